@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+"""
+Benchmarks do capturarXmlSefaz com corpus sintético de NF-e.
+
+O corpus (nfeProc, resNFe, procEventoNFe em meses variados e com nNF repetidos) é
+gerado pelos mesmos geradores do mockSefazDistDFe.py, de forma determinística (--seed).
+
+Uso:
+  python benchCapturarXmlSefaz.py gerar --docs 100000 --saida ./corpus
+  python benchCapturarXmlSefaz.py rodar --corpus ./corpus --json resultado.json
+  python benchCapturarXmlSefaz.py rodar --docs 10000 --online --json novo.json --comparar resultado.json
+
+Mede docs/s, latência por chamada (p50/p99), tempo total e pico de RSS por etapa, e
+grava tudo em JSON para comparar versões (--comparar aponta quedas acima de --tolerancia).
+"""
+
+import argparse
+import base64
+import gzip
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date
+from typing import Callable, Iterator, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import capturarXmlSefaz_1763056346624 as cap  # noqa: E402
+import mockSefazDistDFe as mock  # noqa: E402
+
+# logger próprio: o root fica em WARNING durante as medições (os logs de cada
+# gravação distorceriam os tempos), mas os resultados continuam saindo
+log = logging.getLogger("bench")
+log.setLevel(logging.INFO)
+
+# arquivos por subpasta do corpus (evita diretórios com 1M entradas)
+ARQUIVOS_POR_PASTA = 1000
+LOTE_SOAP = 50
+
+
+# ========= Corpus =========
+
+def corpus_config(meses: str, nnf_distintos: int, seed: int) -> mock.MockConfig:
+    return mock.MockConfig(
+        meses=tuple(m.strip() for m in meses.split(",") if m.strip()),
+        mix=(("procNFe", 0.8), ("resNFe", 0.12), ("procEventoNFe", 0.08)),
+        nnf_distintos=nnf_distintos,
+        seed=seed,
+    )
+
+
+def iter_documentos(cfg: mock.MockConfig, n: int, cnpj: str) -> Iterator[Tuple[int, str, bytes]]:
+    for nsu in range(1, n + 1):
+        tipo, xml = mock.gerar_documento(cfg, cnpj, nsu)
+        yield nsu, tipo, xml
+
+
+def gerar_corpus(saida: str, n: int, cfg: mock.MockConfig, cnpj: str, fracao_xml: float = 0.3) -> int:
+    """
+    Grava n documentos em saida/NNNN/NSU.(b64|xml): a maior parte como docZip
+    (base64+gzip), fracao_xml como XML puro — os dois formatos aceitos por --scan-dir.
+    """
+    passo = int(1 / fracao_xml) if fracao_xml > 0 else 0
+    for nsu, tipo, xml in iter_documentos(cfg, n, cnpj):
+        pasta = os.path.join(saida, f"{(nsu - 1) // ARQUIVOS_POR_PASTA:04d}")
+        if (nsu - 1) % ARQUIVOS_POR_PASTA == 0:
+            os.makedirs(pasta, exist_ok=True)
+        if passo and nsu % passo == 0:
+            nome, dados = f"{nsu:015d}.xml", xml
+        else:
+            nome, dados = f"{nsu:015d}.b64", base64.b64encode(gzip.compress(xml))
+        with open(os.path.join(pasta, nome), "wb") as f:
+            f.write(dados)
+    return n
+
+
+def carregar_amostra(corpus: str, limite: int) -> List[bytes]:
+    """
+    Lê até limite arquivos do corpus, em ordem, como bytes brutos.
+    """
+    dados = []
+    for path in cap._list_scan_files(corpus):
+        with open(path, "rb") as f:
+            dados.append(f.read())
+        if len(dados) >= limite:
+            break
+    return dados
+
+
+# ========= Medição =========
+
+def _rss_pico_mb() -> Optional[float]:
+    """
+    Pico de RSS (MB) deste processo e dos filhos já encerrados (pool de processos).
+    """
+    if resource is None:
+        return None
+    fator = 1024 * 1024 if sys.platform == "darwin" else 1024  # ru_maxrss: bytes no macOS, KB no Linux
+    proprio = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    filhos = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(proprio, filhos) / fator, 1)
+
+
+def _percentil(valores: List[float], p: float) -> float:
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+def medir_por_item(nome: str, fn: Callable, itens: List, docs_por_item: int = 1) -> dict:
+    """
+    Chama fn(item) para cada item, cronometrando cada chamada.
+    """
+    tempos = []
+    inicio = time.perf_counter()
+    for item in itens:
+        t0 = time.perf_counter()
+        fn(item)
+        tempos.append(time.perf_counter() - t0)
+    total = time.perf_counter() - inicio
+    docs = len(itens) * docs_por_item
+    resultado = {
+        "docs": docs,
+        "segundos": round(total, 4),
+        "docs_por_s": round(docs / total, 1) if total else None,
+        "p50_ms": round(_percentil(tempos, 50) * 1000, 4),
+        "p99_ms": round(_percentil(tempos, 99) * 1000, 4),
+        "rss_pico_mb": _rss_pico_mb(),
+    }
+    log.info(f"{nome:<28} {resultado['docs_por_s']:>12} docs/s  p50={resultado['p50_ms']}ms "
+             f"p99={resultado['p99_ms']}ms")
+    return resultado
+
+
+def medir_total(nome: str, fn: Callable[[], int]) -> dict:
+    """
+    Chama fn() uma vez; fn devolve quantos documentos processou.
+    """
+    inicio = time.perf_counter()
+    docs = fn()
+    total = time.perf_counter() - inicio
+    resultado = {
+        "docs": docs,
+        "segundos": round(total, 4),
+        "docs_por_s": round(docs / total, 1) if total else None,
+        "rss_pico_mb": _rss_pico_mb(),
+    }
+    log.info(f"{nome:<28} {resultado['docs_por_s']:>12} docs/s  total={resultado['segundos']}s")
+    return resultado
+
+
+# ========= Benchmarks =========
+
+def bench_funcoes(amostra: List[bytes], filtro: Tuple[int, int]) -> dict:
+    xmls = [cap.decode_local_document(d) for d in amostra]
+    doczips = [d for d in amostra if not d.lstrip().startswith(b"<")]
+    # respostas SOAP com lotes completos de LOTE_SOAP docZip
+    lotes = []
+    for i in range(0, len(xmls) - LOTE_SOAP + 1, LOTE_SOAP):
+        docs = [(i + j + 1, "procNFe", x) for j, x in enumerate(xmls[i:i + LOTE_SOAP])]
+        lotes.append(mock.montar_resposta(138, i + LOTE_SOAP, len(xmls), docs))
+    nfeprocs = [x for x in xmls if b"<nfeProc" in x[:200]]
+
+    r = {}
+    r["gzip_base64_to_xml"] = medir_por_item(
+        "gzip_base64_to_xml", lambda d: cap.gzip_base64_to_xml(d.decode("ascii")), doczips)
+    r["parse_doczips"] = medir_por_item(
+        "parse_doczips", cap.parse_doczips, lotes, LOTE_SOAP)
+    r["extract_chave_from_xml"] = medir_por_item("extract_chave_from_xml", cap.extract_chave_from_xml, nfeprocs)
+    r["extract_doc_meta"] = medir_por_item("extract_doc_meta", cap.extract_doc_meta, xmls)
+    r["probe_emission_date"] = medir_por_item("probe_emission_date", cap.probe_emission_date, xmls)
+    r["matches_month_filter"] = medir_por_item(
+        "matches_month_filter", lambda x: cap.matches_month_filter(x, filtro), nfeprocs)
+    return r
+
+
+def bench_save(amostra: List[bytes], tmp: str) -> dict:
+    metas = []
+    for d in amostra:
+        x = cap.decode_local_document(d)
+        m = cap.extract_doc_meta(x)
+        if m.tag == "nfeProc":
+            metas.append((x, m))
+    r = {}
+    dest = os.path.join(tmp, "save_sem_indice")
+    r["save_nfeproc"] = medir_por_item(
+        "save_nfeproc", lambda xm: cap.save_nfeproc(xm[0], dest, "12345678000199", None, meta=xm[1]), metas)
+    dest = os.path.join(tmp, "save_indice")
+    index = cap.ChaveIndex(dest)
+    r["save_nfeproc_indice"] = medir_por_item(
+        "save_nfeproc (índice)",
+        lambda xm: cap.save_nfeproc(xm[0], dest, "12345678000199", None, meta=xm[1], index=index), metas)
+    r["save_nfeproc_indice_repetido"] = medir_por_item(
+        "save_nfeproc (já indexado)",
+        lambda xm: cap.save_nfeproc(xm[0], dest, "12345678000199", None, meta=xm[1], index=index), metas)
+    return r
+
+
+def bench_scan(corpus: str, tmp: str, filtro: Tuple[int, int], workers: List[int]) -> dict:
+    """
+    process_doczips_locais no corpus inteiro, para cada valor de workers: com filtro de
+    mês, segunda passada (tudo pulado pelo manifesto) e sem filtro (grava tudo).
+    """
+    total = len(cap._list_scan_files(corpus))
+    r = {}
+    for w in workers:
+        manifest = cap.ScanManifest(os.path.join(tmp, f"scan_w{w}.sqlite"))
+
+        def _rodar(dest, mf, manifest):
+            cap.process_doczips_locais(corpus, dest, "12345678000199", mf, apenas_nfeproc=True,
+                                       workers=w, index=cap.ChaveIndex(dest), manifest=manifest)
+            return total
+
+        dest = os.path.join(tmp, f"scan_w{w}")
+        r[f"process_doczips_locais_w{w}"] = medir_total(
+            f"process_doczips_locais w={w}", lambda: _rodar(dest, filtro, manifest))
+        r[f"process_doczips_locais_w{w}_manifesto"] = medir_total(
+            "  ... 2ª passada (manifesto)", lambda: _rodar(dest, filtro, manifest))
+        r[f"process_doczips_locais_w{w}_sem_filtro"] = medir_total(
+            f"  ... sem filtro", lambda: _rodar(os.path.join(tmp, f"scan_w{w}_todos"), None, None))
+    return r
+
+
+def bench_online(docs: int, tmp: str, latencia_ms: float, pipeline: int) -> dict:
+    """
+    baixar_online contra o mock local: mede docs/s e a latência de cada POST (p50/p99).
+    """
+    server, servico, url = mock.iniciar(mock.MockConfig(max_nsu=docs, latencia_ms=latencia_ms))
+    cap.set_endpoint(url)
+    cap.STATE_DIR = os.path.join(tmp, "estado")
+    cap.set_state_store(cap.JsonStateStore())
+
+    tempos = []
+    post_original = cap._post_distdfe
+
+    def _post_cronometrado(*a, **kw):
+        t0 = time.perf_counter()
+        resp = post_original(*a, **kw)
+        tempos.append(time.perf_counter() - t0)
+        return resp
+
+    cap._post_distdfe = _post_cronometrado
+    r = {}
+    try:
+        for modo, workers in (("sequencial", 0), ("pipeline", pipeline)):
+            tempos.clear()
+            cnpj = f"{len(r) + 1:014d}"
+            dest = os.path.join(tmp, f"online_{modo}")
+            index = cap.ChaveIndex(dest)
+            policy = cap.PacingPolicy(intervalo=0, max_chamadas=None)
+
+            def _rodar():
+                cap.baixar_online(
+                    cnpj, "SP", "prod", None, None, None,
+                    lambda xml_txt, raw: cap.salvar_nfeproc_renomeando(xml_txt, raw, dest, cnpj, index=index),
+                    router=None, pipeline_workers=workers, policy=policy)
+                return docs
+
+            res = medir_total(f"baixar_online {modo}", _rodar)
+            res["post_p50_ms"] = round(_percentil(tempos, 50) * 1000, 2)
+            res["post_p99_ms"] = round(_percentil(tempos, 99) * 1000, 2)
+            res["requisicoes"] = len(tempos)
+            r[f"baixar_online_{modo}"] = res
+    finally:
+        cap._post_distdfe = post_original
+        server.shutdown()
+    return r
+
+
+# ========= Relatório =========
+
+def _versao() -> str:
+    try:
+        out = subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10)
+        return out.stdout.strip() or "desconhecida"
+    except (OSError, subprocess.SubprocessError):
+        return "desconhecida"
+
+
+def comparar(atual: dict, base: dict, tolerancia: float) -> List[str]:
+    """
+    Etapas cujo docs/s caiu mais que tolerancia (fração) em relação à base.
+    """
+    regressoes = []
+    for nome, r in atual["resultados"].items():
+        b = base.get("resultados", {}).get(nome)
+        if not b or not b.get("docs_por_s") or not r.get("docs_por_s"):
+            continue
+        variacao = r["docs_por_s"] / b["docs_por_s"] - 1
+        linha = f"{nome:<40} {b['docs_por_s']:>12} -> {r['docs_por_s']:>12} docs/s ({variacao:+.1%})"
+        log.info(linha)
+        if variacao < -tolerancia:
+            regressoes.append(linha)
+    return regressoes
+
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(description="Benchmarks do capturarXmlSefaz com corpus sintético.")
+    sub = p.add_subparsers(dest="comando", required=True)
+
+    def _corpus_args(sp):
+        sp.add_argument("--docs", type=int, default=10000, help="Documentos no corpus (default: 10000).")
+        sp.add_argument("--meses", default="2025-09,2025-10,2025-11", help="Meses de emissão (AAAA-MM,...).")
+        sp.add_argument("--nnf-distintos", type=int, default=2000,
+                        help="Faixa de nNF; menor que --docs gera nNF repetidos (default: 2000).")
+        sp.add_argument("--seed", type=int, default=1)
+
+    g = sub.add_parser("gerar", help="Gera um corpus em disco para --scan-dir ou para rodar.")
+    _corpus_args(g)
+    g.add_argument("--saida", required=True)
+
+    r = sub.add_parser("rodar", help="Roda os benchmarks (gera um corpus temporário se --corpus faltar).")
+    _corpus_args(r)
+    r.add_argument("--corpus", help="Corpus gerado antes com 'gerar'.")
+    r.add_argument("--amostra", type=int, default=20000,
+                   help="Documentos carregados em memória para os benchmarks por função (default: 20000).")
+    r.add_argument("--workers", default=f"1,{os.cpu_count() or 1}",
+                   help="Valores de workers para process_doczips_locais (default: 1,<CPUs>).")
+    r.add_argument("--online", action="store_true", help="Inclui baixar_online contra o mock local.")
+    r.add_argument("--latencia", type=float, default=0, help="Latência do mock no modo --online (ms).")
+    r.add_argument("--pipeline", type=int, default=2, help="Workers do modo pipeline em --online.")
+    r.add_argument("--json", help="Arquivo de saída com os resultados.")
+    r.add_argument("--comparar", help="Resultado anterior (JSON) para comparação.")
+    r.add_argument("--tolerancia", type=float, default=0.10,
+                   help="Queda de docs/s tolerada antes de acusar regressão (default: 0.10).")
+    r.add_argument("--manter", action="store_true", help="Não apaga o diretório temporário.")
+    return p
+
+
+def main():
+    args = build_arg_parser().parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s",
+                        datefmt="%Y-%m-%d %H:%M:%S")
+    cfg = corpus_config(args.meses, args.nnf_distintos, args.seed)
+    cnpj = "12345678000199"
+
+    if args.comando == "gerar":
+        inicio = time.perf_counter()
+        gerar_corpus(args.saida, args.docs, cfg, cnpj)
+        logging.info(f"{args.docs} documentos gerados em {args.saida} ({time.perf_counter() - inicio:.1f}s)")
+        return
+
+    tmp = tempfile.mkdtemp(prefix="bench_sefaz_")
+    logging.getLogger().setLevel(logging.WARNING)
+    try:
+        corpus = args.corpus
+        if not corpus:
+            corpus = os.path.join(tmp, "corpus")
+            gerar_corpus(corpus, args.docs, cfg, cnpj)
+        filtro = tuple(int(x) for x in cfg.meses[0].split("-"))
+        log.info(f"Corpus: {corpus}")
+
+        amostra = carregar_amostra(corpus, args.amostra)
+        resultados = bench_funcoes(amostra, filtro)
+        resultados.update(bench_save(amostra, tmp))
+        del amostra
+        resultados.update(bench_scan(corpus, tmp, filtro, [int(w) for w in args.workers.split(",") if w]))
+        if args.online:
+            resultados.update(bench_online(args.docs, tmp, args.latencia, args.pipeline))
+
+        relatorio = {
+            "versao": _versao(),
+            "data": date.today().isoformat(),
+            "python": platform.python_version(),
+            "plataforma": platform.platform(),
+            "cpus": os.cpu_count(),
+            "docs": args.docs,
+            "rss_pico_mb": _rss_pico_mb(),
+            "resultados": resultados,
+        }
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(relatorio, f, indent=2, ensure_ascii=False)
+            log.info(f"Resultados gravados em {args.json}")
+
+        if args.comparar:
+            with open(args.comparar, "r", encoding="utf-8") as f:
+                base = json.load(f)
+            log.info(f"Comparação com {args.comparar} (versão {base.get('versao')}):")
+            regressoes = comparar(relatorio, base, args.tolerancia)
+            if regressoes:
+                log.warning("Regressões acima da tolerância:\n" + "\n".join(regressoes))
+                sys.exit(1)
+    finally:
+        if args.manter:
+            log.info(f"Diretório temporário mantido: {tmp}")
+        else:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,58 @@
 import argparse
 import base64
+import bisect
 import gzip
+import hashlib
+import heapq
 import io
 import json
 import logging
+import mmap
 import os
+import queue
+import random
 import time
 import re
+import signal
+import socket
+import sqlite3
 import sys
+import tarfile
+import tempfile
+import threading
+import traceback
 import xml.etree.ElementTree as ET
-from datetime import datetime, timezone
-from typing import Optional, Tuple, List,Callable
-import requests_pkcs12
-
-import requests
-from requests_pkcs12 import Pkcs12Adapter
+import zipfile
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from datetime import date, datetime, timedelta, timezone
+from io import BytesIO
+from itertools import islice, repeat
+from typing import IO, Optional, Tuple, List, Callable, Iterator, NamedTuple, Union
 from lxml import etree
 from dateutil import parser as dtparser
 from dateutil.relativedelta import relativedelta
 
+try:
+    import fcntl
+except ImportError:  # Windows: pacotes sem lock entre processos (um processo por DEST)
+    fcntl = None
+
+# requests/requests_pkcs12 só são importados quando há acesso à rede (ver _load_network):
+# a leitura local (--scan-dir) não paga esse custo.
+requests = None
+requests_pkcs12 = None
+urllib3 = None
+
 # ========= Configurações padrão =========
 
 
 STATE_DIR = "state"
+QUARANTINE_DIR = "quarentena"
+# Espera antes de tentar de novo um CNPJ cuja execução falhou (modo --continuo)
+TENANT_RETRY_SECONDS = 300
+LEASE_TTL_SECONDS = 120
 NS_NFE = "http://www.portalfiscal.inf.br/nfe"
 NS_SOAP = "http://www.w3.org/2003/05/soap-envelope"
 SOAP_ACTION = "http://www.portalfiscal.inf.br/nfe/wsdl/NFeDistribuicaoDFe/nfeDistDFeInteresse"
@@ -55,32 +85,815 @@ def _state_filepath(cnpj: str, ambiente: str) -> str:
     fn = f"{cnpj}_{ambiente}.json"
     return os.path.join(STATE_DIR, fn)
 
-def load_state(cnpj: str, ambiente: str) -> dict:
-    path = _state_filepath(cnpj, ambiente)
-    if os.path.isfile(path):
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
+def _ledger_filepath(cnpj: str, ambiente: str) -> str:
+    return os.path.join(STATE_DIR, f"{cnpj}_{ambiente}.nsu.json")
+
+def _default_state() -> dict:
     return {
         "ult_nsu": "000000000000000",
         "next_allowed_ts": 0
     }
 
-def save_state(cnpj: str, ambiente: str, ult_nsu: str, next_allowed_ts: float) -> None:
-    path = _state_filepath(cnpj, ambiente)
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    state = {
-        "ult_nsu": ult_nsu,
-        "next_allowed_ts": next_allowed_ts
-    }
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(state, f, indent=2)
 
-def setup_logging(logfile: Optional[str], verbose: bool):
+class JsonStateStore:
+    """
+    Estado em STATE_DIR/{cnpj}_{ambiente}.json, um arquivo por CNPJ/ambiente.
+    """
+
+    def load(self, cnpj: str, ambiente: str) -> dict:
+        path = _state_filepath(cnpj, ambiente)
+        if os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        return _default_state()
+
+    def save(self, cnpj: str, ambiente: str, **campos) -> None:
+        path = _state_filepath(cnpj, ambiente)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        state = self.load(cnpj, ambiente)
+        state.update(campos)
+        state["updated_at"] = time.time()
+        _atomic_write_json(path, state)
+
+    def list(self) -> List[dict]:
+        states = []
+        if not os.path.isdir(STATE_DIR):
+            return states
+        for fn in sorted(os.listdir(STATE_DIR)):
+            m = re.fullmatch(r"(\d+)_(\w+)\.json", fn)
+            if not m:
+                continue
+            state = self.load(m.group(1), m.group(2))
+            states.append({"cnpj": m.group(1), "ambiente": m.group(2), **state})
+        return states
+
+    def load_ledger(self, cnpj: str, ambiente: str) -> Optional["NsuLedger"]:
+        path = _ledger_filepath(cnpj, ambiente)
+        if os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as f:
+                return NsuLedger.from_dict(json.load(f))
+        return None
+
+    def save_ledger(self, cnpj: str, ambiente: str, ledger: "NsuLedger") -> None:
+        # livro em arquivo próprio ({cnpj}_{ambiente}.nsu.json): sobrevive a um estado apagado
+        atual = self.load_ledger(cnpj, ambiente)
+        if atual is not None:
+            ledger.merge(atual)
+        os.makedirs(STATE_DIR, exist_ok=True)
+        _atomic_write_json(_ledger_filepath(cnpj, ambiente), {**ledger.to_dict(), "updated_at": time.time()})
+
+
+class _SqliteThreadLocal:
+    """
+    Base para arquivos SQLite usados por várias threads: uma conexão por thread,
+    WAL e autocommit (transações explícitas com BEGIN quando necessário).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def _conn(self) -> sqlite3.Connection:
+        # uma conexão por thread (sqlite3 não compartilha conexões entre threads)
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+
+class SqliteStateStore(_SqliteThreadLocal):
+    """
+    Estado de todos os CNPJs numa base SQLite embutida, uma linha por (cnpj, ambiente).
+    Cada gravação é um read-modify-write dentro de BEGIN IMMEDIATE, então execuções
+    concorrentes (threads ou processos) não sobrescrevem campos umas das outras.
+    Campos sem coluna própria vão para a coluna extra (JSON).
+    """
+
+    COLUMNS = ("ult_nsu", "max_nsu", "next_allowed_ts", "last_cstat",
+               "last_run_start", "last_run_end", "updated_at")
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self._conn().execute("""
+            CREATE TABLE IF NOT EXISTS estado (
+                cnpj TEXT NOT NULL,
+                ambiente TEXT NOT NULL,
+                ult_nsu TEXT NOT NULL DEFAULT '000000000000000',
+                max_nsu TEXT,
+                next_allowed_ts REAL NOT NULL DEFAULT 0,
+                last_cstat INTEGER,
+                last_run_start REAL,
+                last_run_end REAL,
+                updated_at REAL,
+                extra TEXT,
+                PRIMARY KEY (cnpj, ambiente)
+            )""")
+        self._conn().execute("""
+            CREATE TABLE IF NOT EXISTS livro_nsu (
+                cnpj TEXT NOT NULL,
+                ambiente TEXT NOT NULL,
+                desde INTEGER NOT NULL DEFAULT 0,
+                recebidos TEXT NOT NULL DEFAULT '',
+                gravados TEXT NOT NULL DEFAULT '',
+                vazios TEXT NOT NULL DEFAULT '',
+                updated_at REAL,
+                PRIMARY KEY (cnpj, ambiente)
+            )""")
+
+    @staticmethod
+    def _row_to_state(row: sqlite3.Row) -> dict:
+        state = {k: row[k] for k in SqliteStateStore.COLUMNS if row[k] is not None}
+        if row["extra"]:
+            state.update(json.loads(row["extra"]))
+        return state
+
+    def load(self, cnpj: str, ambiente: str) -> dict:
+        row = self._conn().execute(
+            "SELECT * FROM estado WHERE cnpj = ? AND ambiente = ?", (cnpj, ambiente)).fetchone()
+        if row is None:
+            return _default_state()
+        return self._row_to_state(row)
+
+    def save(self, cnpj: str, ambiente: str, **campos) -> None:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT * FROM estado WHERE cnpj = ? AND ambiente = ?", (cnpj, ambiente)).fetchone()
+            state = self._row_to_state(row) if row is not None else _default_state()
+            state.update(campos)
+            state["updated_at"] = time.time()
+            extra = {k: v for k, v in state.items() if k not in self.COLUMNS}
+            values = [state.get(k) for k in self.COLUMNS]
+            conn.execute(
+                f"INSERT OR REPLACE INTO estado (cnpj, ambiente, {', '.join(self.COLUMNS)}, extra) "
+                f"VALUES (?, ?, {', '.join('?' for _ in self.COLUMNS)}, ?)",
+                [cnpj, ambiente, *values, json.dumps(extra) if extra else None])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def list(self) -> List[dict]:
+        rows = self._conn().execute("SELECT * FROM estado ORDER BY cnpj, ambiente").fetchall()
+        return [{"cnpj": r["cnpj"], "ambiente": r["ambiente"], **self._row_to_state(r)} for r in rows]
+
+    @staticmethod
+    def _load_ledger(conn: sqlite3.Connection, cnpj: str, ambiente: str) -> Optional["NsuLedger"]:
+        row = conn.execute("SELECT * FROM livro_nsu WHERE cnpj = ? AND ambiente = ?", (cnpj, ambiente)).fetchone()
+        return NsuLedger.from_dict(dict(row)) if row is not None else None
+
+    def load_ledger(self, cnpj: str, ambiente: str) -> Optional["NsuLedger"]:
+        return self._load_ledger(self._conn(), cnpj, ambiente)
+
+    def save_ledger(self, cnpj: str, ambiente: str, ledger: "NsuLedger") -> None:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            atual = self._load_ledger(conn, cnpj, ambiente)
+            if atual is not None:
+                ledger.merge(atual)
+            d = ledger.to_dict()
+            conn.execute(
+                "INSERT OR REPLACE INTO livro_nsu (cnpj, ambiente, desde, recebidos, gravados, vazios, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (cnpj, ambiente, d["desde"], d["recebidos"], d["gravados"], d["vazios"], time.time()))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+
+_STATE_STORE = JsonStateStore()
+
+
+def set_state_store(store) -> None:
+    """
+    Troca o backend de estado usado por load_state/save_state.
+    """
+    global _STATE_STORE
+    _STATE_STORE = store
+
+
+def open_state_store(backend: str, db_path: Optional[str] = None):
+    if backend == "sqlite":
+        return SqliteStateStore(db_path or os.path.join(STATE_DIR, "estado.sqlite"))
+    return JsonStateStore()
+
+
+def load_state(cnpj: str, ambiente: str) -> dict:
+    return _STATE_STORE.load(cnpj, ambiente)
+
+def save_state(cnpj: str, ambiente: str, ult_nsu: str, next_allowed_ts: float,
+               lease: Optional["Lease"] = None, **campos) -> None:
+    """
+    Grava o cursor de NSU e o próximo horário permitido; campos extras
+    (max_nsu, last_cstat, last_run_start, ...) são mesclados ao estado atual.
+    Com lease, só grava se o token ainda for o vigente (senão levanta LeasePerdido).
+    """
+    with _fencing(lease):
+        _STATE_STORE.save(cnpj, ambiente, ult_nsu=ult_nsu, next_allowed_ts=next_allowed_ts, **campos)
+
+
+# ========= Livro de NSUs =========
+
+class NsuRanges:
+    """
+    Conjunto de NSUs guardado como faixas [ini, fim] ordenadas e disjuntas (run-length):
+    um histórico contíguo ocupa uma única faixa. Em texto: "1-250,260,262-400".
+    """
+
+    def __init__(self, faixas=()):
+        self._ini: List[int] = []
+        self._fim: List[int] = []
+        for ini, fim in faixas:
+            self.add(ini, fim)
+
+    @classmethod
+    def parse(cls, texto: Optional[str]) -> "NsuRanges":
+        r = cls()
+        for parte in (texto or "").split(","):
+            parte = parte.strip()
+            if parte:
+                ini, _, fim = parte.partition("-")
+                r.add(int(ini), int(fim or ini))
+        return r
+
+    def __str__(self) -> str:
+        return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in self)
+
+    def __repr__(self) -> str:
+        return f"NsuRanges({str(self)!r})"
+
+    def __iter__(self) -> Iterator[Tuple[int, int]]:
+        return iter(zip(self._ini, self._fim))
+
+    def __bool__(self) -> bool:
+        return bool(self._ini)
+
+    def __contains__(self, nsu: int) -> bool:
+        i = bisect.bisect_right(self._ini, nsu) - 1
+        return i >= 0 and self._fim[i] >= nsu
+
+    def add(self, ini: int, fim: Optional[int] = None) -> None:
+        fim = ini if fim is None else fim
+        if fim < ini:
+            return
+        # funde com as faixas que se sobrepõem ou encostam em [ini, fim]
+        i = bisect.bisect_left(self._fim, ini - 1)
+        j = bisect.bisect_right(self._ini, fim + 1)
+        if i < j:
+            ini = min(ini, self._ini[i])
+            fim = max(fim, self._fim[j - 1])
+        self._ini[i:j] = [ini]
+        self._fim[i:j] = [fim]
+
+    def update(self, outro: "NsuRanges") -> None:
+        for ini, fim in outro:
+            self.add(ini, fim)
+
+    def total(self) -> int:
+        return sum(b - a + 1 for a, b in self)
+
+    def max(self) -> int:
+        return self._fim[-1] if self._fim else 0
+
+    def diferenca(self, outro: "NsuRanges") -> "NsuRanges":
+        """
+        NSUs deste conjunto que não estão em outro.
+        """
+        r = NsuRanges()
+        for ini, fim in self:
+            # faixas de outro que cortam [ini, fim], em ordem
+            k = bisect.bisect_left(outro._fim, ini)
+            while ini <= fim:
+                if k >= len(outro._ini) or outro._ini[k] > fim:
+                    r.add(ini, fim)
+                    break
+                if outro._ini[k] > ini:
+                    r.add(ini, outro._ini[k] - 1)
+                ini = outro._fim[k] + 1
+                k += 1
+        return r
+
+    def nsus(self) -> Iterator[int]:
+        for ini, fim in self:
+            yield from range(ini, fim + 1)
+
+
+class NsuLedger:
+    """
+    Livro de NSUs de um CNPJ/ambiente, independente do cursor ult_nsu:
+    recebidos — NSUs que chegaram num docZip;
+    gravados — recebidos resolvidos sem erro (gravados, já existentes ou descartados pela configuração);
+    vazios — NSUs que o consNSU respondeu sem documento (137): deixam de ser lacuna;
+    desde — cursor quando o livro começou; NSUs até ele não são cobrados.
+    Atualizado por várias threads (pipeline), por isso as alterações passam por lock.
+    """
+
+    def __init__(self, desde: int = 0, recebidos: Optional[NsuRanges] = None,
+                 gravados: Optional[NsuRanges] = None, vazios: Optional[NsuRanges] = None):
+        self.desde = desde
+        self.recebidos = recebidos or NsuRanges()
+        self.gravados = gravados or NsuRanges()
+        self.vazios = vazios or NsuRanges()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "NsuLedger":
+        return cls(int(d.get("desde") or 0), NsuRanges.parse(d.get("recebidos")),
+                   NsuRanges.parse(d.get("gravados")), NsuRanges.parse(d.get("vazios")))
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {"desde": self.desde, "recebidos": str(self.recebidos),
+                    "gravados": str(self.gravados), "vazios": str(self.vazios)}
+
+    def recebido(self, nsu: Optional[str], resolvido: bool = False) -> None:
+        if not nsu:
+            return
+        n = int(nsu)
+        with self._lock:
+            self.recebidos.add(n)
+            if resolvido:
+                self.gravados.add(n)
+
+    def gravado(self, nsu: Optional[str]) -> None:
+        if nsu:
+            with self._lock:
+                self.gravados.add(int(nsu))
+
+    def vazio(self, nsu: int) -> None:
+        with self._lock:
+            self.vazios.add(nsu)
+
+    def merge(self, outro: "NsuLedger") -> None:
+        # só acrescenta fatos: o livro gravado por outro nó/execução não é perdido
+        with self._lock:
+            self.desde = min(self.desde, outro.desde)
+            self.recebidos.update(outro.recebidos)
+            self.gravados.update(outro.gravados)
+            self.vazios.update(outro.vazios)
+
+    def lacunas(self, ate: int) -> Tuple[NsuRanges, NsuRanges]:
+        """
+        (não recebidos entre desde+1 e ate, recebidos mas não gravados).
+        """
+        with self._lock:
+            conhecidos = NsuRanges(self.recebidos)
+            conhecidos.update(self.vazios)
+            nao_recebidos = NsuRanges([(self.desde + 1, ate)]).diferenca(conhecidos)
+            return nao_recebidos, self.recebidos.diferenca(self.gravados)
+
+
+def load_ledger(cnpj: str, ambiente: str) -> Optional[NsuLedger]:
+    return _STATE_STORE.load_ledger(cnpj, ambiente)
+
+
+def save_ledger(cnpj: str, ambiente: str, ledger: NsuLedger, lease: Optional["Lease"] = None) -> None:
+    """
+    Grava o livro mesclando com o que já está no backend (ledger também recebe o que faltava).
+    lease tem o mesmo papel que em save_state.
+    """
+    with _fencing(lease):
+        _STATE_STORE.save_ledger(cnpj, ambiente, ledger)
+
+
+def format_gap_report(linhas: List[Tuple[dict, Optional[NsuLedger]]], max_faixas: int = 8) -> str:
+    """
+    Lacunas por CNPJ: NSUs não recebidos até o cursor e recebidos sem gravação,
+    com as primeiras faixas de cada um.
+    """
+    def _faixas(r: NsuRanges) -> str:
+        lista = list(r)
+        partes = [str(a) if a == b else f"{a}-{b}" for a, b in lista[:max_faixas]]
+        return ",".join(partes) + (",..." if len(lista) > max_faixas else "")
+
+    out = [f"{'CNPJ':<14} {'AMB':<5} {'ULT_NSU':>15} {'DESDE':>9} {'RECEBIDOS':>9} {'NÃO_RECEB':>9} {'NÃO_GRAV':>9}  FAIXAS"]
+    for st, livro in linhas:
+        ult = int(st.get("ult_nsu") or 0)
+        if livro is None:
+            out.append(f"{st['cnpj']:<14} {st['ambiente']:<5} {ult:>15} {'-':>9} {'-':>9} {'-':>9} {'-':>9}  (sem livro)")
+            continue
+        nao_rec, nao_grav = livro.lacunas(ult)
+        faixas = "; ".join(f"{nome} {_faixas(r)}" for nome, r in (("não recebidos", nao_rec), ("não gravados", nao_grav)) if r)
+        out.append(f"{st['cnpj']:<14} {st['ambiente']:<5} {ult:>15} {livro.desde:>9} {livro.recebidos.total():>9} "
+                   f"{nao_rec.total():>9} {nao_grav.total():>9}  {faixas or '-'}")
+    return "\n".join(out)
+
+
+def import_json_states(store, state_dir: Optional[str] = None) -> int:
+    """
+    Importa os arquivos {cnpj}_{ambiente}.json de state_dir (padrão STATE_DIR) para store.
+    Retorna quantos estados foram importados.
+    """
+    state_dir = state_dir or STATE_DIR
+    n = 0
+    for fn in sorted(os.listdir(state_dir)):
+        m = re.fullmatch(r"(\d+)_(\w+)\.json", fn)
+        if not m:
+            continue
+        with open(os.path.join(state_dir, fn), "r", encoding="utf-8") as f:
+            state = json.load(f)
+        store.save(m.group(1), m.group(2), **state)
+        n += 1
+        logging.info(f"Estado importado: {fn}")
+    return n
+
+
+def format_state_report(states: List[dict]) -> str:
+    """
+    Tabela de estado por CNPJ: atraso em relação ao maxNSU e espera restante,
+    ordenada pelos mais atrasados.
+    """
+    now = time.time()
+    linhas = []
+    for st in states:
+        ult = int(st.get("ult_nsu") or 0)
+        mx = int(st["max_nsu"]) if st.get("max_nsu") else None
+        atraso = mx - ult if mx is not None else None
+        espera = max(0, int(st.get("next_allowed_ts", 0) - now))
+        linhas.append((atraso if atraso is not None else -1, st, mx, espera))
+    linhas.sort(key=lambda x: x[0], reverse=True)
+
+    out = [f"{'CNPJ':<14} {'AMB':<5} {'ULT_NSU':>15} {'MAX_NSU':>15} {'ATRASO':>8} {'ESPERA(s)':>9} {'cStat':>5}"]
+    for atraso, st, mx, espera in linhas:
+        out.append(
+            f"{st['cnpj']:<14} {st['ambiente']:<5} {st.get('ult_nsu', ''):>15} "
+            f"{(str(mx).rjust(15, '0') if mx is not None else '-'):>15} "
+            f"{(atraso if atraso >= 0 else '-'):>8} {espera:>9} {st.get('last_cstat') or '-':>5}")
+    return "\n".join(out)
+
+
+def format_catalog_report(rows: List[dict]) -> str:
+    """
+    Tabela do resultado de ChaveIndex.consultar, com o total de notas e de vNF.
+    """
+    out = [f"{'CHAVE':<44} {'nNF':>9} {'EMISSÃO':<10} {'EMITENTE':<14} {'DESTINATÁRIO':<14} {'vNF':>14} {'cStat':>5}  ARQUIVO"]
+    total = 0.0
+    for r in rows:
+        total += r["v_nf"] or 0
+        v_nf = f"{r['v_nf']:.2f}" if r["v_nf"] is not None else "-"
+        out.append(
+            f"{r['chave']:<44} {r['nnf'] or '-':>9} {r['data_emi'] or '-':<10} {r['cnpj_emit'] or '-':<14} "
+            f"{r['cnpj_dest'] or '-':<14} {v_nf:>14} {r['c_stat'] or '-':>5}  {r['path']}")
+    out.append(f"{len(rows)} nota(s), vNF total {total:.2f}")
+    return "\n".join(out)
+
+def _atomic_write_json(path: str, obj) -> None:
+    """
+    Grava JSON de forma segura contra queda do processo: escreve num temporário
+    na mesma pasta, faz fsync e troca pelo arquivo final com os.replace.
+    """
+    _atomic_write_text(path, json.dumps(obj, indent=2))
+
+
+def _atomic_write_text(path: str, text: str) -> None:
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                               dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+# ========= Leases entre nós (vários hosts no mesmo manifesto) =========
+
+class Lease(NamedTuple):
+    """
+    Posse temporária de um recurso ({cnpj}_{ambiente}) por um nó.
+    token cresce a cada nova posse (inclusive quando um nó toma um lease vencido):
+    serve de fencing para saber se a posse ainda é a mesma.
+    """
+    recurso: str
+    dono: str
+    token: int
+    expira_em: float
+
+
+class LeaseOcupado(Exception):
+    """
+    O recurso está com lease válido de outro nó (ou de outra execução do mesmo nó).
+    """
+
+    def __init__(self, lease: Lease):
+        super().__init__(f"{lease.recurso} em uso por {lease.dono} até "
+                         f"{datetime.fromtimestamp(lease.expira_em).isoformat(timespec='seconds')}")
+        self.lease = lease
+
+
+class LeasePerdido(Exception):
+    """
+    Gravação recusada: o token do lease não é mais o vigente (outro nó tomou o recurso).
+    """
+
+    def __init__(self, lease: Lease):
+        super().__init__(f"Lease de {lease.recurso} perdido (token {lease.token} de {lease.dono} "
+                         f"não é mais o vigente)")
+        self.lease = lease
+
+
+class FileLeaseStore:
+    """
+    Leases em arquivos {recurso}.lease numa pasta compartilhada (NFS, volume comum).
+    Cada operação é um read-modify-write sob fcntl.flock exclusivo num {recurso}.lease.lock
+    permanente: o lock morre com o processo que o segura, então não há lock abandonado
+    a remover (e nenhuma corrida entre dois nós removendo o mesmo lock).
+    """
+
+    LOCK_TIMEOUT_SECONDS = 10
+
+    def __init__(self, pasta: str):
+        if fcntl is None:
+            raise RuntimeError("--lease-backend arquivo requer fcntl (POSIX); use --lease-backend sqlite")
+        self.pasta = pasta
+        os.makedirs(pasta, exist_ok=True)
+
+    def _path(self, recurso: str) -> str:
+        return os.path.join(self.pasta, f"{recurso}.lease")
+
+    @contextmanager
+    def _mutex(self, recurso: str):
+        lock = self._path(recurso) + ".lock"
+        limite = time.time() + self.LOCK_TIMEOUT_SECONDS
+        with open(lock, "ab") as f:
+            while True:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.time() > limite:
+                        raise TimeoutError(f"Tempo esgotado aguardando {lock}")
+                    time.sleep(random.uniform(0.01, 0.05))
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def get(self, recurso: str) -> Optional[Lease]:
+        try:
+            with open(self._path(recurso), "r", encoding="utf-8") as f:
+                return Lease(**json.load(f))
+        except FileNotFoundError:
+            return None
+
+    def acquire(self, recurso: str, dono: str, ttl: float) -> Tuple[Optional[Lease], Lease]:
+        """
+        Tenta tomar o recurso. Retorna (lease obtido ou None, lease vigente).
+        """
+        with self._mutex(recurso):
+            atual = self.get(recurso)
+            now = time.time()
+            if atual is not None and atual.dono and atual.expira_em > now:
+                return None, atual
+            novo = Lease(recurso, dono, (atual.token if atual else 0) + 1, now + ttl)
+            _atomic_write_json(self._path(recurso), novo._asdict())
+            return novo, novo
+
+    def renew(self, lease: Lease, ttl: float) -> Optional[Lease]:
+        with self._mutex(lease.recurso):
+            atual = self.get(lease.recurso)
+            if atual is None or (atual.dono, atual.token) != (lease.dono, lease.token):
+                return None
+            novo = lease._replace(expira_em=time.time() + ttl)
+            _atomic_write_json(self._path(lease.recurso), novo._asdict())
+            return novo
+
+    def release(self, lease: Lease) -> bool:
+        # mantém o arquivo (e o token) para a próxima posse continuar a sequência
+        with self._mutex(lease.recurso):
+            atual = self.get(lease.recurso)
+            if atual is None or (atual.dono, atual.token) != (lease.dono, lease.token):
+                return False
+            _atomic_write_json(self._path(lease.recurso), lease._replace(dono="", expira_em=0)._asdict())
+            return True
+
+    @contextmanager
+    def fencing(self, lease: Lease):
+        """
+        Executa o bloco sob o lock do lease, só se lease ainda for a posse vigente
+        (senão levanta LeasePerdido): ninguém toma o recurso no meio da gravação.
+        """
+        with self._mutex(lease.recurso):
+            atual = self.get(lease.recurso)
+            if atual is None or (atual.dono, atual.token) != (lease.dono, lease.token):
+                raise LeasePerdido(lease)
+            yield
+
+    def list(self) -> List[Lease]:
+        return [lease for fn in sorted(os.listdir(self.pasta)) if fn.endswith(".lease")
+                for lease in [self.get(fn[:-len(".lease")])] if lease is not None]
+
+
+class SqliteLeaseStore(_SqliteThreadLocal):
+    """
+    Leases numa tabela SQLite (uma linha por recurso), cada operação em BEGIN IMMEDIATE.
+    Serve para vários processos no mesmo host ou num volume com lock de arquivo confiável.
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self._conn().execute("""
+            CREATE TABLE IF NOT EXISTS leases (
+                recurso TEXT PRIMARY KEY,
+                dono TEXT NOT NULL,
+                token INTEGER NOT NULL,
+                expira_em REAL NOT NULL
+            )""")
+
+    @contextmanager
+    def _transacao(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _get(conn: sqlite3.Connection, recurso: str) -> Optional[Lease]:
+        row = conn.execute("SELECT * FROM leases WHERE recurso = ?", (recurso,)).fetchone()
+        return Lease(row["recurso"], row["dono"], row["token"], row["expira_em"]) if row else None
+
+    def get(self, recurso: str) -> Optional[Lease]:
+        return self._get(self._conn(), recurso)
+
+    def acquire(self, recurso: str, dono: str, ttl: float) -> Tuple[Optional[Lease], Lease]:
+        with self._transacao() as conn:
+            atual = self._get(conn, recurso)
+            now = time.time()
+            if atual is not None and atual.dono and atual.expira_em > now:
+                return None, atual
+            novo = Lease(recurso, dono, (atual.token if atual else 0) + 1, now + ttl)
+            conn.execute("INSERT OR REPLACE INTO leases (recurso, dono, token, expira_em) VALUES (?, ?, ?, ?)",
+                         novo)
+            return novo, novo
+
+    def renew(self, lease: Lease, ttl: float) -> Optional[Lease]:
+        novo = lease._replace(expira_em=time.time() + ttl)
+        with self._transacao() as conn:
+            cur = conn.execute("UPDATE leases SET expira_em = ? WHERE recurso = ? AND dono = ? AND token = ?",
+                               (novo.expira_em, lease.recurso, lease.dono, lease.token))
+        return novo if cur.rowcount else None
+
+    def release(self, lease: Lease) -> bool:
+        with self._transacao() as conn:
+            cur = conn.execute("UPDATE leases SET dono = '', expira_em = 0 WHERE recurso = ? AND dono = ? AND token = ?",
+                               (lease.recurso, lease.dono, lease.token))
+        return bool(cur.rowcount)
+
+    @contextmanager
+    def fencing(self, lease: Lease):
+        """
+        Como FileLeaseStore.fencing; o lock é a transação (BEGIN IMMEDIATE) na base de leases,
+        que por isso não pode ser a mesma base do estado.
+        """
+        with self._transacao() as conn:
+            if conn.execute("SELECT 1 FROM leases WHERE recurso = ? AND dono = ? AND token = ?",
+                            (lease.recurso, lease.dono, lease.token)).fetchone() is None:
+                raise LeasePerdido(lease)
+            yield
+
+    def list(self) -> List[Lease]:
+        rows = self._conn().execute("SELECT * FROM leases ORDER BY recurso").fetchall()
+        return [Lease(r["recurso"], r["dono"], r["token"], r["expira_em"]) for r in rows]
+
+
+class LeaseHeartbeat:
+    """
+    Renova um lease em segundo plano a cada ttl/3 enquanto o CNPJ é baixado.
+    perdido é sinalizado quando outro nó passou a ser o dono, ou quando as renovações
+    falham até faltar só um intervalo para o vencimento (a partir daí outro nó pode tomá-lo).
+    Ao sair, libera o lease se ele ainda for deste nó.
+    """
+
+    def __init__(self, store, lease: Lease, ttl: float):
+        self.store = store
+        self.lease = lease
+        self.ttl = ttl
+        self.intervalo = max(0.05, ttl / 3)
+        self.perdido = threading.Event()
+        self._parar = threading.Event()
+        self._thread = threading.Thread(target=self._renovar, name=f"lease-{lease.recurso}", daemon=True)
+
+    def _renovar(self) -> None:
+        while not self._parar.wait(self.intervalo):
+            try:
+                novo = self.store.renew(self.lease, self.ttl)
+            except Exception as e:
+                if time.time() + self.intervalo < self.lease.expira_em:
+                    logging.warning(f"Falha ao renovar lease de {self.lease.recurso} ({e}); nova tentativa")
+                    continue
+                logging.error(f"Lease de {self.lease.recurso} não renovado a tempo: {e}")
+                novo = None
+            if novo is None:
+                logging.error(f"Lease de {self.lease.recurso} perdido (token {self.lease.token}); interrompendo")
+                self.perdido.set()
+                return
+            self.lease = novo
+
+    def __enter__(self) -> "LeaseHeartbeat":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._parar.set()
+        self._thread.join()
+        if not self.perdido.is_set():
+            try:
+                self.store.release(self.lease)
+            except Exception as e:
+                # sem liberar, o lease só vence pelo TTL
+                logging.warning(f"Falha ao liberar lease de {self.lease.recurso}: {e}")
+
+
+_LEASE_STORE = None
+_LEASE_TTL = LEASE_TTL_SECONDS
+_NODE_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def set_lease_store(store, ttl: float = LEASE_TTL_SECONDS, node_id: Optional[str] = None) -> None:
+    """
+    Ativa a coordenação entre nós: cada CNPJ/ambiente só é baixado por quem tiver o lease.
+    Com store None (padrão), não há coordenação.
+    """
+    global _LEASE_STORE, _LEASE_TTL, _NODE_ID
+    _LEASE_STORE = store
+    _LEASE_TTL = ttl
+    if node_id:
+        _NODE_ID = node_id
+
+
+def open_lease_store(backend: str, path: Optional[str] = None):
+    if backend == "arquivo":
+        return FileLeaseStore(path or os.path.join(STATE_DIR, "leases"))
+    if backend == "sqlite":
+        return SqliteLeaseStore(path or os.path.join(STATE_DIR, "leases.sqlite"))
+    return None
+
+
+@contextmanager
+def tenant_lease(cnpj: str, ambiente: str):
+    """
+    Toma o lease de {cnpj}_{ambiente} pela duração do bloco, com heartbeat.
+    Entrega o LeaseHeartbeat (None sem store configurado); levanta LeaseOcupado
+    se outro nó estiver com o recurso.
+    """
+    if _LEASE_STORE is None:
+        yield None
+        return
+    lease, atual = _LEASE_STORE.acquire(f"{cnpj}_{ambiente}", _NODE_ID, _LEASE_TTL)
+    if lease is None:
+        raise LeaseOcupado(atual)
+    logging.debug(f"Lease de {lease.recurso} obtido por {_NODE_ID} (token {lease.token})")
+    with LeaseHeartbeat(_LEASE_STORE, lease, _LEASE_TTL) as hb:
+        yield hb
+
+
+@contextmanager
+def _fencing(lease: Optional[Lease]):
+    """
+    Cerca uma gravação de estado/livro pelo token de lease (sem lease ou sem store, não cerca).
+    """
+    if lease is None or _LEASE_STORE is None:
+        yield
+        return
+    with _LEASE_STORE.fencing(lease):
+        yield
+
+
+def format_lease_report(leases: List[Lease]) -> str:
+    now = time.time()
+    out = [f"{'RECURSO':<24} {'DONO':<32} {'TOKEN':>6} {'RESTA(s)':>8}"]
+    for lease in leases:
+        ativo = lease.dono and lease.expira_em > now
+        out.append(f"{lease.recurso:<24} {(lease.dono if ativo else '-'):<32} {lease.token:>6} "
+                   f"{(int(lease.expira_em - now) if ativo else '-'):>8}")
+    return "\n".join(out)
+
+
+def setup_logging(logfile: Optional[str], verbose: bool, stream=None):
     logger = logging.getLogger()
     logger.setLevel(logging.DEBUG if verbose else logging.INFO)
     fmt = logging.Formatter("%(asctime)s | %(levelname)s | %(message)s", "%Y-%m-%d %H:%M:%S")
 
-    ch = logging.StreamHandler(sys.stdout)
+    ch = logging.StreamHandler(stream or sys.stdout)
     ch.setLevel(logging.DEBUG if verbose else logging.INFO)
     ch.setFormatter(fmt)
     logger.handlers.clear()
@@ -93,6 +906,18 @@ def setup_logging(logfile: Optional[str], verbose: bool):
         logger.addHandler(fh)
 
 
+def _load_network() -> None:
+    """
+    Importa a pilha HTTP (requests, requests_pkcs12) na primeira chamada que a usa.
+    """
+    global requests, requests_pkcs12, urllib3
+    if requests_pkcs12 is None:
+        import requests as _requests
+        import requests_pkcs12 as _requests_pkcs12
+        import urllib3 as _urllib3
+        requests, requests_pkcs12, urllib3 = _requests, _requests_pkcs12, _urllib3
+
+
 def ensure_dir(path: str):
     os.makedirs(path, exist_ok=True)
 
@@ -117,6 +942,77 @@ def month_from_arg(mes_emissao: Optional[str], ultimo_mes: bool) -> Optional[Tup
     return None
 
 
+def range_from_args(emissao_de: Optional[str], emissao_ate: Optional[str]) -> Optional[Tuple[date, date]]:
+    """
+    Resolve o filtro por intervalo: retorna (data_ini, data_fim), inclusive, ou None.
+    Só um dos extremos informado deixa o outro em aberto.
+    """
+    if not emissao_de and not emissao_ate:
+        return None
+    try:
+        ini = date.fromisoformat(emissao_de) if emissao_de else date.min
+        fim = date.fromisoformat(emissao_ate) if emissao_ate else date.max
+    except ValueError:
+        raise SystemExit("--emissao-de/--emissao-ate devem estar no formato AAAA-MM-DD (ex.: 2025-11-01)")
+    if ini > fim:
+        raise SystemExit("--emissao-de deve ser anterior ou igual a --emissao-ate")
+    return ini, fim
+
+
+def as_date_range(emission_filter) -> Optional[Tuple[date, date]]:
+    """
+    Normaliza o filtro de emissão: (ano, mes) vira o intervalo do mês inteiro;
+    (data_ini, data_fim) é devolvido como está.
+    """
+    if not emission_filter:
+        return None
+    a, b = emission_filter
+    if isinstance(a, date):
+        return a, b
+    ini = date(a, b, 1)
+    fim = (ini + relativedelta(months=1)) - timedelta(days=1)
+    return ini, fim
+
+
+def filter_key(emission_filter) -> str:
+    """
+    Representação textual do filtro (logs e manifesto): AAAA-MM ou AAAA-MM-DD..AAAA-MM-DD.
+    """
+    if not emission_filter:
+        return ""
+    a, b = emission_filter
+    if isinstance(a, date):
+        return f"{a.isoformat()}..{b.isoformat()}"
+    return f"{a:04d}-{b:02d}"
+
+
+_EMISSAO_RE = re.compile(rb"<(?:[\w.-]+:)?(?:dhEmi|dEmi)>\s*(\d{4})-(\d{2})-(\d{2})")
+
+
+def probe_emission_date(xml_bytes: bytes) -> Optional[date]:
+    """
+    Lê a data de dhEmi/dEmi direto dos bytes, sem montar a árvore XML.
+    Retorna None se não achar (ex.: procEventoNFe) ou se a data for inválida.
+    """
+    m = _EMISSAO_RE.search(xml_bytes)
+    if not m:
+        return None
+    try:
+        return date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+    except ValueError:
+        return None
+
+
+def _parse_datetime(text: str) -> datetime:
+    """
+    Formato ISO fixo (AAAA-MM-DDTHH:MM:SS-03:00) direto; dateutil só como fallback.
+    """
+    try:
+        return datetime.fromisoformat(text.strip())
+    except ValueError:
+        return dtparser.parse(text)
+
+
 def parse_emission_dt(nfe_root: etree._Element) -> Optional[datetime]:
     """
     Busca ide/dhEmi (ou dEmi) e retorna datetime (naive em UTC/local, tanto faz para ano/mês).
@@ -126,7 +1022,7 @@ def parse_emission_dt(nfe_root: etree._Element) -> Optional[datetime]:
     el = nfe_root.find(".//{http://www.portalfiscal.inf.br/nfe}ide/{http://www.portalfiscal.inf.br/nfe}dhEmi")
     if el is not None and el.text:
         try:
-            return dtparser.parse(el.text)
+            return _parse_datetime(el.text)
         except Exception:
             pass
 
@@ -134,7 +1030,7 @@ def parse_emission_dt(nfe_root: etree._Element) -> Optional[datetime]:
     el = nfe_root.find(".//{http://www.portalfiscal.inf.br/nfe}ide/{http://www.portalfiscal.inf.br/nfe}dEmi")
     if el is not None and el.text:
         try:
-            return dtparser.parse(el.text)
+            return _parse_datetime(el.text)
         except Exception:
             pass
 
@@ -150,10 +1046,26 @@ def localname(tag: str) -> str:
     return tag
 
 
+class DocXml(bytes):
+    """
+    XML descompactado que guarda o stream gzip de onde veio (gzip_stream), para a
+    gravação em --armazenamento gz reaproveitá-lo sem recomprimir, e o NSU/schema do
+    docZip, registrados no catálogo. Para todo o resto se comporta como bytes.
+    """
+
+    def __new__(cls, xml_bytes: bytes, gzip_stream: Optional[bytes] = None,
+                nsu: Optional[str] = None, schema: Optional[str] = None):
+        obj = super().__new__(cls, xml_bytes)
+        obj.gzip_stream = gzip_stream
+        obj.nsu = nsu
+        obj.schema = schema
+        return obj
+
+
 def gzip_base64_to_xml(b64_text: str) -> bytes:
     raw = base64.b64decode(b64_text)
     try:
-        return gzip.decompress(raw)
+        return DocXml(gzip.decompress(raw), raw)
     except OSError:
         # Algumas implantações já retornam descompactado; devolve como está
         return raw
@@ -171,62 +1083,787 @@ def extract_chave_e_nnf(nfeproc_root: etree._Element) -> Tuple[Optional[str], Op
     return ch_text, nnf_text
 
 
-def save_nfeproc(xml_bytes: bytes, dest_root: str, cnpj: str, dh_emi: Optional[datetime]) -> Tuple[str, str]:
+class DocMeta(NamedTuple):
     """
-    Salva o nfeProc em DEST/CNPJ/AAAA/MM/nNF.xml (ou CHAVE.xml em conflito).
-    Retorna (dest_dir, filename).
+    Metadados leves de um documento, extraídos numa única passada de parse.
     """
-    root = etree.fromstring(xml_bytes)
-    if localname(root.tag) != "nfeProc":
-        raise ValueError("XML não é nfeProc")
-
-    # Data de emissão para path
-    dt_emi = parse_emission_dt(root) or dh_emi or datetime.now()
-    year = f"{dt_emi.year:04d}"
-    month = f"{dt_emi.month:02d}"
+    tag: str
+    chave: Optional[str]
+    nnf: Optional[str]
+    dh_emi: Optional[datetime]
+    schema: Optional[str] = None
+    # campos do catálogo (só para nfeProc)
+    cnpj_emit: Optional[str] = None
+    cnpj_dest: Optional[str] = None
+    v_nf: Optional[float] = None
+    c_stat: Optional[int] = None
 
-    dest_dir = os.path.join(dest_root, cnpj, year, month)
-    ensure_dir(dest_dir)
 
-    ch, nnf = extract_chave_e_nnf(root)
-    if not nnf:
-        # fallback para chave
-        if not ch:
-            raise ValueError("Não foi possível extrair nNF nem chNFe.")
-        base = f"{ch}.xml"
-    else:
-        base = f"{int(nnf)}.xml" if nnf.isdigit() else f"{nnf}.xml"  # lida com zeros à esquerda
+def decode_local_document(data: bytes) -> bytes:
+    """
+    Devolve o XML de um arquivo local: docZip (base64+gzip) ou XML puro.
+    """
+    if data[:256].lstrip(b"\xef\xbb\xbf \t\r\n")[:1] == b"<":
+        return data
+    try:
+        return gzip_base64_to_xml(data.decode("utf-8"))
+    except Exception:
+        # pode ser xml puro
+        return data
 
-    filename = os.path.join(dest_dir, base)
 
-    if os.path.exists(filename):
-        if ch:
-            filename = os.path.join(dest_dir, f"{ch}.xml")
+def extract_doc_meta(xml_bytes: bytes, schema: Optional[str] = None) -> DocMeta:
+    """
+    Faz o parse do XML uma única vez e extrai tag raiz, chave, nNF e data de emissão.
+    Filtro, nome do arquivo e gravação leem deste registro em vez de reparsear.
+    """
+    root = etree.fromstring(xml_bytes)
+    ch, nnf = extract_chave_e_nnf(root)
+    if not ch:
+        # resNFe / procEventoNFe trazem chNFe fora do protNFe
+        ch_el = root.find(".//{http://www.portalfiscal.inf.br/nfe}chNFe")
+        ch = ch_el.text.strip() if ch_el is not None and ch_el.text else None
+    tag = localname(root.tag)
+    return DocMeta(
+        tag=tag,
+        chave=ch,
+        nnf=nnf,
+        dh_emi=parse_emission_dt(root),
+        schema=schema,
+        **(catalog_fields(root) if tag == "nfeProc" else {}),
+    )
+
+
+def catalog_fields(nfeproc_root) -> dict:
+    """
+    Emitente, destinatário (CNPJ ou CPF), vNF e cStat do protocolo de um nfeProc já
+    parseado (lxml ou ElementTree), por caminho direto a partir da raiz.
+    """
+    nfe = "{http://www.portalfiscal.inf.br/nfe}"
+    inf = f"{nfe}NFe/{nfe}infNFe/"
+
+    def _txt(path: str) -> Optional[str]:
+        el = nfeproc_root.find(path)
+        return el.text.strip() if el is not None and el.text else None
+
+    v_nf = _txt(f"{inf}{nfe}total/{nfe}ICMSTot/{nfe}vNF")
+    c_stat = _txt(f"{nfe}protNFe/{nfe}infProt/{nfe}cStat")
+    return {
+        "cnpj_emit": _txt(f"{inf}{nfe}emit/{nfe}CNPJ") or _txt(f"{inf}{nfe}emit/{nfe}CPF"),
+        "cnpj_dest": _txt(f"{inf}{nfe}dest/{nfe}CNPJ") or _txt(f"{inf}{nfe}dest/{nfe}CPF"),
+        "v_nf": float(v_nf) if v_nf else None,
+        "c_stat": int(c_stat) if c_stat and c_stat.isdigit() else None,
+    }
+
+
+INDEX_FILENAME = ".indice.sqlite"
+
+# Serializa a escolha do nome (nNF.xml / CHAVE.xml / .dup) + gravação quando
+# várias threads gravam ao mesmo tempo (pipeline, agendador). Um lock por pasta
+# CNPJ/AAAA/MM: gravações de CNPJs ou meses diferentes seguem em paralelo.
+_SAVE_LOCKS = {}
+_SAVE_LOCKS_GUARD = threading.Lock()
+
+
+def _save_lock(dest_dir: str) -> threading.Lock:
+    chave = os.path.normpath(os.path.abspath(dest_dir))
+    with _SAVE_LOCKS_GUARD:
+        lock = _SAVE_LOCKS.get(chave)
+        if lock is None:
+            lock = _SAVE_LOCKS[chave] = threading.Lock()
+        return lock
+
+
+class ChaveIndex(_SqliteThreadLocal):
+    """
+    Índice em disco chave de acesso (44 dígitos) → (caminho salvo, sha256 do conteúdo).
+    Fica em DEST/.indice.sqlite; os caminhos são relativos a DEST. A consulta é uma
+    busca por chave primária, independente de quantos arquivos existem na árvore.
+
+    Na mesma base fica o catálogo (tabela catalogo): emitente, destinatário, vNF,
+    dhEmi, cStat, NSU e schema de cada nfeProc gravado, preenchido na ingestão a
+    partir do parse que já é feito, para consultas sem reler a árvore (ver consultar).
+    """
+
+    CATALOG_COLUMNS = ("chave", "cnpj", "nnf", "dh_emi", "data_emi", "cnpj_emit", "cnpj_dest",
+                       "v_nf", "c_stat", "nsu", "schema")
+
+    def __init__(self, dest_root: str):
+        super().__init__(os.path.join(dest_root, INDEX_FILENAME))
+        self.root = dest_root
+        self._conn().execute("""
+            CREATE TABLE IF NOT EXISTS chaves (
+                chave TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                sha256 TEXT NOT NULL,
+                updated_at REAL
+            )""")
+        self._conn().executescript("""
+            CREATE TABLE IF NOT EXISTS catalogo (
+                chave TEXT PRIMARY KEY,
+                cnpj TEXT,
+                nnf TEXT,
+                dh_emi TEXT,
+                data_emi TEXT,
+                cnpj_emit TEXT,
+                cnpj_dest TEXT,
+                v_nf REAL,
+                c_stat INTEGER,
+                nsu TEXT,
+                schema TEXT
+            );
+            CREATE INDEX IF NOT EXISTS catalogo_emit ON catalogo (cnpj_emit, data_emi);
+            CREATE INDEX IF NOT EXISTS catalogo_dest ON catalogo (cnpj_dest, data_emi);
+            CREATE INDEX IF NOT EXISTS catalogo_data ON catalogo (data_emi);
+            """)
+
+    def get(self, chave: str) -> Optional[Tuple[str, str]]:
+        """
+        Retorna (caminho absoluto, sha256) do documento já salvo, ou None.
+        """
+        row = self._conn().execute("SELECT path, sha256 FROM chaves WHERE chave = ?", (chave,)).fetchone()
+        if row is None:
+            return None
+        return os.path.join(self.root, row["path"]), row["sha256"]
+
+    def put(self, chave: str, path: str, data: bytes,
+            meta: Optional[DocMeta] = None, nsu: Optional[str] = None) -> None:
+        """
+        Registra o documento salvo em path; com meta, também no catálogo.
+        """
+        rel = os.path.relpath(path, self.root)
+        self._conn().execute(
+            "INSERT OR REPLACE INTO chaves (chave, path, sha256, updated_at) VALUES (?, ?, ?, ?)",
+            (chave, rel, hashlib.sha256(data).hexdigest(), time.time()))
+        if meta is not None:
+            self.catalogar(chave, rel.split(os.sep, 1)[0], meta, nsu)
+
+    def catalogar(self, chave: str, cnpj: str, meta: DocMeta, nsu: Optional[str] = None) -> None:
+        dh = meta.dh_emi
+        self._conn().execute(
+            f"INSERT OR REPLACE INTO catalogo ({', '.join(self.CATALOG_COLUMNS)}) "
+            f"VALUES ({', '.join('?' * len(self.CATALOG_COLUMNS))})",
+            (chave, cnpj, meta.nnf, dh.isoformat() if dh else None, dh.date().isoformat() if dh else None,
+             meta.cnpj_emit, meta.cnpj_dest, meta.v_nf, meta.c_stat, nsu, meta.schema))
+
+    def consultar(self, cnpj: Optional[str] = None,
+                  emitente: Optional[str] = None,
+                  destinatario: Optional[str] = None,
+                  emissao: Optional[Tuple[date, date]] = None,
+                  valor_min: Optional[float] = None,
+                  valor_max: Optional[float] = None,
+                  chave: Optional[str] = None,
+                  limite: Optional[int] = None) -> List[dict]:
+        """
+        nfeProc do catálogo que atendem a todos os filtros informados, ordenados por
+        dhEmi. emissao: intervalo (data_ini, data_fim) inclusivo (ver as_date_range).
+        Cada item traz as colunas do catálogo e o caminho absoluto salvo (path).
+        """
+        where, params = [], []
+        for coluna, valor in (("c.cnpj", cnpj), ("c.cnpj_emit", emitente),
+                              ("c.cnpj_dest", destinatario), ("c.chave", chave)):
+            if valor:
+                where.append(f"{coluna} = ?")
+                params.append(valor)
+        if emissao:
+            where.append("c.data_emi BETWEEN ? AND ?")
+            params += [emissao[0].isoformat(), emissao[1].isoformat()]
+        if valor_min is not None:
+            where.append("c.v_nf >= ?")
+            params.append(valor_min)
+        if valor_max is not None:
+            where.append("c.v_nf <= ?")
+            params.append(valor_max)
+        sql = "SELECT c.*, k.path FROM catalogo c JOIN chaves k ON k.chave = c.chave"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY c.dh_emi, c.chave"
+        if limite:
+            sql += f" LIMIT {int(limite)}"
+        rows = []
+        for row in self._conn().execute(sql, params):
+            item = dict(row)
+            item["path"] = os.path.join(self.root, item["path"])
+            rows.append(item)
+        return rows
+
+    def _catalogado(self, chave: str) -> bool:
+        return self._conn().execute("SELECT 1 FROM catalogo WHERE chave = ?", (chave,)).fetchone() is not None
+
+    def _reindexar(self, path: str, data: bytes, meta: DocMeta) -> bool:
+        """
+        rebuild de um documento: indexa se a chave é nova; completa só o catálogo se a
+        chave já aponta para este mesmo caminho (índices anteriores ao catálogo).
+        """
+        known = self.get(meta.chave)
+        if known is None:
+            self.put(meta.chave, path, data, meta)
+            return True
+        if known[0] == path and not self._catalogado(meta.chave):
+            self.catalogar(meta.chave, os.path.relpath(path, self.root).split(os.sep, 1)[0], meta)
+        return False
+
+    def rebuild(self) -> int:
+        """
+        Indexa (e cataloga) os nfeProc já existentes na árvore DEST/CNPJ/AAAA/MM.
+        Retorna quantos foram indexados.
+        """
+        n = 0
+        for path in _list_scan_files(self.root):
+            if not path.endswith((".xml", ".dup")) and not path.endswith(tuple(COMPRESSED_SUFFIXES.values())):
+                continue
+            try:
+                data = read_saved_document(path)
+                meta = extract_doc_meta(data)
+            except Exception as e:
+                logging.warning(f"Índice: ignorando {path}: {e}")
+                continue
+            if meta.tag == "nfeProc" and meta.chave and self._reindexar(path, data, meta):
+                n += 1
+        # documentos guardados em pacotes (--armazenamento pacote)
+        for path, entrada in _PACKS.iter_documents(self.root):
+            if not entrada.get("chave"):
+                continue
+            try:
+                data = _PACKS.read(path)
+                meta = extract_doc_meta(data)
+            except Exception as e:
+                logging.warning(f"Índice: ignorando {path} ({_PACKS.pack_path(os.path.dirname(path))}, "
+                                f"offset {entrada.get('offset')}): {e}")
+                continue
+            if meta.tag == "nfeProc" and meta.chave and self._reindexar(path, data, meta):
+                n += 1
+        return n
+
+
+# ========= Armazenamento em pacotes =========
+
+PACK_SUFFIX = ".pack"
+PACK_INDEX_SUFFIX = ".idx"
+STORAGE_MODES = ("arquivos", "pacote", "gz", "zst")
+# sufixo acrescentado ao nome (nNF.xml → nNF.xml.gz) nos modos compactados
+COMPRESSED_SUFFIXES = {"gz": ".gz", "zst": ".zst"}
+
+# zstd é opcional: compression.zstd (Python 3.14+) ou o pacote zstandard, importados sob demanda
+_zstd_compress = None
+_zstd_decompress = None
+
+
+def _load_zstd() -> None:
+    global _zstd_compress, _zstd_decompress
+    if _zstd_compress is not None:
+        return
+    try:
+        from compression import zstd as _zstd
+        _zstd_compress, _zstd_decompress = _zstd.compress, _zstd.decompress
+    except ImportError:
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("--armazenamento zst requer Python 3.14+ ou o pacote zstandard (pip install zstandard)")
+        _zstd_compress = zstandard.ZstdCompressor(level=10).compress
+        _zstd_decompress = zstandard.ZstdDecompressor().decompress
+
+
+def compress_document(xml_bytes: bytes, mode: str) -> bytes:
+    """
+    Conteúdo a gravar para o modo de armazenamento. Em "gz", um DocXml vindo de um
+    docZip grava o stream gzip original (já compactado pela SEFAZ) tal como veio.
+    """
+    if mode == "gz":
+        stream = getattr(xml_bytes, "gzip_stream", None)
+        return stream if stream is not None else gzip.compress(xml_bytes, compresslevel=6, mtime=0)
+    if mode == "zst":
+        _load_zstd()
+        return _zstd_compress(bytes(xml_bytes))
+    return xml_bytes
+
+
+def decompress_document(path: str, data: bytes) -> bytes:
+    """
+    XML de um arquivo salvo, descompactado conforme a extensão (.gz, .zst ou XML puro).
+    """
+    if path.endswith(".gz"):
+        return gzip.decompress(data)
+    if path.endswith(".zst"):
+        _load_zstd()
+        return _zstd_decompress(data)
+    return data
+
+
+def _stored_path(path: str) -> str:
+    """
+    Caminho em disco de um documento no modo de armazenamento atual (nNF.xml → nNF.xml.gz).
+    """
+    return path + COMPRESSED_SUFFIXES.get(_STORAGE_MODE, "")
+
+
+class PackStore:
+    """
+    Armazenamento em pacotes: em vez de um arquivo por documento em DEST/CNPJ/AAAA/MM/,
+    um arquivo append-only por CNPJ/mês (DEST/CNPJ/AAAA/MM.pack) com um membro gzip por
+    documento — o pacote inteiro também é um .gz válido — e um índice JSON lines ao lado
+    (MM.idx: nome, chave, nNF, offset, tamanho, sha256). Um nome repetido no índice
+    substitui o anterior (vale a última linha), como a sobrescrita no layout de pastas.
+
+    Os documentos são endereçados pelo caminho que teriam no layout de pastas
+    (DEST/CNPJ/AAAA/MM/nome): é o que vai para o ChaveIndex e o que export recria.
+    Leituras usam mmap do pacote. Uma gravação interrompida deixa no máximo um final
+    incompleto, descartado (truncado) na próxima abertura do pacote.
+
+    Vários processos podem gravar no mesmo DEST (ex.: --scan-dir no cron ao lado de um
+    --serve): cada gravação e cada reparo acontecem sob fcntl.flock exclusivo no índice,
+    relendo antes as linhas que outros processos acrescentaram; o offset de gravação é o
+    tamanho real do pacote, e o pacote recebe fsync antes da linha do índice, que é a
+    referência da recuperação.
+    """
+
+    def __init__(self, max_abertos: int = 32):
+        self.max_abertos = max_abertos
+        self._lock = threading.RLock()
+        # pacote -> {"nomes": {nome: entrada}, "fim": fim indexado, "idx_pos": bytes do índice já lidos}
+        self._packs = {}
+        self._handles = OrderedDict()    # pacote -> (arquivo do pacote, arquivo do índice)
+        self._maps = {}                  # pacote -> mmap
+
+    @staticmethod
+    def pack_path(pasta: str) -> str:
+        return pasta.rstrip("\\/") + PACK_SUFFIX
+
+    @staticmethod
+    def _index_path(pack: str) -> str:
+        return pack[: -len(PACK_SUFFIX)] + PACK_INDEX_SUFFIX
+
+    @contextmanager
+    def _travar(self, pack: str):
+        """
+        Lock exclusivo entre processos (fcntl.flock no índice) durante leitura do índice,
+        reparo e gravação.
+        """
+        ensure_dir(os.path.dirname(pack))
+        with open(self._index_path(pack), "ab") as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _sincronizar(self, pack: str, st: dict, reparar: bool) -> None:
+        """
+        Acrescenta a st as linhas do índice gravadas desde a última leitura (inclusive
+        por outros processos). Com reparar (só sob _travar), trunca a linha incompleta
+        do índice e os bytes do pacote sem índice deixados por uma gravação interrompida.
+        """
+        idx = self._index_path(pack)
+        try:
+            with open(idx, "rb") as f:
+                f.seek(st["idx_pos"])
+                raw = f.read()
+        except FileNotFoundError:
+            raw = b""
+        valido = raw[: raw.rfind(b"\n") + 1]
+        for linha in valido.splitlines():
+            try:
+                entrada = json.loads(linha)
+                nome, fim = entrada["nome"], entrada["offset"] + entrada["tamanho"]
+            except (ValueError, KeyError, TypeError) as e:
+                logging.warning(f"Pacote {idx}: ignorando linha inválida do índice ({e!r})")
+                continue
+            st["nomes"][nome] = entrada
+            st["fim"] = max(st["fim"], fim)
+        st["idx_pos"] += len(valido)
+        if not reparar:
+            return
+        if len(valido) != len(raw):
+            logging.warning(f"Pacote {idx}: descartando linha incompleta do índice")
+            with open(idx, "r+b") as f:
+                f.truncate(st["idx_pos"])
+        if os.path.exists(pack) and os.path.getsize(pack) > st["fim"]:
+            logging.warning(f"Pacote {pack}: descartando {os.path.getsize(pack) - st['fim']} byte(s) sem índice")
+            with open(pack, "r+b") as f:
+                f.truncate(st["fim"])
+
+    def _load(self, pack: str) -> dict:
+        st = self._packs.get(pack)
+        if st is not None:
+            return st
+        st = {"nomes": {}, "fim": 0, "idx_pos": 0}
+        if os.path.exists(pack) or os.path.exists(self._index_path(pack)):
+            with self._travar(pack):
+                self._sincronizar(pack, st, reparar=True)
+        self._packs[pack] = st
+        return st
+
+    def _open(self, pack: str):
+        h = self._handles.get(pack)
+        if h is not None:
+            self._handles.move_to_end(pack)
+            return h
+        ensure_dir(os.path.dirname(pack))
+        h = (open(pack, "ab"), open(self._index_path(pack), "ab"))
+        self._handles[pack] = h
+        while len(self._handles) > self.max_abertos:
+            _, (fp, fi) = self._handles.popitem(last=False)
+            fp.close()
+            fi.close()
+        return h
+
+    def put(self, pasta: str, nomes: List[str], data: bytes,
+            chave: Optional[str] = None, nnf: Optional[str] = None) -> Tuple[str, bool]:
+        """
+        Grava data no pacote de pasta (DEST/CNPJ/AAAA/MM) com o primeiro nome livre de
+        nomes (o último substitui, se todos estiverem ocupados). Se um desses nomes já
+        tiver exatamente este conteúdo, nada é gravado.
+        Retorna (caminho lógico, gravado).
+        """
+        sha = hashlib.sha256(data).hexdigest()
+        pack = self.pack_path(pasta)
+        # DocXml vindo de docZip: o próprio stream gzip da SEFAZ vira o membro
+        membro = compress_document(data, "gz")
+        with self._lock:
+            st = self._load(pack)
+            with self._travar(pack):
+                # outro processo pode ter gravado desde a última leitura do índice
+                self._sincronizar(pack, st, reparar=True)
+                escolhido = nomes[-1]
+                for nome in nomes:
+                    atual = st["nomes"].get(nome)
+                    if atual is None:
+                        escolhido = nome
+                        break
+                    if atual["sha256"] == sha:
+                        return os.path.join(pasta, nome), False
+
+                fp, fi = self._open(pack)
+                offset = os.fstat(fp.fileno()).st_size
+                entrada = {"nome": escolhido, "chave": chave or "", "nnf": nnf or "",
+                           "offset": offset, "tamanho": len(membro), "sha256": sha}
+                linha = (json.dumps(entrada) + "\n").encode("utf-8")
+                # dados (com fsync) antes do índice: sem a linha do índice, o membro é descartado
+                fp.write(membro)
+                fp.flush()
+                os.fsync(fp.fileno())
+                fi.write(linha)
+                fi.flush()
+                st["fim"] = offset + len(membro)
+                st["idx_pos"] += len(linha)
+                st["nomes"][escolhido] = entrada
+        return os.path.join(pasta, escolhido), True
+
+    def entry(self, path: str) -> Optional[dict]:
+        pack = self.pack_path(os.path.dirname(path))
+        nome = os.path.basename(path)
+        with self._lock:
+            st = self._load(pack)
+            if nome not in st["nomes"]:
+                # pode ter sido gravado por outro processo
+                self._sincronizar(pack, st, reparar=False)
+            return st["nomes"].get(nome)
+
+    def exists(self, path: str) -> bool:
+        return os.path.exists(self.pack_path(os.path.dirname(path))) and self.entry(path) is not None
+
+    def read(self, path: str) -> bytes:
+        """
+        Conteúdo do documento pelo caminho lógico DEST/CNPJ/AAAA/MM/nome.
+        """
+        pack = self.pack_path(os.path.dirname(path))
+        with self._lock:
+            entrada = self.entry(path) if os.path.exists(pack) else None
+            if entrada is None:
+                raise FileNotFoundError(path)
+            fim = entrada["offset"] + entrada["tamanho"]
+            mm = self._maps.get(pack)
+            if mm is None or len(mm) < fim:
+                if mm is not None:
+                    mm.close()
+                with open(pack, "rb") as f:
+                    mm = self._maps[pack] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            membro = mm[entrada["offset"]:fim]
+        return gzip.decompress(membro)
+
+    def iter_documents(self, root: str) -> Iterator[Tuple[str, dict]]:
+        """
+        (caminho lógico, entrada do índice) de todos os documentos dos pacotes sob root.
+        """
+        for path in _list_scan_files(root):
+            if not path.endswith(PACK_SUFFIX):
+                continue
+            pasta = path[: -len(PACK_SUFFIX)]
+            with self._lock:
+                st = self._load(path)
+                self._sincronizar(path, st, reparar=False)
+                nomes = dict(st["nomes"])
+            for nome in sorted(nomes):
+                yield os.path.join(pasta, nome), nomes[nome]
+
+    def export(self, root: str, out_dir: str) -> int:
+        """
+        Desempacota os pacotes sob root para out_dir no layout de pastas
+        (out_dir/CNPJ/AAAA/MM/nome). Retorna quantos documentos foram gravados.
+        """
+        n = 0
+        for path, _ in self.iter_documents(root):
+            alvo = os.path.join(out_dir, os.path.relpath(path, root))
+            ensure_dir(os.path.dirname(alvo))
+            with open(alvo, "wb") as f:
+                f.write(self.read(path))
+            n += 1
+        return n
+
+    def close(self) -> None:
+        with self._lock:
+            for fp, fi in self._handles.values():
+                fp.close()
+                fi.close()
+            self._handles.clear()
+            for mm in self._maps.values():
+                mm.close()
+            self._maps.clear()
+
+
+_PACKS = PackStore()
+_STORAGE_MODE = "arquivos"
+
+
+def set_storage_mode(mode: str) -> None:
+    """
+    Modo de gravação dos nfeProc: "arquivos" (um arquivo por documento), "pacote" (PackStore)
+    ou "gz"/"zst" (um arquivo compactado por documento, nNF.xml.gz / nNF.xml.zst).
+    """
+    global _STORAGE_MODE
+    if mode not in STORAGE_MODES:
+        raise ValueError(f"Modo de armazenamento inválido: {mode}")
+    if mode == "zst":
+        _load_zstd()
+    _STORAGE_MODE = mode
+
+
+def read_saved_document(path: str) -> bytes:
+    """
+    Lê um documento salvo pelo caminho (o do ChaveIndex ou do layout de pastas),
+    esteja ele num arquivo próprio, compactado (path.gz/path.zst) ou num pacote.
+    Devolve sempre o XML descompactado.
+    """
+    for candidato in (path,) + tuple(path + suf for suf in COMPRESSED_SUFFIXES.values()):
+        if os.path.isfile(candidato):
+            with open(candidato, "rb") as f:
+                return decompress_document(candidato, f.read())
+    return _PACKS.read(path)
+
+
+def save_nfeproc(xml_bytes: bytes, dest_root: str, cnpj: str, dh_emi: Optional[datetime],
+                 meta: Optional[DocMeta] = None,
+                 index: Optional[ChaveIndex] = None) -> Tuple[str, str]:
+    """
+    Salva o nfeProc em DEST/CNPJ/AAAA/MM/nNF.xml (ou CHAVE.xml em conflito).
+    Se meta for informado, não reparseia o XML. Com index, uma chave já
+    indexada não é gravada de novo (retorna o local existente) e cada
+    gravação nova é registrada no índice.
+    Retorna (dest_dir, filename).
+    """
+    if meta is None:
+        meta = extract_doc_meta(xml_bytes)
+    if meta.tag != "nfeProc":
+        raise ValueError("XML não é nfeProc")
+
+    if index is not None and meta.chave:
+        known = index.get(meta.chave)
+        if known:
+            return os.path.dirname(known[0]), os.path.basename(known[0])
+
+    # Data de emissão para path
+    dt_emi = meta.dh_emi or dh_emi or datetime.now()
+    year = f"{dt_emi.year:04d}"
+    month = f"{dt_emi.month:02d}"
+
+    dest_dir = os.path.join(dest_root, cnpj, year, month)
+
+    ch, nnf = meta.chave, meta.nnf
+    if not nnf:
+        # fallback para chave
+        if not ch:
+            raise ValueError("Não foi possível extrair nNF nem chNFe.")
+        base = f"{ch}.xml"
+    else:
+        base = f"{int(nnf)}.xml" if nnf.isdigit() else f"{nnf}.xml"  # lida com zeros à esquerda
+
+    filename = os.path.join(dest_dir, base)
+
+    with _save_lock(dest_dir):
+        # outro job/thread pode ter gravado a mesma chave desde a consulta acima
+        if index is not None and ch:
+            known = index.get(ch)
+            if known:
+                return os.path.dirname(known[0]), os.path.basename(known[0])
+
+        if _STORAGE_MODE == "pacote":
+            # mesma regra de nomes (nNF.xml, depois CHAVE.xml ou .dup), dentro do pacote do mês
+            filename, _ = _PACKS.put(dest_dir, [base, f"{ch}.xml" if ch else f"{base}.dup"],
+                                     xml_bytes, ch, nnf)
         else:
-            # último recurso: sufixo
-            filename = os.path.join(dest_dir, f"{base}.dup")
+            ensure_dir(dest_dir)
+            filename = _stored_path(filename)
+            if os.path.exists(filename):
+                if ch:
+                    filename = _stored_path(os.path.join(dest_dir, f"{ch}.xml"))
+                else:
+                    # último recurso: sufixo
+                    filename = _stored_path(os.path.join(dest_dir, f"{base}.dup"))
 
-    with open(filename, "wb") as f:
-        f.write(xml_bytes)
+            with open(filename, "wb") as f:
+                f.write(compress_document(xml_bytes, _STORAGE_MODE))
+        if index is not None and ch:
+            index.put(ch, filename, xml_bytes, meta, getattr(xml_bytes, "nsu", None))
 
     return dest_dir, os.path.basename(filename)
 
 
-def matches_month_filter(xml_bytes: bytes, month_filter: Optional[Tuple[int, int]]) -> bool:
-    if not month_filter:
+def matches_month_filter(xml_bytes: bytes, month_filter,
+                         meta: Optional[DocMeta] = None) -> bool:
+    """
+    month_filter: (ano, mes) ou intervalo (data_ini, data_fim), inclusive.
+    """
+    date_range = as_date_range(month_filter)
+    if not date_range:
         return True
-    y, m = month_filter
+    ini, fim = date_range
     try:
-        root = etree.fromstring(xml_bytes)
+        if meta is None:
+            meta = extract_doc_meta(xml_bytes)
         # Tenta pegar data de emissão do próprio nfeProc
-        dt = parse_emission_dt(root)
+        dt = meta.dh_emi
         if dt:
-            return (dt.year == y and dt.month == m)
+            return ini <= dt.date() <= fim
     except Exception:
         pass
     return False
 
 
+# ========= Métricas =========
+
+class Metrics:
+    """
+    Contadores e histogramas de latência por etapa (http, decode, parse, filtro,
+    gravacao, leitura) e por CNPJ, exportados em texto Prometheus ou JSON.
+    O CNPJ vem do argumento ou do contexto da thread (ver Metrics.cnpj), para que
+    etapas internas como o decode dos docZip não precisem recebê-lo.
+    """
+
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._hist = {}       # (etapa, cnpj) -> [contagens por bucket..., +Inf, soma]
+        self._counters = {}   # (nome, (("rotulo", valor), ...)) -> valor
+
+    @contextmanager
+    def cnpj(self, cnpj: str):
+        anterior = getattr(self._local, "cnpj", "")
+        self._local.cnpj = cnpj
+        try:
+            yield
+        finally:
+            self._local.cnpj = anterior
+
+    def _cnpj(self, cnpj: Optional[str]) -> str:
+        return cnpj if cnpj is not None else getattr(self._local, "cnpj", "")
+
+    def observe(self, etapa: str, segundos: float, cnpj: Optional[str] = None) -> None:
+        key = (etapa, self._cnpj(cnpj))
+        with self._lock:
+            h = self._hist.get(key)
+            if h is None:
+                h = self._hist[key] = [0] * (len(self.BUCKETS) + 2)
+            for i, limite in enumerate(self.BUCKETS):
+                if segundos <= limite:
+                    h[i] += 1
+                    break
+            else:
+                h[len(self.BUCKETS)] += 1
+            h[-1] += segundos
+
+    @contextmanager
+    def timer(self, etapa: str, cnpj: Optional[str] = None):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(etapa, time.perf_counter() - t0, cnpj)
+
+    def inc(self, nome: str, n: int = 1, cnpj: Optional[str] = None, **rotulos) -> None:
+        key = (nome, (("cnpj", self._cnpj(cnpj)),) + tuple(sorted((k, str(v)) for k, v in rotulos.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + n
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            hist = {k: list(v) for k, v in self._hist.items()}
+            counters = dict(self._counters)
+        etapas = []
+        for (etapa, cnpj), h in sorted(hist.items()):
+            n = sum(h[:-1])
+            etapas.append({
+                "etapa": etapa, "cnpj": cnpj, "n": n, "soma_s": round(h[-1], 6),
+                "media_ms": round(h[-1] / n * 1000, 3) if n else None,
+                "buckets": {str(b): c for b, c in zip(self.BUCKETS + ("+Inf",), h[:-1])},
+            })
+        contadores = [{"nome": nome, **dict(rotulos), "valor": v}
+                      for (nome, rotulos), v in sorted(counters.items())]
+        return {"gerado_em": datetime.now(timezone.utc).isoformat(), "etapas": etapas, "contadores": contadores}
+
+    def prometheus(self) -> str:
+        with self._lock:
+            hist = {k: list(v) for k, v in self._hist.items()}
+            counters = dict(self._counters)
+        linhas = ["# HELP sefaz_etapa_segundos Latência por etapa do download/processamento.",
+                  "# TYPE sefaz_etapa_segundos histogram"]
+        for (etapa, cnpj), h in sorted(hist.items()):
+            rotulos = f'etapa="{etapa}",cnpj="{cnpj}"'
+            acumulado = 0
+            for limite, c in zip(self.BUCKETS + ("+Inf",), h[:-1]):
+                acumulado += c
+                linhas.append(f'sefaz_etapa_segundos_bucket{{{rotulos},le="{limite}"}} {acumulado}')
+            linhas.append(f"sefaz_etapa_segundos_sum{{{rotulos}}} {h[-1]:.6f}")
+            linhas.append(f"sefaz_etapa_segundos_count{{{rotulos}}} {acumulado}")
+        nomes = sorted({nome for nome, _ in counters})
+        for nome in nomes:
+            linhas.append(f"# TYPE sefaz_{nome}_total counter")
+            for (n, rotulos), v in sorted(counters.items()):
+                if n == nome:
+                    lbl = ",".join(f'{k}="{val}"' for k, val in rotulos)
+                    linhas.append(f"sefaz_{nome}_total{{{lbl}}} {v}")
+        return "\n".join(linhas) + "\n"
+
+    def write(self, path: str) -> None:
+        """
+        Grava as métricas em path: JSON se terminar em .json, senão texto Prometheus
+        (formato do textfile collector do node_exporter).
+        """
+        if path.endswith(".json"):
+            _atomic_write_json(path, self.snapshot())
+        else:
+            _atomic_write_text(path, self.prometheus())
+
+    def summary(self) -> str:
+        """
+        Uma linha por etapa (todos os CNPJs somados) para o log do fim da execução.
+        """
+        totais = {}
+        with self._lock:
+            for (etapa, _), h in self._hist.items():
+                n, soma = totais.get(etapa, (0, 0.0))
+                totais[etapa] = (n + sum(h[:-1]), soma + h[-1])
+        return " | ".join(f"{etapa}: n={n} total={soma:.2f}s méd={soma / n * 1000:.2f}ms"
+                          for etapa, (n, soma) in sorted(totais.items()) if n)
+
+
+_METRICS = Metrics()
+
+
 # ========= SOAP: NFeDistribuicaoDFe =========
 
 def build_envelope(cnpj: str, uf: str, ambiente: str, nsu: str = "000000000000000") -> bytes:
@@ -253,8 +1890,37 @@ def build_envelope(cnpj: str, uf: str, ambiente: str, nsu: str = "00000000000000
     return envelope.encode("utf-8")
 
 
+def build_envelope_dist_nsu(cnpj: str, uf: str, ambiente: str, ult_nsu: str = "000000000000000") -> bytes:
+    """
+    Monta o envelope com <distNSU><ultNSU>: a SEFAZ devolve os documentos
+    posteriores ao ultNSU informado (NT 2014.002). build_envelope usa consNSU,
+    que consulta um NSU específico.
+    """
+    cuf_autor = UF_CODE_MAP.get(uf.upper(), 35)
+    tp_amb_str = "1" if ambiente.lower().startswith("prod") else "2"
+    ult_nsu15 = (ult_nsu or "0").rjust(15, "0")
+
+    envelope = f"""<?xml version="1.0" encoding="utf-8"?>
+<soap12:Envelope xmlns:soap12="http://www.w3.org/2003/05/soap-envelope"
+                 xmlns:nfe="http://www.portalfiscal.inf.br/nfe/wsdl/NFeDistribuicaoDFe">
+  <soap12:Body>
+    <nfe:nfeDistDFeInteresse>
+      <nfe:nfeDadosMsg>
+        <distDFeInt xmlns="http://www.portalfiscal.inf.br/nfe" versao="1.01">
+          <tpAmb>{tp_amb_str}</tpAmb>
+          <cUFAutor>{cuf_autor}</cUFAutor>
+          <CNPJ>{cnpj}</CNPJ>
+          <distNSU><ultNSU>{ult_nsu15}</ultNSU></distNSU>
+        </distDFeInt>
+      </nfe:nfeDadosMsg>
+    </nfe:nfeDistDFeInteresse>
+  </soap12:Body>
+</soap12:Envelope>"""
+    return envelope.encode("utf-8")
+
+
 def call_distdfe(
-    session: requests.Session,
+    session: "requests.Session",
     url: str,
     envelope_xml: bytes,
     timeout: int = 60,
@@ -264,6 +1930,7 @@ def call_distdfe(
     Chama o serviço nfeDistDFeInteresse e retorna a raiz SOAP como Element.
     Loga SOAP Fault (500) e responde com raise contendo mais contexto.
     """
+    _load_network()
     headers = {
         "Content-Type": "application/soap+xml; charset=utf-8",
         "Connection": "keep-alive",
@@ -329,12 +1996,6 @@ def iter_doczip_from_response(soap_root: etree._Element) -> Tuple[str, str, List
 
     return cStat, xMotivo, doczips, ultNSU, maxNSU
 
-import xml.etree.ElementTree as ET
-import base64
-import gzip
-from io import BytesIO
-import logging
-from typing import List, Tuple, Optional, Union
 
 def _strip_ns(tag: str) -> str:
     """Remove namespace de uma tag XML (ex: '{…}cStat' → 'cStat')."""
@@ -352,51 +2013,130 @@ def _find_text(root: ET.Element, path: str, nsmap: dict, required: bool = True)
         return None
     return elem.text.strip() if elem.text is not None else ''
 
+class RespostaDistDFe(NamedTuple):
+    """
+    Cabeçalho de um retDistDFeInt já lido e iterador preguiçoso dos documentos do lote.
+    docs produz (NSU, schema, raw_xml_bytes), um docZip por vez.
+    """
+    cstat: int
+    xmotivo: str
+    ult_nsu: str
+    max_nsu: Optional[str]
+    docs: Iterator[Tuple[str, str, bytes]]
+
+
+def _decode_doczip(nsu: Optional[str], schema: Optional[str], raw_b64: str) -> Optional[bytes]:
+    """
+    Decodifica o conteúdo de um docZip (base64 + gzip). Retorna None se o base64 for inválido.
+    """
+    try:
+        compressed = base64.b64decode(raw_b64)
+    except Exception as e:
+        logging.error(f"Falha no base64 do NSU={nsu} schema={schema}: {e}")
+        return None
+    try:
+        buf = BytesIO(compressed)
+        with gzip.GzipFile(fileobj=buf) as gz:
+            xml_raw = DocXml(gz.read(), compressed, nsu, schema)
+        logging.debug(f"Descompactado gzip NSU={nsu} (schema={schema}), tamanho={len(xml_raw)} bytes")
+    except OSError:
+        # Se não for gzip
+        xml_raw = DocXml(compressed, None, nsu, schema)
+        logging.debug(f"Não era gzip (NSU={nsu}), usando raw direto, tamanho={len(xml_raw)} bytes")
+    return xml_raw
+
+
+def _iter_lote_doczips(context,
+                       accept_schema: Optional[Callable[[Optional[str]], bool]] = None,
+                       on_doczip: Optional[Callable[[Optional[str], bool], None]] = None
+                       ) -> Iterator[Tuple[str, str, bytes]]:
+    """
+    Continua o iterparse da resposta produzindo cada docZip decodificado,
+    liberando os elementos já consumidos. docZip cujo schema é recusado por
+    accept_schema é descartado sem base64/gunzip.
+    on_doczip(nsu, descartado) é chamado para todo docZip lido, inclusive os descartados
+    e os que não decodificam.
+    """
+    for event, el in context:
+        if event != "end" or localname(el.tag) != "docZip":
+            continue
+        nsu = el.get("NSU")
+        schema = el.get("schema")
+        raw_b64 = el.text.strip() if el.text else ""
+        # libera o docZip e os irmãos anteriores antes de decodificar
+        el.clear()
+        while el.getprevious() is not None:
+            del el.getparent()[0]
+        logging.debug(f"docZip encontrado → NSU={nsu}, schema={schema}, tamanho(base64)={len(raw_b64)}")
+        descartar = accept_schema is not None and not accept_schema(schema)
+        if on_doczip is not None:
+            on_doczip(nsu, descartar)
+        if descartar:
+            logging.debug(f"Descartando docZip NSU={nsu} (schema={schema}) sem decodificar")
+            continue
+        with _METRICS.timer("decode"):
+            xml_raw = _decode_doczip(nsu, schema, raw_b64)
+        if xml_raw is not None:
+            yield nsu, schema, xml_raw
+
+
+def read_distdfe_response(source: Union[bytes, str, IO[bytes]],
+                          accept_schema: Optional[Callable[[Optional[str]], bool]] = None,
+                          on_doczip: Optional[Callable[[Optional[str], bool], None]] = None) -> RespostaDistDFe:
+    """
+    Lê uma resposta do NFeDistribuicaoDFe de forma incremental (iterparse).
+    source pode ser o corpo em bytes, o caminho de um dump salvo ou um arquivo/stream
+    (ex.: resp.raw). O cabeçalho (cStat, xMotivo, ultNSU, maxNSU) é lido na hora,
+    e os docZip só são decodificados conforme RespostaDistDFe.docs é consumido.
+    accept_schema (opcional) filtra pelo atributo schema antes de decodificar;
+    on_doczip (opcional) é avisado de cada docZip lido (ver _iter_lote_doczips).
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = BytesIO(source)
+    context = etree.iterparse(source, events=("start", "end"), huge_tree=True)
+
+    campos = {}
+    for event, el in context:
+        name = localname(el.tag)
+        if event == "start":
+            if name == "loteDistDFeInt":
+                break
+            continue
+        if name == "Fault":
+            fault_str = etree.tostring(el, encoding="unicode")
+            raise RuntimeError(f"SOAP Fault recebido:\n{fault_str}")
+        if name in ("cStat", "xMotivo", "ultNSU", "maxNSU") and name not in campos:
+            campos[name] = el.text.strip() if el.text is not None else ""
+        elif name == "retDistDFeInt":
+            break
+
+    if "cStat" not in campos:
+        logging.error("Elemento obrigatório 'cStat' não encontrado no XML.")
+        raise ValueError("Elemento obrigatório 'cStat' não encontrado.")
+
+    cstat = int(campos["cStat"])
+    ult_nsu = campos.get("ultNSU") or ""
+    max_nsu = campos.get("maxNSU")
+    logging.debug(f"read_distdfe_response → cStat={cstat}, ultNSU={ult_nsu}, maxNSU={max_nsu}")
+    return RespostaDistDFe(cstat, campos.get("xMotivo", ""), ult_nsu, max_nsu, _iter_lote_doczips(context, accept_schema, on_doczip))
+
+
 def parse_response_metadata(xml_bytes: bytes) -> Tuple[int, str, Optional[str]]:
     """
     Extrai cStat (int), ultNSU (str) e maxNSU (str | None) da resposta.
     Retorna: (cStat, ultNSU, maxNSU)
     """
-    root = ET.fromstring(xml_bytes)
-    ns = {'nfe': 'http://www.portalfiscal.inf.br/nfe'}  # pode haver mais
-    # localizar cStat
-    text_stat = _find_text(root, './/nfe:cStat', ns)
-    cstat = int(text_stat)
-    ult_nsu = _find_text(root, './/nfe:ultNSU', ns, required=False) or ''
-    max_nsu = _find_text(root, './/nfe:maxNSU', ns, required=False)
-    logging.debug(f"parse_response_metadata → cStat={cstat}, ultNSU={ult_nsu}, maxNSU={max_nsu}")
-    return cstat, ult_nsu, max_nsu
+    ret = read_distdfe_response(xml_bytes)
+    return ret.cstat, ret.ult_nsu, ret.max_nsu
 
 def parse_doczips(xml_bytes: bytes) -> List[Tuple[str, str, bytes]]:
     """
     Extrai todos os docZip da resposta.
     Cada tuple: (NSU, schema, raw_xml_bytes)
     raw_xml_bytes: descompactado se necessário (gzip + base64).
+    Para não manter todos os documentos em memória, prefira read_distdfe_response.
     """
-    root = ET.fromstring(xml_bytes)
-    ns = {'nfe': 'http://www.portalfiscal.inf.br/nfe'}
-    docs = []
-    for dz in root.findall('.//nfe:docZip', ns):
-        nsu = dz.get('NSU')
-        schema = dz.get('schema')
-        raw_b64 = dz.text.strip() if dz.text else ''
-        logging.debug(f"docZip encontrado → NSU={nsu}, schema={schema}, tamanho(base64)={len(raw_b64)}")
-        try:
-            compressed = base64.b64decode(raw_b64)
-        except Exception as e:
-            logging.error(f"Falha no base64 do NSU={nsu} schema={schema}: {e}")
-            continue
-        try:
-            buf = BytesIO(compressed)
-            with gzip.GzipFile(fileobj=buf) as gz:
-                xml_raw = gz.read()
-            logging.debug(f"Descompactado gzip NSU={nsu} (schema={schema}), tamanho={len(xml_raw)} bytes")
-        except OSError:
-            # Se não for gzip
-            xml_raw = compressed
-            logging.debug(f"Não era gzip (NSU={nsu}), usando raw direto, tamanho={len(xml_raw)} bytes")
-        docs.append((nsu, schema, xml_raw))
-    return docs
+    return list(read_distdfe_response(xml_bytes).docs)
 
 def extract_chave_from_xml(raw_xml_bytes: bytes) -> str:
     """
@@ -436,10 +2176,13 @@ def extract_chave_from_xml(raw_xml_bytes: bytes) -> str:
 
 
 
-def salvar_nfeproc_renomeando(xml_txt: str, _raw: bytes, dest_base: str, cnpj_alvo: str):
+def salvar_nfeproc_renomeando(xml_txt: str, _raw: bytes, dest_base: str, cnpj_alvo: str,
+                              index: Optional["ChaveIndex"] = None):
     """
     Salva sob <dest_base>/<cnpj_alvo>/<AAAA>/<MM>/
     Nome principal: nNF.xml; se já existir, salva como CHAVE.xml.
+    Retorna False (sem gravar) se o mesmo conteúdo já estiver salvo
+    ou, com index, se a chave do nfeProc já estiver indexada.
     """
     import os, re, xml.etree.ElementTree as ET
     ns = {"nfe": "http://www.portalfiscal.inf.br/nfe"}
@@ -449,6 +2192,10 @@ def salvar_nfeproc_renomeando(xml_txt: str, _raw: bytes, dest_base: str, cnpj_al
     ch = root.find(".//nfe:protNFe/nfe:infProt/nfe:chNFe", ns)
     chave = (ch.text or "").strip() if ch is not None else ""
 
+    indexar = index is not None and bool(chave) and _strip_ns(root.tag) == "nfeProc"
+    if indexar and index.get(chave):
+        return False
+
     # nNF
     nnf = root.find(".//nfe:NFe/nfe:infNFe/nfe:ide/nfe:nNF", ns)
     nNF = (nnf.text or "").strip() if nnf is not None else ""
@@ -460,173 +2207,2313 @@ def salvar_nfeproc_renomeando(xml_txt: str, _raw: bytes, dest_base: str, cnpj_al
     mes = em[5:7]
 
     pasta = os.path.join(dest_base, cnpj_alvo, ano, mes)
-    os.makedirs(pasta, exist_ok=True)
 
     # nome principal: nNF.xml (somente dígitos)
     base_name = re.sub(r"[^\d]", "", nNF) or (chave if chave else "sem_nnf")
-    primario = os.path.join(pasta, f"{base_name}.xml")
+    primario = _stored_path(os.path.join(pasta, f"{base_name}.xml"))
 
-    if os.path.exists(primario):
-        # fallback como CHAVE.xml (44 dígitos)
-        if not chave:
-            chave = "sem_chave"
-        alvo = os.path.join(pasta, f"{chave}.xml")
-    else:
-        alvo = primario
+    conteudo = xml_txt.encode("utf-8")
+    meta = None
+    if indexar:
+        # catálogo a partir do mesmo parse
+        try:
+            dh_emi = _parse_datetime(em) if em else None
+        except (ValueError, OverflowError):
+            dh_emi = None
+        meta = DocMeta("nfeProc", chave, nNF or None, dh_emi, getattr(_raw, "schema", None),
+                       **catalog_fields(root))
+    nsu = getattr(_raw, "nsu", None)
+    with _save_lock(pasta):
+        if indexar and index.get(chave):
+            return False
+        if _STORAGE_MODE == "pacote":
+            alvo, gravado = _PACKS.put(pasta, [f"{base_name}.xml", f"{chave or 'sem_chave'}.xml"],
+                                       conteudo, chave, nNF)
+            if gravado and indexar:
+                index.put(chave, alvo, conteudo, meta, nsu)
+            return gravado
+        os.makedirs(pasta, exist_ok=True)
+        if os.path.exists(primario):
+            if _same_content(primario, conteudo):
+                # já gravado (ex.: lote refeito após retomada)
+                return False
+            # fallback como CHAVE.xml (44 dígitos)
+            alvo = _stored_path(os.path.join(pasta, f"{chave or 'sem_chave'}.xml"))
+            if _same_content(alvo, conteudo):
+                return False
+        else:
+            alvo = primario
 
-    with open(alvo, "w", encoding="utf-8") as f:
-        f.write(xml_txt)
+        if _STORAGE_MODE in COMPRESSED_SUFFIXES:
+            # _raw (DocXml) traz o stream gzip original do docZip, reaproveitado em "gz"
+            dados = _raw if isinstance(_raw, DocXml) and _raw == conteudo else conteudo
+            with open(alvo, "wb") as f:
+                f.write(compress_document(dados, _STORAGE_MODE))
+        else:
+            with open(alvo, "w", encoding="utf-8") as f:
+                f.write(xml_txt)
+        if indexar:
+            index.put(chave, alvo, conteudo, meta, nsu)
+    return True
 
-def get_endpoint(ambiente: str) -> str:
-    key = "prod" if ambiente.lower().startswith("prod") else "hom"
-    return ENDPOINTS[key]
 
-def baixar_online(cnpj: str, uf: str, ambiente: str,
-                  cert_pfx: str, cert_pass: str,
-                  filtro_ano_mes: str | None,
-                  salvar_xml_fn: Callable[[str, bytes], None],
-                  verbose: bool = False) -> Tuple[int, int]:
-
-    state = load_state(cnpj, ambiente)
-    now_ts = time.time()
-    if now_ts < state["next_allowed_ts"]:
-        wait = int(state["next_allowed_ts"] - now_ts)
-        logging.info(f"Aguardar {wait} segundos antes de nova consulta para {cnpj}/{ambiente}")
-        return 0, 0
-
-    sess = requests.Session()
-    sess.mount('https://', requests_pkcs12.Pkcs12Adapter(
-        pkcs12_filename=cert_pfx,
-        pkcs12_password=cert_pass
-    ))
-
-    url = get_endpoint(ambiente)
-    total_processed = 0
-    total_saved = 0
-    ult_nsu = state["ult_nsu"]
+def _same_content(path: str, data: bytes) -> bool:
+    """
+    True se o arquivo existe e tem exatamente o conteúdo data
+    (descompactado, para .gz/.zst).
+    """
+    if path.endswith(tuple(COMPRESSED_SUFFIXES.values())):
+        try:
+            return read_saved_document(path) == data
+        except Exception:
+            return False
+    try:
+        if os.path.getsize(path) != len(data):
+            return False
+        with open(path, "rb") as f:
+            return f.read() == data
+    except OSError:
+        return False
 
-    while True:
-        if verbose:
-            logging.info(f"[NSU={ult_nsu}] POST {url}")
-        envelope = build_envelope(cnpj=cnpj, uf=uf, ambiente=ambiente, nsu=ult_nsu)
-        headers = {
-            "Content-Type": "application/soap+xml; charset=utf-8",
-            "Connection": "keep-alive",
-        }
-        resp = sess.post(url, data=envelope, headers=headers, timeout=60)
-        resp.raise_for_status()
-        body = resp.content
+# ========= Roteamento por tipo de documento =========
 
-        # *** IMPORTANTE: adapte estas funções de parsing no seu projeto ***
-        cStat, new_ult_nsu, max_nsu = parse_response_metadata(body)
-        docs = [d[2] for d in parse_doczips(body)]
+# prefixo do atributo schema do docZip → tag raiz do documento
+SCHEMA_KINDS = {
+    "procNFe": "nfeProc",
+    "resNFe": "resNFe",
+    "procEventoNFe": "procEventoNFe",
+    "resEvento": "resEvento",
+}
 
-        if verbose:
-            logging.info(f"cStat={cStat} novoUltNSU={new_ult_nsu} maxNSU={max_nsu} docs={len(docs)}")
-
-        if cStat == 138:
-            for raw in docs:
-                xml_txt = extract_chave(raw)
-                salvar_xml_fn(xml_txt, raw)
-                total_saved += 1
-            total_processed += len(docs)
-            ult_nsu = new_ult_nsu
-            if ult_nsu == max_nsu:
-                break
-        elif cStat == 137:
-            break
-        else:
-            logging.warning(f"Código inesperado cStat={cStat} para CNPJ={cnpj}, NSU={ult_nsu}")
-            break
+_ROOT_TAG_RE = re.compile(rb"<(?![?!])(?:[\w.-]+:)?([\w.-]+)")
 
-        time.sleep(1.2)
 
-    # Salvando estado para retomar depois
-    next_allowed = time.time() + 3600
-    save_state(cnpj, ambiente, ult_nsu, next_allowed)
+def schema_kind(schema: Optional[str]) -> Optional[str]:
+    """
+    Tipo do documento a partir do atributo schema (ex.: 'procNFe_v4.00.xsd' → 'nfeProc').
+    Retorna None para schema ausente ou desconhecido.
+    """
+    if not schema:
+        return None
+    return SCHEMA_KINDS.get(schema.split("_v", 1)[0])
 
-    return total_processed, total_saved
 
-def process_doczips_locais(scan_dir: str,
-                           dest_root: str,
-                           cnpj: str,
-                           month_filter: Optional[Tuple[int, int]],
-                           apenas_nfeproc: bool) -> Tuple[int, int]:
+def sniff_root_tag(xml_bytes: bytes) -> Optional[str]:
     """
-    Lê todos os arquivos em scan_dir (docZip base64+gzip ou XML puro),
-    aplica filtros e salva nfeProc conforme regras.
+    Nome local da tag raiz lido dos primeiros bytes, sem parse
+    (pula declaração <?xml?> e comentários).
     """
-    processados = 0
-    salvos = 0
+    m = _ROOT_TAG_RE.search(xml_bytes, 0, 4096)
+    return m.group(1).decode("ascii", "replace") if m else None
 
-    for root_dir, _, files in os.walk(scan_dir):
-        for name in files:
-            path = os.path.join(root_dir, name)
-            try:
-                with open(path, "rb") as f:
-                    data = f.read()
-                # detecta se é docZip base64 ou xml já
-                xml_bytes = None
-                try:
-                    # tenta como base64+gzip
-                    xml_bytes = gzip_base64_to_xml(data.decode("utf-8"))
-                except Exception:
-                    # pode ser xml puro
-                    xml_bytes = data
-
-                processados += 1
-                root = etree.fromstring(xml_bytes)
-                tag = localname(root.tag)
-
-                if tag == "procEventoNFe":
-                    logging.debug(f"[local] Descartando procEventoNFe: {name}")
-                    continue
 
-                if apenas_nfeproc and tag != "nfeProc":
-                    logging.debug(f"[local] Descartando {tag} (apenas nfeProc): {name}")
-                    continue
+class DocRouter:
+    """
+    Encaminha cada documento para o handler registrado para o seu tipo
+    (nfeProc, resNFe, procEventoNFe, resEvento). Tipos sem handler são descartados
+    antes de gunzip/parse. Handler: fn(nsu, schema, xml_bytes) -> Optional[bool],
+    False indicando que nada foi gravado.
+    """
 
-                if not matches_month_filter(xml_bytes, month_filter):
-                    logging.debug(f"[local] Fora do mês filtrado: {name}")
-                    continue
+    def __init__(self, cnpj: str = ""):
+        self.cnpj = cnpj
+        self.handlers = {}
 
-                dest_dir, fname = save_nfeproc(xml_bytes, dest_root=dest_root, cnpj=cnpj, dh_emi=None)
-                salvos += 1
-                logging.info(f"[local] Salvo: {os.path.join(dest_dir, fname)}")
+    def register(self, kind: str, handler: Callable[[Optional[str], Optional[str], bytes], Optional[bool]]) -> None:
+        self.handlers[kind] = handler
 
-            except Exception as e:
-                logging.exception(f"Falha ao processar {path}: {e}")
+    def kinds(self) -> frozenset:
+        return frozenset(self.handlers)
 
-    return processados, salvos
+    def accepts(self, kind: Optional[str]) -> bool:
+        return kind in self.handlers
 
+    def accepts_schema(self, schema: Optional[str]) -> bool:
+        kind = schema_kind(schema)
+        if kind is None:
+            logging.warning(f"Schema desconhecido no docZip: {schema}")
+        return self.accepts(kind)
 
-# ========= CLI =========
+    def dispatch(self, kind: str, nsu: Optional[str], schema: Optional[str], xml_bytes: bytes) -> Optional[bool]:
+        return self.handlers[kind](nsu, schema, xml_bytes)
 
-def build_arg_parser() -> argparse.ArgumentParser:
-    p = argparse.ArgumentParser(
+
+def make_sink_handler(sink_root: str, cnpj: str) -> Callable[[Optional[str], Optional[str], bytes], bool]:
+    """
+    Handler que grava o documento como SINK/CNPJ/<NSU>.xml (ou <sha256[:16]>.xml sem NSU).
+    """
+    def _handler(nsu: Optional[str], schema: Optional[str], xml_bytes: bytes) -> bool:
+        pasta = os.path.join(sink_root, cnpj)
+        ensure_dir(pasta)
+        nome = nsu or hashlib.sha256(xml_bytes).hexdigest()[:16]
+        alvo = os.path.join(pasta, f"{nome}.xml")
+        if _same_content(alvo, xml_bytes):
+            return False
+        with open(alvo, "wb") as f:
+            f.write(xml_bytes)
+        return True
+    return _handler
+
+
+def build_router(cnpj: str,
+                 salvar_xml_fn: Callable[[str, bytes], Optional[bool]],
+                 sinks: Optional[dict] = None,
+                 apenas_nfeproc: bool = False) -> DocRouter:
+    """
+    nfeProc vai para salvar_xml_fn; sinks ({tipo: pasta}) recebem os demais tipos
+    (resumos, eventos), a não ser com apenas_nfeproc. Tipos sem destino são descartados.
+    """
+    router = DocRouter(cnpj)
+    router.register("nfeProc", lambda nsu, schema, xml: salvar_xml_fn(xml.decode("utf-8"), xml))
+    if not apenas_nfeproc:
+        for kind, pasta in (sinks or {}).items():
+            if pasta:
+                router.register(kind, make_sink_handler(pasta, cnpj))
+    return router
+
+
+# ========= Validação XSD =========
+
+# nome do arquivo no disco → nome do schema (procNFe_v4.00_1763749949287.xsd → procNFe_v4.00.xsd)
+_XSD_NAME_RE = re.compile(r"^(.+?_v\d+\.\d+)(?:_\d{10,})?\.xsd$")
+# tag raiz → prefixo do schema, para documentos sem o atributo schema do docZip
+KIND_SCHEMAS = {kind: prefixo for prefixo, kind in SCHEMA_KINDS.items()}
+
+
+class _XsdResolver(etree.Resolver):
+    """
+    Resolve xs:include/xs:import pelo nome do schema, inclusive quando o arquivo
+    no disco tem sufixo (tiposBasico_v1.03.xsd → tiposBasico_v1.03_1763756687364.xsd).
+    """
+
+    def __init__(self, arquivos: dict):
+        super().__init__()
+        self.arquivos = arquivos
+
+    def resolve(self, url, pubid, context):
+        path = self.arquivos.get(os.path.basename(url or ""))
+        if path is not None:
+            return self.resolve_filename(path, context)
+        return None
+
+
+class XsdValidator:
+    """
+    Valida documentos contra os XSD encontrados em xsd_dirs. Cada schema é compilado
+    uma única vez por thread (XMLSchema não é compartilhado entre threads) e reaproveitado
+    para todos os documentos com o mesmo atributo schema (ou tag raiz + versao).
+    Documentos cujo schema não está disponível não são validados (aviso uma vez por schema).
+    Pode ir para os processos do --workers: só a configuração é serializada.
+    """
+
+    def __init__(self, xsd_dirs: List[str], quarentena: Optional[str] = QUARANTINE_DIR):
+        self.xsd_dirs = list(xsd_dirs)
+        self.quarentena = quarentena
+        self._arquivos = None
+        self._local = threading.local()
+        self._avisados = set()
+
+    def __getstate__(self):
+        return {"xsd_dirs": self.xsd_dirs, "quarentena": self.quarentena}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def arquivos(self) -> dict:
+        """
+        Nome do schema → arquivo; com o mesmo nome em mais de uma pasta, vale a primeira.
+        """
+        if self._arquivos is None:
+            arquivos = {}
+            for pasta in self.xsd_dirs:
+                for nome in sorted(os.listdir(pasta)) if os.path.isdir(pasta) else ():
+                    m = _XSD_NAME_RE.match(nome)
+                    if m:
+                        arquivos.setdefault(f"{m.group(1)}.xsd", os.path.join(pasta, nome))
+            self._arquivos = arquivos
+        return self._arquivos
+
+    def assinatura(self) -> str:
+        """
+        Impressão digital do conjunto de XSD (nome, tamanho, mtime): muda quando um
+        schema é incluído, removido ou atualizado.
+        """
+        h = hashlib.sha256()
+        for nome, path in sorted(self.arquivos().items()):
+            st = os.stat(path)
+            h.update(f"{nome}:{st.st_size}:{st.st_mtime_ns};".encode())
+        return h.hexdigest()[:16]
+
+    def _avisar(self, nome: str, msg: str) -> None:
+        if nome not in self._avisados:
+            self._avisados.add(nome)
+            logging.warning(msg)
+
+    def compiled(self, nome: str) -> Optional["etree.XMLSchema"]:
+        cache = getattr(self._local, "schemas", None)
+        if cache is None:
+            cache = self._local.schemas = {}
+        if nome in cache:
+            return cache[nome]
+        xsd = None
+        path = self.arquivos().get(nome)
+        if path is None:
+            self._avisar(nome, f"XSD {nome} não encontrado em {', '.join(self.xsd_dirs)}; documentos sem validação")
+        else:
+            try:
+                parser = etree.XMLParser()
+                parser.resolvers.add(_XsdResolver(self.arquivos()))
+                xsd = etree.XMLSchema(etree.parse(path, parser))
+                logging.debug(f"XSD {nome} compilado de {path}")
+            except (etree.XMLSchemaParseError, etree.XMLSyntaxError, OSError) as e:
+                self._avisar(nome, f"XSD {nome} não compilou ({e}); documentos sem validação")
+        cache[nome] = xsd
+        return xsd
+
+    def validate(self, xml_bytes: bytes, schema: Optional[str] = None) -> Optional[str]:
+        """
+        None se o documento é válido (ou não há XSD para ele); senão o motivo da rejeição.
+        """
+        try:
+            root = etree.fromstring(xml_bytes, etree.XMLParser(huge_tree=True))
+        except etree.XMLSyntaxError as e:
+            return f"XML malformado: {e}"
+        if schema:
+            nome = schema if schema.endswith(".xsd") else f"{schema}.xsd"
+        else:
+            prefixo = KIND_SCHEMAS.get(localname(root.tag))
+            versao = root.get("versao")
+            if not prefixo or not versao:
+                return None
+            nome = f"{prefixo}_v{versao}.xsd"
+        xsd = self.compiled(nome)
+        if xsd is None or xsd.validate(root):
+            return None
+        erros = [f"linha {e.line}: {e.message}" for e in list(xsd.error_log)[:5]]
+        return f"{nome}: " + "; ".join(erros)
+
+    def quarantine(self, cnpj: str, nome: str, xml_bytes: bytes, motivo: str) -> Optional[str]:
+        """
+        Grava o documento rejeitado em QUARENTENA/CNPJ/nome.xml, com o motivo em
+        nome.motivo.txt. Sem pasta de quarentena, só registra no log.
+        """
+        if not self.quarentena:
+            return None
+        pasta = os.path.join(self.quarentena, cnpj or "sem_cnpj")
+        ensure_dir(pasta)
+        alvo = os.path.join(pasta, f"{nome}.xml")
+        with open(alvo, "wb") as f:
+            f.write(bytes(xml_bytes))
+        _atomic_write_text(os.path.join(pasta, f"{nome}.motivo.txt"), motivo + "\n")
+        return alvo
+
+
+_VALIDATOR: Optional[XsdValidator] = None
+
+
+def set_validator(validator: Optional[XsdValidator]) -> None:
+    global _VALIDATOR
+    _VALIDATOR = validator
+
+
+def _rejeitar(validator: XsdValidator, cnpj: str, nome: str, xml_bytes: bytes, motivo: str, origem: str) -> None:
+    alvo = validator.quarantine(cnpj, nome, xml_bytes, motivo)
+    logging.warning(f"Documento inválido ({origem}): {motivo}" + (f" → {alvo}" if alvo else ""))
+
+
+def get_endpoint(ambiente: str) -> str:
+    key = "prod" if ambiente.lower().startswith("prod") else "hom"
+    return ENDPOINTS[key]
+
+
+def set_endpoint(url: str) -> None:
+    """
+    Aponta os dois ambientes para url (ex.: o mockSefazDistDFe.py local).
+    """
+    ENDPOINTS.update(prod=url, hom=url)
+
+
+def requires_certificate(ambiente: str) -> bool:
+    """
+    Só endpoints https exigem o certificado A1; http fica restrito a servidores de teste.
+    """
+    return get_endpoint(ambiente).lower().startswith("https://")
+
+# ========= Sessões HTTPS por certificado =========
+
+# Sessões ociosas há mais que isso (segundos) são fechadas junto com o SSL context
+SESSION_IDLE_SECONDS = 600
+
+
+class SessionPool:
+    """
+    Sessões HTTPS reaproveitadas por certificado. O PFX é lido e decifrado uma vez por
+    impressão digital (sha256 do arquivo): o Pkcs12Adapter (SSL context + pool de conexões
+    keep-alive) é compartilhado pelas sessões do mesmo certificado, entre lotes e entre
+    CNPJs. Cada thread recebe uma sessão própria; entradas ociosas além de idle_seconds
+    são fechadas na próxima aquisição (ou em evict_idle/close).
+    Sem cert_pfx (endpoint http de teste, ver --endpoint), as sessões não usam certificado.
+    """
+
+    def __init__(self, idle_seconds: float = SESSION_IDLE_SECONDS, pool_maxsize: int = 10):
+        self.idle_seconds = idle_seconds
+        self.pool_maxsize = pool_maxsize
+        self._lock = threading.Lock()
+        self._entries = {}        # fingerprint -> {"adapter", "livres", "em_uso", "ultimo_uso"}
+        self._fingerprints = {}   # caminho -> (mtime_ns, size, fingerprint, dados)
+
+    def fingerprint(self, cert_pfx: str) -> Tuple[str, bytes]:
+        """
+        Impressão digital (sha256) e conteúdo do PFX; relê o arquivo só se ele mudou.
+        """
+        path = os.path.abspath(cert_pfx)
+        st = os.stat(path)
+        cached = self._fingerprints.get(path)
+        if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+            return cached[2], cached[3]
+        with open(path, "rb") as f:
+            data = f.read()
+        fp = hashlib.sha256(data).hexdigest()
+        self._fingerprints[path] = (st.st_mtime_ns, st.st_size, fp, data)
+        return fp, data
+
+    def _acquire(self, cert_pfx: str, cert_pass: str) -> Tuple[str, "requests.Session"]:
+        _load_network()
+        self.evict_idle()
+        with self._lock:
+            fp, data = self.fingerprint(cert_pfx) if cert_pfx else ("", None)
+            entry = self._entries.get(fp)
+            if entry is None:
+                # única etapa cara: decifra o PKCS#12 e monta o SSL context
+                adapter = requests_pkcs12.Pkcs12Adapter(
+                    pkcs12_data=data,
+                    pkcs12_password=cert_pass,
+                    pool_maxsize=self.pool_maxsize,
+                ) if data is not None else requests.adapters.HTTPAdapter(pool_maxsize=self.pool_maxsize)
+                entry = {"adapter": adapter, "livres": [], "em_uso": 0, "ultimo_uso": time.time()}
+                self._entries[fp] = entry
+                logging.debug(f"Certificado {fp[:12]} carregado no pool de sessões")
+            if entry["livres"]:
+                sess = entry["livres"].pop()
+            else:
+                sess = requests.Session()
+                sess.mount("https://", entry["adapter"])
+                sess.mount("http://", entry["adapter"])
+            entry["em_uso"] += 1
+            return fp, sess
+
+    def _release(self, fp: str, sess: "requests.Session") -> None:
+        with self._lock:
+            entry = self._entries.get(fp)
+            if entry is None:
+                return
+            entry["em_uso"] -= 1
+            entry["ultimo_uso"] = time.time()
+            entry["livres"].append(sess)
+
+    @contextmanager
+    def session(self, cert_pfx: str, cert_pass: str) -> Iterator["requests.Session"]:
+        """
+        Sessão do certificado para uso exclusivo da thread atual durante o bloco with.
+        """
+        fp, sess = self._acquire(cert_pfx, cert_pass)
+        try:
+            yield sess
+        finally:
+            self._release(fp, sess)
+
+    def evict_idle(self, now: Optional[float] = None) -> int:
+        """
+        Fecha as entradas sem uso há mais de idle_seconds. Retorna quantas foram fechadas.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            velhas = [fp for fp, e in self._entries.items()
+                      if e["em_uso"] == 0 and now - e["ultimo_uso"] > self.idle_seconds]
+            entries = [self._entries.pop(fp) for fp in velhas]
+        for entry in entries:
+            entry["adapter"].close()
+        return len(entries)
+
+    def close(self) -> None:
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            entry["adapter"].close()
+
+
+_SESSION_POOL = SessionPool()
+
+
+def set_session_pool(pool: SessionPool) -> None:
+    global _SESSION_POOL
+    _SESSION_POOL = pool
+
+
+# ========= Ritmo de consultas =========
+
+class PacingPolicy(NamedTuple):
+    """
+    Parâmetros de ritmo (segundos). A espera após cada execução depende de como ela terminou:
+    em_dia (137 ou ultNSU == maxNSU), pendente (parou em max_chamadas com lotes restantes),
+    656 (consumo indevido, backoff exponencial por bloqueios seguidos), erro_http
+    (esgotou as tentativas com backoff exponencial + jitter) ou cstat_inesperado.
+    """
+    intervalo: float = 1.2
+    cooldown_em_dia: float = 3600
+    cooldown_pendente: float = 60
+    cooldown_erro: float = 900
+    backoff_656: float = 3600
+    backoff_max: float = 6 * 3600
+    backoff_http_base: float = 2
+    backoff_http_max: float = 120
+    tentativas_http: int = 3
+    max_chamadas: Optional[int] = None
+
+
+def http_retry_delay(policy: PacingPolicy, tentativa: int) -> float:
+    """
+    Backoff exponencial com jitter para a tentativa (0, 1, 2, ...) após erro HTTP.
+    """
+    teto = min(policy.backoff_http_max, policy.backoff_http_base * (2 ** tentativa))
+    return random.uniform(teto / 2, teto)
+
+
+def compute_cooldown(policy: PacingPolicy, motivo: str, state: dict) -> Tuple[float, dict]:
+    """
+    Espera até a próxima execução conforme o motivo de parada, e os contadores
+    (bloqueios_656, falhas_http) a gravar no estado.
+    """
+    bloqueios = state.get("bloqueios_656", 0) + 1 if motivo == "656" else 0
+    falhas = state.get("falhas_http", 0) + 1 if motivo == "erro_http" else 0
+
+    if motivo == "656":
+        espera = min(policy.backoff_max, policy.backoff_656 * (2 ** (bloqueios - 1)))
+    elif motivo == "erro_http":
+        teto = min(policy.backoff_max, policy.cooldown_erro * (2 ** (falhas - 1)))
+        espera = random.uniform(teto / 2, teto)
+    elif motivo == "pendente":
+        espera = policy.cooldown_pendente
+    elif motivo == "em_dia":
+        espera = policy.cooldown_em_dia
+    else:
+        espera = policy.cooldown_erro
+    return espera, {"bloqueios_656": bloqueios, "falhas_http": falhas, "motivo_espera": motivo}
+
+
+def _aguardar_intervalo(policy: PacingPolicy, ultimo_post: float) -> None:
+    espera = policy.intervalo - (time.time() - ultimo_post)
+    if espera > 0:
+        time.sleep(espera)
+
+
+def _post_with_retry(sess, url: str, envelope: bytes, policy: PacingPolicy, stream: bool = False):
+    """
+    POST com novas tentativas em erro HTTP/conexão. Retorna None se todas falharem.
+    """
+    for tentativa in range(policy.tentativas_http + 1):
+        try:
+            return _post_distdfe(sess, url, envelope, stream=stream)
+        except requests.RequestException as e:
+            if tentativa >= policy.tentativas_http:
+                logging.error(f"Falha HTTP após {tentativa + 1} tentativa(s): {e}")
+                return None
+            _METRICS.inc("falhas_http")
+            delay = http_retry_delay(policy, tentativa)
+            logging.warning(f"Falha HTTP ({e}); nova tentativa em {delay:.1f}s")
+            time.sleep(delay)
+    return None
+
+
+def _motivo_parada(cstat: int, ult_nsu: str, max_nsu: Optional[str]) -> Optional[str]:
+    """
+    Motivo de parada do laço para o cStat recebido, ou None para continuar.
+    """
+    if cstat == 138:
+        return "em_dia" if ult_nsu == max_nsu else None
+    if cstat == 137:
+        return "em_dia"
+    if cstat == 656:
+        return "656"
+    return "cstat_inesperado"
+
+
+def _save_batch(body: Union[bytes, str, IO[bytes]], router: DocRouter,
+                livro: Optional[NsuLedger] = None) -> Tuple[int, int]:
+    """
+    Decodifica e grava todos os documentos de um lote (cStat 138). Retorna (processados, salvos).
+    """
+    n_docs = 0
+    n_saved = 0
+    ret = read_distdfe_response(body, accept_schema=router.accepts_schema,
+                                on_doczip=livro.recebido if livro is not None else None)
+    for nsu, schema, raw in ret.docs:
+        if _dispatch_timed(router, nsu, schema, raw, livro):
+            n_saved += 1
+        n_docs += 1
+    return n_docs, n_saved
+
+
+def _dispatch_timed(router: DocRouter, nsu: Optional[str], schema: Optional[str], raw: bytes,
+                    livro: Optional[NsuLedger] = None) -> bool:
+    """
+    router.dispatch com métricas de gravação. True se o documento foi gravado.
+    Em livro, o NSU é marcado como gravado quando o handler termina sem erro
+    (documento reprovado no XSD não conta). Um erro num documento (XML malformado,
+    falha de disco) é registrado com o NSU e não interrompe o lote: o NSU fica como
+    recebido sem gravação, para o --reparar-lacunas.
+    """
+    kind = schema_kind(schema)
+    try:
+        if _VALIDATOR is not None:
+            with _METRICS.timer("validacao"):
+                motivo = _VALIDATOR.validate(raw, schema)
+            if motivo:
+                _rejeitar(_VALIDATOR, router.cnpj, nsu or hashlib.sha256(raw).hexdigest()[:16], raw, motivo,
+                          f"NSU {nsu}")
+                _METRICS.inc("documentos", tipo=kind, resultado="invalido")
+                return False
+        with _METRICS.timer("gravacao"):
+            gravado = router.dispatch(kind, nsu, schema, raw) is not False
+    except Exception as e:
+        logging.exception(f"Falha ao gravar NSU={nsu} ({schema}) do CNPJ {router.cnpj}: {e}")
+        _METRICS.inc("documentos", tipo=kind, resultado="erro")
+        return False
+    if livro is not None:
+        livro.gravado(nsu)
+    _METRICS.inc("documentos", tipo=kind, resultado="salvo" if gravado else "ignorado")
+    return gravado
+
+
+def _post_distdfe(sess, url: str, envelope: bytes, stream: bool = False):
+    headers = {
+        "Content-Type": "application/soap+xml; charset=utf-8",
+        "Connection": "keep-alive",
+    }
+    resp = sess.post(url, data=envelope, headers=headers, timeout=60, stream=stream)
+    try:
+        resp.raise_for_status()
+    except Exception:
+        resp.close()
+        raise
+    return resp
+
+
+def _report_progress(progresso: Optional[Callable[[dict], None]], prog: dict) -> None:
+    if progresso is not None:
+        progresso({"ult_nsu": prog["ult_nsu"], "max_nsu": prog["max_nsu"],
+                   "processados": prog["processed"], "salvos": prog["saved"]})
+
+
+def _nsu_loop(sess, url: str, cnpj: str, uf: str, ambiente: str, state: dict,
+              router: DocRouter, verbose: bool, run_start: float,
+              policy: PacingPolicy, progresso: Optional[Callable[[dict], None]] = None,
+              interromper: Optional[threading.Event] = None,
+              livro: Optional[NsuLedger] = None,
+              lease: Optional[Lease] = None) -> dict:
+    """
+    Laço sequencial: POST, leitura em stream e gravação de cada lote, checkpoint e pausa.
+    prog["motivo"] diz por que o laço parou (ver PacingPolicy); progresso, se informado,
+    recebe o avanço a cada checkpoint. interromper (ex.: lease perdido) encerra o laço
+    antes do próximo POST e impede o checkpoint do lote em andamento.
+    livro, se informado, registra cada NSU recebido/gravado e é gravado a cada checkpoint.
+    lease cerca cada checkpoint (ver save_state): uma gravação recusada sinaliza
+    interromper e encerra o laço.
+    """
+    prog = {"processed": 0, "saved": 0, "ult_nsu": state["ult_nsu"],
+            "max_nsu": state.get("max_nsu"), "cstat": None, "motivo": None}
+    chamadas = 0
+    ultimo_post = 0.0
+    falhas_leitura = 0
+
+    while True:
+        if interromper is not None and interromper.is_set():
+            prog["motivo"] = "lease_perdido"
+            break
+        if policy.max_chamadas and chamadas >= policy.max_chamadas:
+            prog["motivo"] = "pendente"
+            break
+        ult_nsu = prog["ult_nsu"]
+        _aguardar_intervalo(policy, ultimo_post)
+        if verbose:
+            logging.info(f"[NSU={ult_nsu}] POST {url}")
+        envelope = build_envelope_dist_nsu(cnpj=cnpj, uf=uf, ambiente=ambiente, ult_nsu=ult_nsu)
+        with _METRICS.timer("http"):
+            resp = _post_with_retry(sess, url, envelope, policy, stream=True)
+        ultimo_post = time.time()
+        chamadas += 1
+        if resp is None:
+            prog["motivo"] = "erro_http"
+            break
+        try:
+            # lê o corpo incrementalmente; cada docZip é decodificado só quando consumido
+            resp.raw.decode_content = True
+            ret = read_distdfe_response(resp.raw, accept_schema=router.accepts_schema,
+                                        on_doczip=livro.recebido if livro is not None else None)
+            cStat, new_ult_nsu, max_nsu = ret.cstat, ret.ult_nsu, ret.max_nsu
+            prog["cstat"] = cStat
+            _METRICS.inc("requisicoes", cstat=cStat)
+
+            if verbose:
+                logging.info(f"cStat={cStat} novoUltNSU={new_ult_nsu} maxNSU={max_nsu}")
+
+            if cStat == 138:
+                n_docs = 0
+                for nsu, schema, raw in ret.docs:
+                    if _dispatch_timed(router, nsu, schema, raw, livro):
+                        prog["saved"] += 1
+                    n_docs += 1
+                prog["processed"] += n_docs
+                if verbose:
+                    logging.info(f"docs={n_docs}")
+                try:
+                    if livro is not None:
+                        save_ledger(cnpj, ambiente, livro, lease)
+                    if interromper is not None and interromper.is_set():
+                        # outro nó já pode ter avançado o cursor: não sobrescreve
+                        prog["motivo"] = "lease_perdido"
+                        break
+                    # checkpoint do lote já gravado: uma retomada continua daqui
+                    save_state(cnpj, ambiente, new_ult_nsu, state["next_allowed_ts"], lease,
+                               max_nsu=max_nsu, last_cstat=cStat, last_run_start=run_start)
+                except LeasePerdido as e:
+                    logging.error(f"{e}; checkpoint de CNPJ={cnpj} não gravado")
+                    interromper.set()
+                    prog["motivo"] = "lease_perdido"
+                    break
+                prog["ult_nsu"], prog["max_nsu"] = new_ult_nsu, max_nsu
+                _report_progress(progresso, prog)
+
+            falhas_leitura = 0
+            prog["motivo"] = _motivo_parada(cStat, new_ult_nsu, max_nsu)
+            if prog["motivo"] is not None:
+                if prog["motivo"] != "em_dia":
+                    logging.warning(f"cStat={cStat} ({ret.xmotivo}) para CNPJ={cnpj}, NSU={ult_nsu}")
+                break
+        except (requests.RequestException, urllib3.exceptions.HTTPError, etree.XMLSyntaxError) as e:
+            # corpo interrompido no meio do lote: o checkpoint não avançou, então o mesmo
+            # NSU é pedido de novo (as gravações já feitas são idempotentes)
+            falhas_leitura += 1
+            if falhas_leitura > policy.tentativas_http:
+                logging.error(f"Resposta interrompida em NSU={ult_nsu} após {falhas_leitura} tentativa(s): {e}")
+                prog["motivo"] = "erro_http"
+                break
+            delay = http_retry_delay(policy, falhas_leitura - 1)
+            logging.warning(f"Resposta interrompida em NSU={ult_nsu} ({e}); nova tentativa em {delay:.1f}s")
+            time.sleep(delay)
+        finally:
+            resp.close()
+
+    return prog
+
+
+def _nsu_loop_pipeline(sess, url: str, cnpj: str, uf: str, ambiente: str, state: dict,
+                       router: DocRouter, verbose: bool, run_start: float,
+                       policy: PacingPolicy, workers: int, fila: int,
+                       progresso: Optional[Callable[[dict], None]] = None,
+                       interromper: Optional[threading.Event] = None,
+                       livro: Optional[NsuLedger] = None,
+                       lease: Optional[Lease] = None) -> dict:
+    """
+    Laço em pipeline: esta thread só busca (POST + cabeçalho da resposta) e avança o
+    cursor dentro do ritmo permitido; os corpos vão para uma fila limitada (fila lotes,
+    o que limita a memória e segura a busca quando a gravação atrasa) e workers
+    threads decodificam e gravam em paralelo.
+    O checkpoint só avança até o último lote contíguo já gravado por completo.
+    interromper, livro e lease têm o mesmo papel que em _nsu_loop.
+    """
+    q = queue.Queue(maxsize=max(1, fila))
+    lock = threading.Lock()
+    parar = threading.Event()
+    concluidos = {}
+    prog = {"processed": 0, "saved": 0, "ult_nsu": state["ult_nsu"],
+            "max_nsu": state.get("max_nsu"), "cstat": None, "motivo": None, "seq": 0, "erro": None}
+
+    def _consumidor():
+        with _METRICS.cnpj(cnpj):
+            _consumir()
+
+    def _consumir():
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            seq, body, ult_nsu, max_nsu, cstat = item
+            if parar.is_set():
+                continue
+            try:
+                n_docs, n_saved = _save_batch(body, router, livro)
+                if livro is not None:
+                    save_ledger(cnpj, ambiente, livro, lease)
+            except LeasePerdido as e:
+                logging.error(f"{e}; checkpoint de CNPJ={cnpj} não gravado")
+                interromper.set()
+                parar.set()
+                continue
+            except Exception as e:
+                logging.exception(f"Falha ao gravar lote NSU→{ult_nsu} do CNPJ {cnpj}: {e}")
+                with lock:
+                    prog["erro"] = prog["erro"] or e
+                parar.set()
+                continue
+            with lock:
+                prog["processed"] += n_docs
+                prog["saved"] += n_saved
+                concluidos[seq] = (ult_nsu, max_nsu, cstat)
+                # avança só pelos lotes contíguos (um lote posterior pode terminar antes)
+                while prog["seq"] + 1 in concluidos and not (interromper is not None and interromper.is_set()):
+                    ult, maximo, c = concluidos[prog["seq"] + 1]
+                    try:
+                        save_state(cnpj, ambiente, ult, state["next_allowed_ts"], lease,
+                                   max_nsu=maximo, last_cstat=c, last_run_start=run_start)
+                    except LeasePerdido as e:
+                        logging.error(f"{e}; checkpoint de CNPJ={cnpj} não gravado")
+                        interromper.set()
+                        parar.set()
+                        break
+                    del concluidos[prog["seq"] + 1]
+                    prog["seq"] += 1
+                    prog["ult_nsu"], prog["max_nsu"] = ult, maximo
+                    _report_progress(progresso, prog)
+            if verbose:
+                logging.info(f"[pipeline] lote {seq} gravado: docs={n_docs}")
+
+    threads = [threading.Thread(target=_consumidor, name=f"pipeline-{cnpj}-{i}", daemon=True)
+               for i in range(max(1, workers))]
+    for t in threads:
+        t.start()
+
+    seq = 0
+    ult_nsu = state["ult_nsu"]
+    chamadas = 0
+    ultimo_post = 0.0
+    try:
+        while not parar.is_set():
+            if interromper is not None and interromper.is_set():
+                prog["motivo"] = "lease_perdido"
+                break
+            if policy.max_chamadas and chamadas >= policy.max_chamadas:
+                prog["motivo"] = "pendente"
+                break
+            _aguardar_intervalo(policy, ultimo_post)
+            if verbose:
+                logging.info(f"[NSU={ult_nsu}] POST {url}")
+            envelope = build_envelope_dist_nsu(cnpj=cnpj, uf=uf, ambiente=ambiente, ult_nsu=ult_nsu)
+            with _METRICS.timer("http"):
+                resp = _post_with_retry(sess, url, envelope, policy)
+            ultimo_post = time.time()
+            chamadas += 1
+            if resp is None:
+                prog["motivo"] = "erro_http"
+                break
+            try:
+                body = resp.content
+            finally:
+                resp.close()
+
+            # só o cabeçalho: os docZip ficam para os workers
+            ret = read_distdfe_response(body)
+            prog["cstat"] = ret.cstat
+            _METRICS.inc("requisicoes", cstat=ret.cstat)
+            if verbose:
+                logging.info(f"cStat={ret.cstat} novoUltNSU={ret.ult_nsu} maxNSU={ret.max_nsu}")
+
+            if ret.cstat == 138:
+                seq += 1
+                q.put((seq, body, ret.ult_nsu, ret.max_nsu, ret.cstat))
+
+            prog["motivo"] = _motivo_parada(ret.cstat, ret.ult_nsu, ret.max_nsu)
+            if prog["motivo"] is not None:
+                if prog["motivo"] != "em_dia":
+                    logging.warning(f"cStat={ret.cstat} ({ret.xmotivo}) para CNPJ={cnpj}, NSU={ult_nsu}")
+                break
+            ult_nsu = ret.ult_nsu
+    finally:
+        for _ in threads:
+            q.put(None)
+        for t in threads:
+            t.join()
+
+    if prog["erro"] is not None:
+        raise prog["erro"]
+    return prog
+
+
+def baixar_online(cnpj: str, uf: str, ambiente: str,
+                  cert_pfx: str, cert_pass: str,
+                  filtro_ano_mes: str | None,
+                  salvar_xml_fn: Callable[[str, bytes], Optional[bool]],
+                  verbose: bool = False,
+                  router: Optional[DocRouter] = None,
+                  pipeline_workers: int = 0,
+                  pipeline_fila: int = 4,
+                  policy: Optional[PacingPolicy] = None,
+                  progresso: Optional[Callable[[dict], None]] = None) -> Tuple[int, int]:
+    """
+    Laço de NSU (distNSU) de um CNPJ. Cada docZip é roteado pelo atributo schema:
+    nfeProc vai para salvar_xml_fn (ou para o router informado); tipos sem handler
+    são descartados sem decodificar.
+    Com pipeline_workers > 0, a busca e a gravação se sobrepõem (ver _nsu_loop_pipeline).
+    O intervalo entre chamadas e a espera até a próxima execução vêm de policy
+    (PacingPolicy) e do motivo de parada; tudo é registrado no estado.
+    Com leases ativos, levanta LeaseOcupado se outro nó estiver com o CNPJ.
+    """
+    policy = policy or PacingPolicy()
+    if not cert_pfx and requires_certificate(ambiente):
+        raise ValueError(f"Certificado obrigatório para {get_endpoint(ambiente)}")
+
+    # com leases (set_lease_store), só um nó por vez consulta este CNPJ/ambiente;
+    # o estado é lido já com o lease, então reflete o que o dono anterior gravou
+    with tenant_lease(cnpj, ambiente) as hb:
+        interromper = hb.perdido if hb is not None else None
+        # cada gravação de estado/livro confere o token desta posse (fencing)
+        lease = hb.lease if hb is not None else None
+        state = load_state(cnpj, ambiente)
+        now_ts = time.time()
+        if now_ts < state["next_allowed_ts"]:
+            wait = int(state["next_allowed_ts"] - now_ts)
+            logging.info(f"Aguardar {wait} segundos antes de nova consulta para {cnpj}/{ambiente}")
+            return 0, 0
+
+        livro = load_ledger(cnpj, ambiente)
+        if livro is None:
+            livro = NsuLedger(desde=int(state["ult_nsu"] or 0))
+        elif int(state["ult_nsu"] or 0) == 0 and livro.recebidos:
+            # estado perdido ou zerado: o livro diz até onde já veio, e o que faltar
+            # antes disso aparece como lacuna (--reparar-lacunas) em vez de baixar tudo de novo
+            state["ult_nsu"] = f"{livro.recebidos.max():015d}"
+            logging.warning(f"Cursor de {cnpj}/{ambiente} zerado; retomando do livro de NSU em {state['ult_nsu']} "
+                            f"(para repetir tudo, apague também o livro)")
+
+        if router is None:
+            router = build_router(cnpj, salvar_xml_fn)
+
+        url = get_endpoint(ambiente)
+        run_start = time.time()
+
+        # sessão do pool: o SSL context e as conexões do certificado seguem vivos após a execução
+        try:
+            with _SESSION_POOL.session(cert_pfx, cert_pass) as sess, _METRICS.cnpj(cnpj):
+                if pipeline_workers > 0:
+                    prog = _nsu_loop_pipeline(sess, url, cnpj, uf, ambiente, state, router, verbose, run_start,
+                                              policy, workers=pipeline_workers, fila=pipeline_fila,
+                                              progresso=progresso, interromper=interromper, livro=livro,
+                                              lease=lease)
+                else:
+                    prog = _nsu_loop(sess, url, cnpj, uf, ambiente, state, router, verbose, run_start, policy,
+                                     progresso=progresso, interromper=interromper, livro=livro, lease=lease)
+        finally:
+            # o livro registra o que foi gravado mesmo quando o laço falha no meio
+            try:
+                save_ledger(cnpj, ambiente, livro, lease)
+            except LeasePerdido as e:
+                logging.error(f"{e}; livro de NSU não gravado")
+                interromper.set()
+
+        if interromper is not None and interromper.is_set():
+            # o estado agora é do novo dono do lease
+            logging.warning(f"{cnpj}/{ambiente}: lease perdido; estado não gravado por este nó")
+            return prog["processed"], prog["saved"]
+
+        # Salvando estado para retomar depois
+        espera, contadores = compute_cooldown(policy, prog["motivo"], state)
+        next_allowed = time.time() + espera
+        logging.info(f"Próxima consulta de {cnpj}/{ambiente} em {int(espera)}s ({prog['motivo']})")
+        try:
+            save_state(cnpj, ambiente, prog["ult_nsu"], next_allowed, lease,
+                       max_nsu=prog["max_nsu"], last_cstat=prog["cstat"],
+                       last_run_start=run_start, last_run_end=time.time(), **contadores)
+        except LeasePerdido as e:
+            logging.error(f"{e}; estado não gravado por este nó")
+            interromper.set()
+
+        return prog["processed"], prog["saved"]
+
+
+def reparar_lacunas(cnpj: str, uf: str, ambiente: str,
+                    cert_pfx: str, cert_pass: str,
+                    router: DocRouter,
+                    verbose: bool = False,
+                    policy: Optional[PacingPolicy] = None) -> Tuple[int, int, int]:
+    """
+    Pede de novo, um a um via consNSU (build_envelope), só os NSUs que o livro aponta
+    como lacuna até o cursor: não recebidos e recebidos sem gravação.
+    Respeita policy.intervalo e policy.max_chamadas; 137 marca o NSU como vazio e 656
+    encerra com o mesmo backoff do laço de distNSU. Retorna (processados, salvos, restantes).
+    """
+    policy = policy or PacingPolicy()
+    if not cert_pfx and requires_certificate(ambiente):
+        raise ValueError(f"Certificado obrigatório para {get_endpoint(ambiente)}")
+
+    with tenant_lease(cnpj, ambiente) as hb:
+        lease = hb.lease if hb is not None else None
+        state = load_state(cnpj, ambiente)
+        if state.get("motivo_espera") == "656" and time.time() < state["next_allowed_ts"]:
+            logging.info(f"{cnpj}/{ambiente} em backoff de 656 por mais "
+                         f"{int(state['next_allowed_ts'] - time.time())}s; reparo adiado")
+            return 0, 0, 0
+        livro = load_ledger(cnpj, ambiente)
+        if livro is None:
+            logging.info(f"{cnpj}/{ambiente} sem livro de NSU: nada a reparar")
+            return 0, 0, 0
+        nao_recebidos, nao_gravados = livro.lacunas(int(state["ult_nsu"] or 0))
+        alvos = NsuRanges(nao_recebidos)
+        alvos.update(nao_gravados)
+        total = alvos.total()
+        logging.info(f"{cnpj}/{ambiente}: {nao_recebidos.total()} NSU(s) não recebido(s), "
+                     f"{nao_gravados.total()} sem gravação")
+
+        url = get_endpoint(ambiente)
+        processados = salvos = chamadas = 0
+        checkpoint = 0
+        motivo = None
+        ultimo_post = 0.0
+        try:
+            with _SESSION_POOL.session(cert_pfx, cert_pass) as sess, _METRICS.cnpj(cnpj):
+                for nsu in alvos.nsus():
+                    if hb is not None and hb.perdido.is_set():
+                        motivo = "lease_perdido"
+                        break
+                    # resposta truncada/malformada: mesmo backoff do laço de distNSU; esgotadas
+                    # as tentativas, o NSU segue como lacuna para o próximo reparo
+                    for falhas in range(policy.tentativas_http + 1):
+                        if policy.max_chamadas and chamadas >= policy.max_chamadas:
+                            motivo = "pendente"
+                            break
+                        _aguardar_intervalo(policy, ultimo_post)
+                        if verbose:
+                            logging.info(f"[consNSU={nsu}] POST {url}")
+                        envelope = build_envelope(cnpj=cnpj, uf=uf, ambiente=ambiente, nsu=str(nsu))
+                        with _METRICS.timer("http"):
+                            resp = _post_with_retry(sess, url, envelope, policy)
+                        ultimo_post = time.time()
+                        chamadas += 1
+                        if resp is None:
+                            motivo = "erro_http"
+                            break
+                        try:
+                            ret = read_distdfe_response(resp.content, accept_schema=router.accepts_schema,
+                                                        on_doczip=livro.recebido)
+                            _METRICS.inc("requisicoes", cstat=ret.cstat)
+                            if ret.cstat == 138:
+                                for doc_nsu, schema, raw in ret.docs:
+                                    if _dispatch_timed(router, doc_nsu, schema, raw, livro):
+                                        salvos += 1
+                                    processados += 1
+                            elif ret.cstat == 137:
+                                livro.vazio(nsu)
+                            elif ret.cstat == 656:
+                                motivo = "656"
+                                logging.warning(f"cStat=656 ({ret.xmotivo}) no consNSU de CNPJ={cnpj}, NSU={nsu}")
+                            else:
+                                logging.warning(f"cStat={ret.cstat} ({ret.xmotivo}) no consNSU de CNPJ={cnpj}, NSU={nsu}")
+                            break
+                        except (requests.RequestException, urllib3.exceptions.HTTPError, etree.XMLSyntaxError) as e:
+                            if falhas == policy.tentativas_http:
+                                logging.error(f"Resposta inválida no consNSU de CNPJ={cnpj}, NSU={nsu} após "
+                                              f"{falhas + 1} tentativa(s): {e}; NSU segue como lacuna")
+                                break
+                            delay = http_retry_delay(policy, falhas)
+                            logging.warning(f"Resposta inválida no consNSU de CNPJ={cnpj}, NSU={nsu} ({e}); "
+                                            f"nova tentativa em {delay:.1f}s")
+                            time.sleep(delay)
+                        finally:
+                            resp.close()
+                    if motivo is not None:
+                        break
+                    if chamadas - checkpoint >= 50:
+                        checkpoint = chamadas
+                        try:
+                            save_ledger(cnpj, ambiente, livro, lease)
+                        except LeasePerdido as e:
+                            logging.error(f"{e}; reparo de {cnpj}/{ambiente} interrompido")
+                            hb.perdido.set()
+                            motivo = "lease_perdido"
+                            break
+        finally:
+            try:
+                save_ledger(cnpj, ambiente, livro, lease)
+            except LeasePerdido as e:
+                logging.error(f"{e}; livro de NSU não gravado")
+                hb.perdido.set()
+                motivo = "lease_perdido"
+
+        if motivo == "656":
+            espera, contadores = compute_cooldown(policy, motivo, state)
+            try:
+                save_state(cnpj, ambiente, state["ult_nsu"], time.time() + espera, lease,
+                           last_cstat=656, **contadores)
+            except LeasePerdido as e:
+                logging.error(f"{e}; backoff de 656 não gravado")
+        nao_recebidos, nao_gravados = livro.lacunas(int(state["ult_nsu"] or 0))
+        restantes = NsuRanges(nao_recebidos)
+        restantes.update(nao_gravados)
+        logging.info(f"Reparo de {cnpj}/{ambiente}: {chamadas} consNSU, processados={processados}, "
+                     f"salvos={salvos}, lacunas {total}→{restantes.total()}" + (f" ({motivo})" if motivo else ""))
+        return processados, salvos, restantes.total()
+
+
+def _list_scan_files(scan_dir: str) -> List[str]:
+    """
+    Lista os arquivos de scan_dir em ordem determinística (pastas e nomes ordenados).
+    """
+    paths = []
+    for root_dir, dirs, files in os.walk(scan_dir):
+        dirs.sort()
+        for name in sorted(files):
+            paths.append(os.path.join(root_dir, name))
+    return paths
+
+
+class ScanManifest(_SqliteThreadLocal):
+    """
+    Manifesto do --scan-dir: (path, tamanho, mtime, sha256, resultado) de cada arquivo
+    já processado para um destino. Execuções seguintes só leem arquivos novos ou alterados.
+    """
+
+    # resultados que não mudam enquanto o arquivo não mudar
+    FINAL = ("salvo", "ja_salvo")
+    # resultados que dependem dos tipos com destino (--dest-eventos/--dest-resumos/--apenas-nfeproc)
+    ROTEADOS = ("evento", "descartado")
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self._conn().execute("""
+            CREATE TABLE IF NOT EXISTS arquivos (
+                path TEXT NOT NULL,
+                destino TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                sha256 TEXT,
+                outcome TEXT NOT NULL,
+                filtro TEXT,
+                updated_at REAL,
+                PRIMARY KEY (path, destino)
+            )""")
+
+    def get(self, path: str, destino: str) -> Optional[sqlite3.Row]:
+        return self._conn().execute(
+            "SELECT * FROM arquivos WHERE path = ? AND destino = ?", (path, destino)).fetchone()
+
+    @staticmethod
+    def chave(filtro_emissao: str, aceitos: frozenset, apenas_nfeproc: bool = False,
+              validator: Optional["XsdValidator"] = None) -> str:
+        """
+        Configuração gravada com cada resultado (coluna filtro): filtro de emissão,
+        tipos aceitos e validação XSD (desligada ou a assinatura dos schemas),
+        ex.: "2025-10|tipos=nfeProc,procEventoNFe|xsd=-".
+        """
+        tipos = ",".join(sorted(aceitos)) + (";apenas_nfeproc" if apenas_nfeproc else "")
+        xsd = validator.assinatura() if validator is not None else "-"
+        return f"{filtro_emissao}|tipos={tipos}|xsd={xsd}"
+
+    @staticmethod
+    def _partes(filtro: Optional[str]) -> dict:
+        emissao, *resto = (filtro or "").split("|")
+        return {"emissao": emissao, **dict(p.partition("=")[::2] for p in resto)}
+
+    @classmethod
+    def is_done(cls, row: Optional[sqlite3.Row], filtro: str) -> bool:
+        """
+        True se o resultado registrado continua valendo para a configuração atual (ver chave).
+        """
+        if row is None:
+            return False
+        if row["outcome"] in cls.FINAL:
+            return True
+        if row["outcome"] in cls.ROTEADOS:
+            # evento/resumo descartado pode ter destino agora
+            return cls._partes(row["filtro"]).get("tipos") == cls._partes(filtro).get("tipos")
+        if row["outcome"] == "invalido":
+            # reprovado vale só para a mesma validação (ligada/desligada, mesmos XSD)
+            return cls._partes(row["filtro"]).get("xsd") == cls._partes(filtro).get("xsd")
+        # conteiner (ZIP/TAR/resposta SOAP) pode ter documentos fora do filtro em que foi lido
+        return row["outcome"] in ("fora_do_mes", "conteiner") and row["filtro"] == filtro
+
+    def record_many(self, rows: List[Tuple[str, str, int, int, Optional[str], str, str]]) -> None:
+        """
+        Grava (path, destino, size, mtime_ns, sha256, outcome, filtro) numa única transação.
+        """
+        if not rows:
+            return
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO arquivos (path, destino, size, mtime_ns, sha256, outcome, filtro, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(*r, now) for r in rows])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+
+# ZIP/TAR no --scan-dir, lidos membro a membro (tarfile em modo stream)
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+# tags raiz de respostas do NFeDistribuicaoDFe salvas em disco (envelope SOAP ou retDistDFeInt)
+DUMP_ROOT_TAGS = ("Envelope", "retDistDFeInt")
+
+
+def _iter_member_docs(ident: str, f: IO[bytes]) -> Iterator[Tuple[str, bytes]]:
+    """
+    Documentos de um arquivo aberto: os docZip, se for uma resposta SOAP salva
+    (lidos em streaming por read_distdfe_response), senão o próprio conteúdo.
+    """
+    head = f.peek(4096)[:4096] if hasattr(f, "peek") else b""
+    if sniff_root_tag(head) in DUMP_ROOT_TAGS:
+        for nsu, schema, xml in read_distdfe_response(f).docs:
+            yield f"{ident}#NSU{nsu}", xml
+    else:
+        yield ident, f.read()
+
+
+def _iter_container_docs(path: str) -> Iterator[Tuple[str, bytes]]:
+    """
+    (identificação, conteúdo) de cada documento de um ZIP, TAR (compactado ou não) ou
+    resposta SOAP salva, um por vez: nada é extraído para o disco e o arquivo nunca é
+    carregado inteiro. Membros que são respostas SOAP também são abertos.
+    Identificação: arquivo::membro, com #NSU<n> para docZips.
+    """
+    if path.lower().endswith(".zip"):
+        with zipfile.ZipFile(path) as zf:
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                with zf.open(info) as f:
+                    yield from _iter_member_docs(f"{path}::{info.filename}", f)
+    elif path.lower().endswith(ARCHIVE_SUFFIXES):
+        with tarfile.open(path, "r|*") as tf:
+            for member in tf:
+                if not member.isfile():
+                    continue
+                with tf.extractfile(member) as f:
+                    yield from _iter_member_docs(f"{path}::{member.name}", f)
+    else:
+        with open(path, "rb") as f:
+            yield from _iter_member_docs(path, f)
+
+
+def _prepare_local_file(path: str,
+                        month_filter,
+                        aceitos: frozenset,
+                        known_sha: Optional[str] = None,
+                        validator: Optional[XsdValidator] = None
+                        ) -> Tuple[str, str, Optional[bytes], Optional[DocMeta], str, Optional[str], dict]:
+    """
+    Estágio de decode/parse/filtro de um arquivo local (pode rodar em processo worker).
+    aceitos: tipos (tag raiz) a manter; os demais são descartados pela tag lida dos
+    bytes, sem parse.
+    Retorna (path, status, xml_bytes, meta, detalhe, sha256, tempos); status em
+    "salvar", "evento", "descartado", "fora_do_mes", "inalterado", "invalido",
+    "conteiner", "erro_leitura" ou "erro".
+    "inalterado": o conteúdo tem o mesmo sha256 de known_sha (nem decodifica).
+    "invalido": reprovado por validator (XSD); detalhe traz o motivo.
+    "conteiner": ZIP/TAR ou resposta SOAP salva; o processo principal percorre os
+    documentos dele em streaming (_iter_container_docs), sem este arquivo ser lido inteiro.
+    tempos: segundos gastos por etapa (leitura, decode, filtro, parse, validacao), registrados
+    nas métricas pelo processo principal.
+    Não grava nada em disco: a gravação fica no processo principal.
+    """
+    tempos = {}
+    if path.lower().endswith(ARCHIVE_SUFFIXES):
+        return path, "conteiner", None, None, "", None, tempos
+    t0 = time.perf_counter()
+    try:
+        with open(path, "rb") as f:
+            data = f.read(4096)
+            if sniff_root_tag(data) in DUMP_ROOT_TAGS:
+                return path, "conteiner", None, None, "", None, tempos
+            data += f.read()
+    except Exception:
+        return path, "erro_leitura", None, None, traceback.format_exc(), None, tempos
+
+    sha = hashlib.sha256(data).hexdigest()
+    t1 = time.perf_counter()
+    tempos["leitura"] = t1 - t0
+    if known_sha is not None and sha == known_sha:
+        return path, "inalterado", None, None, "", sha, tempos
+    return _prepare_local_data(path, data, month_filter, aceitos, validator, sha, tempos)
+
+
+def _prepare_local_data(path: str,
+                        data: bytes,
+                        month_filter,
+                        aceitos: frozenset,
+                        validator: Optional[XsdValidator] = None,
+                        sha: Optional[str] = None,
+                        tempos: Optional[dict] = None
+                        ) -> Tuple[str, str, Optional[bytes], Optional[DocMeta], str, Optional[str], dict]:
+    """
+    decode/filtro/parse/validação do conteúdo de um documento já lido: um arquivo solto
+    (_prepare_local_file) ou um membro de ZIP/TAR/resposta SOAP. Mesmo retorno de
+    _prepare_local_file; path identifica o documento nos logs.
+    """
+    tempos = {} if tempos is None else tempos
+    if sha is None:
+        sha = hashlib.sha256(data).hexdigest()
+    t1 = time.perf_counter()
+    try:
+        # detecta se é docZip base64 ou xml já
+        xml_bytes = decode_local_document(data)
+        t0 = time.perf_counter()
+        tempos["decode"] = t0 - t1
+
+        tag = sniff_root_tag(xml_bytes)
+        if tag is not None and tag not in aceitos:
+            tempos["filtro"] = time.perf_counter() - t0
+            return path, "evento" if tag == "procEventoNFe" else "descartado", None, None, tag, sha, tempos
+
+        # pré-filtro barato: dhEmi lido dos bytes; o parse completo só roda
+        # para documentos dentro do intervalo (ou sem data legível)
+        date_range = as_date_range(month_filter)
+        if date_range:
+            dt = probe_emission_date(xml_bytes)
+            if dt is not None and not (date_range[0] <= dt <= date_range[1]):
+                tempos["filtro"] = time.perf_counter() - t0
+                return path, "fora_do_mes", None, None, "", sha, tempos
+        t1 = time.perf_counter()
+        tempos["filtro"] = t1 - t0
+
+        try:
+            meta = extract_doc_meta(xml_bytes)
+        except etree.XMLSyntaxError as e:
+            if validator is None:
+                raise
+            # truncado/malformado: com validação, vai para a quarentena em vez de erro
+            return path, "invalido", xml_bytes, None, f"XML malformado: {e}", sha, tempos
+        tag = meta.tag
+        t0 = time.perf_counter()
+        tempos["parse"] = t0 - t1
+
+        if tag not in aceitos:
+            return path, "evento" if tag == "procEventoNFe" else "descartado", None, meta, tag, sha, tempos
+
+        ok = matches_month_filter(xml_bytes, month_filter, meta=meta)
+        t1 = time.perf_counter()
+        tempos["filtro"] += t1 - t0
+        if not ok:
+            return path, "fora_do_mes", None, meta, tag, sha, tempos
+
+        if validator is not None:
+            motivo = validator.validate(xml_bytes, meta.schema)
+            tempos["validacao"] = time.perf_counter() - t1
+            if motivo:
+                return path, "invalido", xml_bytes, meta, motivo, sha, tempos
+
+        return path, "salvar", xml_bytes, meta, tag, sha, tempos
+    except Exception:
+        return path, "erro", None, None, traceback.format_exc(), sha, tempos
+
+
+def process_doczips_locais(scan_dir: str,
+                           dest_root: str,
+                           cnpj: str,
+                           month_filter,
+                           apenas_nfeproc: bool,
+                           workers: int = 1,
+                           index: Optional[ChaveIndex] = None,
+                           manifest: Optional[ScanManifest] = None,
+                           full_rescan: bool = False,
+                           router: Optional[DocRouter] = None,
+                           progresso: Optional[Callable[[dict], None]] = None,
+                           paths: Optional[List[str]] = None,
+                           executor: Optional[ProcessPoolExecutor] = None,
+                           parar: Optional[threading.Event] = None) -> Tuple[int, int]:
+    """
+    Lê todos os arquivos em scan_dir (docZip base64+gzip ou XML puro),
+    aplica filtros e salva nfeProc conforme regras.
+    month_filter: (ano, mes) ou intervalo (data_ini, data_fim) de emissão.
+    nfeProc é sempre salvo em DEST; com router (e sem apenas_nfeproc), os demais
+    tipos registrados nele (resumos, eventos) vão para os respectivos handlers.
+    Tipos sem destino são descartados pela tag raiz, antes do parse.
+    Com index, notas cuja chave já está indexada são puladas sem escrita em disco.
+    Com manifest, arquivos com mesmo tamanho/mtime (ou mesmo sha256) e resultado já
+    registrado para este destino não são lidos de novo; full_rescan ignora o
+    manifesto na leitura, mas continua atualizando-o.
+    Com workers > 1, decode/parse rodam num pool de processos; as gravações
+    (e o tratamento de colisão nNF.xml / CHAVE.xml / .dup) continuam no processo
+    principal, na ordem dos arquivos, para manter o resultado determinístico.
+    progresso, se informado, recebe os totais ao fim de cada lote de arquivos.
+    paths restringe o processamento a esses arquivos (micro-lotes do --watch), e
+    executor reaproveita um pool de processos já aberto (não é encerrado aqui).
+    parar, se sinalizado, encerra a varredura entre lotes (SIGTERM no --watch); o que
+    ficou para trás não entra no manifesto e é lido na próxima execução.
+    """
+    processados = 0
+    salvos = 0
+    pulados = 0
+
+    destino = f"{os.path.abspath(dest_root)}|{cnpj}"
+    aceitos = frozenset({"nfeProc"})
+    if router is not None and not apenas_nfeproc:
+        aceitos |= router.kinds()
+    filtro = ScanManifest.chave(filter_key(month_filter), aceitos, apenas_nfeproc, _VALIDATOR)
+
+    micro_lote = paths is not None
+    if paths is None:
+        paths = _list_scan_files(scan_dir)
+    proprio = executor is None and workers > 1
+    if proprio:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    # lotes limitados para não acumular todos os XMLs decodificados em memória
+    lote = max(1, workers) * 64
+
+    def _tratar(path, status, xml_bytes, meta, detalhe, sha, tempos) -> str:
+        """
+        Grava/encaminha um documento preparado; devolve o resultado para o manifesto.
+        """
+        nonlocal processados, salvos
+        name = os.path.basename(path)
+        for etapa, segundos in tempos.items():
+            _METRICS.observe(etapa, segundos, cnpj)
+        processados += 1
+        outcome = status
+        if status == "erro":
+            logging.error(f"Falha ao processar {path}:\n{detalhe}")
+        elif status == "evento":
+            logging.debug(f"[local] Descartando procEventoNFe: {name}")
+        elif status == "descartado":
+            logging.debug(f"[local] Descartando {detalhe} (sem destino para o tipo): {name}")
+        elif status == "fora_do_mes":
+            logging.debug(f"[local] Fora do mês filtrado: {name}")
+        elif status == "invalido":
+            _rejeitar(_VALIDATOR, cnpj, (meta.chave if meta else None) or os.path.splitext(name)[0],
+                      xml_bytes, detalhe, path)
+        elif meta.tag != "nfeProc":
+            try:
+                with _METRICS.timer("gravacao", cnpj):
+                    gravado = router.dispatch(meta.tag, None, None, xml_bytes)
+                outcome = "salvo" if gravado is not False else "ja_salvo"
+                if gravado is not False:
+                    salvos += 1
+                logging.debug(f"[local] {meta.tag} encaminhado: {name}")
+            except Exception as e:
+                outcome = "erro"
+                logging.exception(f"Falha ao processar {path}: {e}")
+        elif index is not None and meta.chave and index.get(meta.chave):
+            logging.debug(f"[local] Já salvo (chave {meta.chave}): {name}")
+            outcome = "ja_salvo"
+        else:
+            try:
+                with _METRICS.timer("gravacao", cnpj):
+                    dest_dir, fname = save_nfeproc(xml_bytes, dest_root=dest_root, cnpj=cnpj,
+                                                   dh_emi=None, meta=meta, index=index)
+                salvos += 1
+                outcome = "salvo"
+                logging.info(f"[local] Salvo: {os.path.join(dest_dir, fname)}")
+            except Exception as e:
+                outcome = "erro"
+                logging.exception(f"Falha ao processar {path}: {e}")
+
+        _METRICS.inc("documentos_locais", cnpj=cnpj, resultado=outcome)
+        return outcome
+
+    def _tratar_conteiner(path: str) -> str:
+        """
+        Percorre ZIP/TAR/resposta SOAP em streaming, em lotes de documentos pelo mesmo
+        caminho (_prepare_local_data + _tratar). "conteiner" se tudo correu bem, senão "erro".
+        """
+        outcome = "conteiner"
+        membros = _iter_container_docs(path)
+        n = 0
+        try:
+            while True:
+                bloco = list(islice(membros, lote))
+                if not bloco:
+                    break
+                ids = [ident for ident, _ in bloco]
+                datas = [data for _, data in bloco]
+                del bloco
+                if executor is not None:
+                    results = executor.map(_prepare_local_data, ids, datas, repeat(month_filter),
+                                           repeat(aceitos), repeat(_VALIDATOR), chunksize=16)
+                else:
+                    results = (_prepare_local_data(ident, data, month_filter, aceitos, _VALIDATOR)
+                               for ident, data in zip(ids, datas))
+                for res in results:
+                    if _tratar(*res) == "erro":
+                        outcome = "erro"
+                n += len(ids)
+        except Exception as e:
+            logging.error(f"Falha ao ler {path}: {e}")
+            outcome = "erro"
+        logging.info(f"[local] {path}: {n} documento(s) lido(s) do conteiner")
+        return outcome
+
+    try:
+        for i in range(0, len(paths), lote):
+            if parar is not None and parar.is_set():
+                logging.info(f"[local] Interrompido após {i} de {len(paths)} arquivo(s)")
+                break
+            chunk = []
+            known = []
+            stats = {}
+            for pth in paths[i:i + lote]:
+                if manifest is not None:
+                    try:
+                        st = os.stat(pth)
+                    except OSError:
+                        st = None
+                    if st is not None:
+                        stats[pth] = (st.st_size, st.st_mtime_ns)
+                        row = manifest.get(os.path.abspath(pth), destino)
+                        if not full_rescan and ScanManifest.is_done(row, filtro):
+                            if (row["size"], row["mtime_ns"]) == stats[pth]:
+                                pulados += 1
+                                _METRICS.inc("documentos_locais", cnpj=cnpj, resultado="inalterado")
+                                continue
+                            known.append(row["sha256"])
+                        else:
+                            known.append(None)
+                        chunk.append(pth)
+                        continue
+                chunk.append(pth)
+                known.append(None)
+
+            if executor is not None:
+                results = executor.map(_prepare_local_file, chunk,
+                                       repeat(month_filter), repeat(aceitos), known, repeat(_VALIDATOR),
+                                       chunksize=16)
+            else:
+                results = (_prepare_local_file(pth, month_filter, aceitos, k, _VALIDATOR)
+                           for pth, k in zip(chunk, known))
+
+            registros = []
+            for path, status, xml_bytes, meta, detalhe, sha, tempos in results:
+                if status == "erro_leitura":
+                    logging.error(f"Falha ao processar {path}:\n{detalhe}")
+                    continue
+                if status == "inalterado":
+                    pulados += 1
+                    _METRICS.inc("documentos_locais", cnpj=cnpj, resultado="inalterado")
+                    outcome = manifest.get(os.path.abspath(path), destino)["outcome"]
+                elif status == "conteiner":
+                    outcome = _tratar_conteiner(path)
+                else:
+                    outcome = _tratar(path, status, xml_bytes, meta, detalhe, sha, tempos)
+                if manifest is not None and path in stats:
+                    registros.append((os.path.abspath(path), destino, *stats[path], sha, outcome, filtro))
+
+            if manifest is not None:
+                manifest.record_many(registros)
+            if progresso is not None:
+                progresso({"arquivos": min(i + lote, len(paths)), "total": len(paths),
+                           "processados": processados, "salvos": salvos, "inalterados": pulados})
+    finally:
+        if proprio:
+            executor.shutdown()
+
+    if manifest is not None and not micro_lote:
+        logging.info(f"[local] Inalterados desde a última execução (manifesto): {pulados}")
+
+    return processados, salvos
+
+
+# ========= Modo watch (--watch) =========
+
+# nomes ignorados até serem renomeados para o nome final (gravação em andamento)
+WATCH_IGNORE_PREFIXES = (".",)
+WATCH_IGNORE_SUFFIXES = (".tmp", ".part", ".partial", ".crdownload", "~")
+
+
+class _InotifyBackend:
+    """
+    Eventos de arquivo via inotify (Linux), chamado direto da libc com ctypes.
+    Observa a árvore inteira: subpastas criadas depois passam a ser observadas
+    na hora, e os arquivos que já estiverem nelas são reportados.
+    """
+
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    nome = "inotify"
+
+    def __init__(self, root: str):
+        import ctypes
+        import ctypes.util
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError("inotify indisponível")
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 falhou")
+        self._wds = {}
+        self._add_tree(root)
+
+    def _add_tree(self, pasta: str) -> List[str]:
+        """
+        Observa pasta e subpastas; devolve os arquivos já existentes nelas.
+        """
+        existentes = []
+        for root_dir, dirs, files in os.walk(pasta):
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(root_dir), self.MASK)
+            if wd >= 0:
+                self._wds[wd] = root_dir
+            existentes.extend(os.path.join(root_dir, n) for n in files)
+        return existentes
+
+    def poll(self, timeout: float) -> Tuple[List[str], bool]:
+        """
+        Espera até timeout segundos. Retorna (arquivos tocados, overflow); com overflow
+        eventos se perderam e a árvore deve ser relistada.
+        """
+        import select
+        import struct
+        pronto, _, _ = select.select([self.fd], [], [], timeout)
+        if not pronto:
+            return [], False
+        tocados, overflow = [], False
+        try:
+            buf = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return [], False
+        pos = 0
+        while pos + 16 <= len(buf):
+            wd, mask, _cookie, tam = struct.unpack_from("iIII", buf, pos)
+            nome = buf[pos + 16:pos + 16 + tam].rstrip(b"\0")
+            pos += 16 + tam
+            if mask & self.IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            if mask & self.IN_IGNORED:
+                self._wds.pop(wd, None)
+                continue
+            pasta = self._wds.get(wd)
+            if pasta is None or not nome:
+                continue
+            path = os.path.join(pasta, os.fsdecode(nome))
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    tocados.extend(self._add_tree(path))
+            else:
+                tocados.append(path)
+        return tocados, overflow
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class _PollBackend:
+    """
+    Fallback sem inotify: relista a árvore a cada intervalo e reporta arquivos novos
+    ou com tamanho/mtime alterado.
+    """
+
+    nome = "poll"
+
+    def __init__(self, root: str, intervalo: float):
+        self.root = root
+        self.intervalo = intervalo
+        self._visto = self._snapshot()
+        self._proximo = time.monotonic() + intervalo
+
+    def _snapshot(self) -> dict:
+        snap = {}
+        for path in _list_scan_files(self.root):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            snap[path] = (st.st_size, st.st_mtime_ns)
+        return snap
+
+    def poll(self, timeout: float) -> Tuple[List[str], bool]:
+        espera = self._proximo - time.monotonic()
+        if espera > timeout:
+            time.sleep(timeout)
+            return [], False
+        time.sleep(max(0.0, espera))
+        self._proximo = time.monotonic() + self.intervalo
+        atual = self._snapshot()
+        tocados = [p for p, sig in atual.items() if self._visto.get(p) != sig]
+        self._visto = atual
+        return tocados, False
+
+    def close(self) -> None:
+        pass
+
+
+class DirWatcher:
+    """
+    Arquivos novos ou alterados em root, entregues só depois de debounce segundos sem
+    mudança de tamanho/mtime (o produtor pode ainda estar gravando). Nomes temporários
+    (WATCH_IGNORE_PREFIXES/SUFFIXES) são ignorados até o rename final.
+    backend: "inotify", "poll" ou "auto" (inotify quando disponível).
+    """
+
+    def __init__(self, root: str, debounce: float = 1.0, backend: str = "auto", intervalo_poll: float = 5.0):
+        self.root = root
+        self.debounce = debounce
+        self._pendentes = {}   # path -> (último evento, (tamanho, mtime) naquele momento)
+        self.backend = None
+        if backend in ("auto", "inotify"):
+            try:
+                self.backend = _InotifyBackend(root)
+            except OSError as e:
+                if backend == "inotify":
+                    raise
+                logging.info(f"[watch] inotify indisponível ({e}); usando polling a cada {intervalo_poll}s")
+        if self.backend is None:
+            self.backend = _PollBackend(root, intervalo_poll)
+
+    @staticmethod
+    def ignorado(path: str) -> bool:
+        nome = os.path.basename(path)
+        return nome.startswith(WATCH_IGNORE_PREFIXES) or nome.endswith(WATCH_IGNORE_SUFFIXES)
+
+    @staticmethod
+    def _assinatura(path: str) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime_ns
+
+    def tocar(self, paths: List[str]) -> None:
+        agora = time.monotonic()
+        for path in paths:
+            if not self.ignorado(path):
+                self._pendentes[path] = (agora, self._assinatura(path))
+
+    def prontos(self, limite: Optional[int] = None) -> List[str]:
+        """
+        Retira e devolve (em ordem) os pendentes estáveis há pelo menos debounce segundos.
+        """
+        agora = time.monotonic()
+        saida = []
+        for path, (quando, sig) in sorted(self._pendentes.items()):
+            if limite is not None and len(saida) >= limite:
+                break
+            if agora - quando < self.debounce:
+                continue
+            atual = self._assinatura(path)
+            if atual is None:
+                del self._pendentes[path]
+            elif atual != sig:
+                # ainda mudando: recomeça a contagem
+                self._pendentes[path] = (agora, atual)
+            else:
+                del self._pendentes[path]
+                saida.append(path)
+        return saida
+
+    def esperar(self, timeout: float) -> None:
+        """
+        Recolhe eventos por até timeout segundos. Em overflow do inotify, a árvore
+        inteira volta a ser candidata (o manifesto pula o que não mudou).
+        """
+        tocados, overflow = self.backend.poll(timeout)
+        if overflow:
+            logging.warning("[watch] fila de eventos do inotify estourou; relistando a pasta")
+            tocados = _list_scan_files(self.root)
+        self.tocar(tocados)
+
+    def pendentes(self) -> int:
+        return len(self._pendentes)
+
+    def close(self) -> None:
+        self.backend.close()
+
+
+def watch_scan_dir(scan_dir: str,
+                   dest_root: str,
+                   cnpj: str,
+                   month_filter,
+                   apenas_nfeproc: bool,
+                   workers: int = 1,
+                   index: Optional[ChaveIndex] = None,
+                   manifest: Optional[ScanManifest] = None,
+                   router: Optional[DocRouter] = None,
+                   debounce: float = 1.0,
+                   backend: str = "auto",
+                   intervalo_poll: float = 5.0,
+                   lote_max: int = 256,
+                   full_rescan: bool = False,
+                   parar: Optional[threading.Event] = None) -> Tuple[int, int]:
+    """
+    Modo contínuo do --scan-dir: processa o que já existe (incremental pelo manifesto) e
+    depois cada arquivo que chegar, em micro-lotes de até lote_max arquivos, pelo mesmo
+    caminho de process_doczips_locais (decode/filtro/gravação, índice, manifesto, router).
+    Roda até parar ser sinalizado (ou Ctrl+C/SIGTERM). Retorna (processados, salvos) acumulados.
+    """
+    parar = parar or threading.Event()
+    sigterm_anterior = None
+    if threading.current_thread() is threading.main_thread():
+        # daemon (systemd etc.): SIGTERM encerra depois do micro-lote em andamento
+        sigterm_anterior = signal.signal(signal.SIGTERM, lambda *_: parar.set())
+    watcher = DirWatcher(scan_dir, debounce=debounce, backend=backend, intervalo_poll=intervalo_poll)
+    logging.info(f"[watch] Observando {scan_dir} ({watcher.backend.nome}, debounce {debounce}s)")
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    comum = dict(dest_root=dest_root, cnpj=cnpj, month_filter=month_filter, apenas_nfeproc=apenas_nfeproc,
+                 workers=workers, index=index, manifest=manifest, router=router, executor=executor)
+    total_proc = total_save = 0
+    try:
+        total_proc, total_save = process_doczips_locais(scan_dir, full_rescan=full_rescan, parar=parar, **comum)
+        while not parar.is_set():
+            # acorda a tempo de liberar o próximo pendente assim que o debounce vencer
+            watcher.esperar(min(debounce, 1.0) if watcher.pendentes() else 1.0)
+            while not parar.is_set():
+                lote = watcher.prontos(lote_max)
+                if not lote:
+                    break
+                inicio = time.perf_counter()
+                p, s = process_doczips_locais(scan_dir, paths=lote, **comum)
+                total_proc += p
+                total_save += s
+                _METRICS.inc("watch_lotes", cnpj=cnpj)
+                logging.info(f"[watch] {len(lote)} arquivo(s): processados={p}, salvos={s} "
+                             f"em {time.perf_counter() - inicio:.2f}s")
+    except KeyboardInterrupt:
+        logging.info("[watch] Interrompido.")
+    finally:
+        watcher.close()
+        if executor is not None:
+            executor.shutdown()
+        if sigterm_anterior is not None:
+            signal.signal(signal.SIGTERM, sigterm_anterior)
+    return total_proc, total_save
+
+
+# ========= Agendador multi-CNPJ =========
+
+def load_tenants(path: str, exigir_certificado: bool = True) -> List[dict]:
+    """
+    Lê o manifesto de CNPJs (JSON: lista de objetos com cnpj, uf, amb, cert_pfx, cert_pass).
+    amb é opcional (padrão prod); dest opcional sobrescreve o --dest do CNPJ.
+    Com exigir_certificado=False (endpoint http de teste), cert_pfx/cert_pass são opcionais.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        raw = json.load(f)
+    if not isinstance(raw, list):
+        raise SystemExit(f"Manifesto {path} deve conter uma lista de CNPJs.")
+
+    tenants = []
+    for i, item in enumerate(raw):
+        obrigatorios = ("cnpj", "uf", "cert_pfx", "cert_pass") if exigir_certificado else ("cnpj", "uf")
+        for req in obrigatorios:
+            if not item.get(req):
+                raise SystemExit(f"Manifesto {path}: item {i} sem '{req}'.")
+        uf = item["uf"].upper()
+        if uf not in UF_CODE_MAP:
+            raise SystemExit(f"Manifesto {path}: UF inválida no item {i}: {item['uf']}")
+        tenants.append({
+            "cnpj": re.sub(r"\D", "", item["cnpj"]),
+            "uf": uf,
+            "amb": item.get("amb") or item.get("ambiente") or "prod",
+            "cert_pfx": item.get("cert_pfx"),
+            "cert_pass": item.get("cert_pass"),
+            "dest": item.get("dest"),
+        })
+    return tenants
+
+
+def _run_tenant(tenant: dict, dest_root: str, filtro_ano_mes: Optional[str], verbose: bool,
+                index: Optional[ChaveIndex] = None,
+                sinks: Optional[dict] = None,
+                apenas_nfeproc: bool = False,
+                pipeline_workers: int = 0,
+                policy: Optional[PacingPolicy] = None,
+                reparar: bool = False) -> Tuple[int, int]:
+    """
+    Executa o laço de NSU (baixar_online) de um CNPJ do manifesto;
+    com reparar, só o reparo das lacunas do livro (reparar_lacunas).
+    """
+    cnpj = tenant["cnpj"]
+    dest = tenant["dest"] or dest_root
+    if tenant["dest"] and index is not None:
+        # índice fica na raiz de destino do próprio CNPJ
+        index = ChaveIndex(dest)
+
+    def _salvar(xml_txt: str, raw: bytes):
+        return salvar_nfeproc_renomeando(xml_txt, raw, dest, cnpj, index=index)
+
+    if reparar:
+        p, s, _ = reparar_lacunas(cnpj, tenant["uf"], tenant["amb"], tenant["cert_pfx"], tenant["cert_pass"],
+                                  build_router(cnpj, _salvar, sinks, apenas_nfeproc), verbose, policy)
+        return p, s
+
+    return baixar_online(
+        cnpj=cnpj,
+        uf=tenant["uf"],
+        ambiente=tenant["amb"],
+        cert_pfx=tenant["cert_pfx"],
+        cert_pass=tenant["cert_pass"],
+        filtro_ano_mes=filtro_ano_mes,
+        salvar_xml_fn=_salvar,
+        verbose=verbose,
+        router=build_router(cnpj, _salvar, sinks, apenas_nfeproc),
+        pipeline_workers=pipeline_workers,
+        policy=policy,
+    )
+
+
+def run_tenants(tenants: List[dict],
+                dest_root: str,
+                filtro_ano_mes: Optional[str],
+                max_paralelo: int = 4,
+                continuo: bool = False,
+                verbose: bool = False,
+                index: Optional[ChaveIndex] = None,
+                sinks: Optional[dict] = None,
+                apenas_nfeproc: bool = False,
+                pipeline_workers: int = 0,
+                policy: Optional[PacingPolicy] = None) -> Tuple[int, int]:
+    """
+    Roda o laço de NSU de vários CNPJs em paralelo (pool de threads limitado a max_paralelo).
+    A fila é ordenada pelo next_allowed_ts de load_state: assim que uma vaga abre,
+    o próximo CNPJ liberado é iniciado.
+    Sem continuo, cada CNPJ roda no máximo uma vez e os que estão em espera são pulados;
+    com continuo, cada CNPJ volta para a fila com o novo next_allowed_ts.
+    Com leases (set_lease_store), vários nós podem rodar o mesmo manifesto: um CNPJ com
+    lease de outro nó é pulado e, com continuo, volta à fila para o vencimento desse lease.
+    """
+    total_proc = 0
+    total_save = 0
+
+    fila = []
+    now = time.time()
+    for i, t in enumerate(tenants):
+        ts = load_state(t["cnpj"], t["amb"])["next_allowed_ts"]
+        if ts > now and not continuo:
+            logging.info(f"Aguardar {int(ts - now)} segundos antes de nova consulta para {t['cnpj']}/{t['amb']}")
+            continue
+        heapq.heappush(fila, (ts, i))
+
+    with ThreadPoolExecutor(max_workers=max_paralelo) as ex:
+        running = {}
+        while fila or running:
+            now = time.time()
+            while fila and len(running) < max_paralelo and fila[0][0] <= now:
+                _, i = heapq.heappop(fila)
+                t = tenants[i]
+                logging.info(f"[agendador] Iniciando {t['cnpj']}/{t['amb']}")
+                running[ex.submit(_run_tenant, t, dest_root, filtro_ano_mes, verbose,
+                                   index, sinks, apenas_nfeproc, pipeline_workers, policy)] = i
+
+            if not running:
+                # ninguém liberado ainda: dorme até o próximo next_allowed_ts
+                time.sleep(max(0.0, fila[0][0] - time.time()))
+                continue
+
+            timeout = None
+            if fila and len(running) < max_paralelo:
+                timeout = max(0.0, fila[0][0] - time.time())
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for fut in done:
+                i = running.pop(fut)
+                t = tenants[i]
+                retry_ts = None
+                try:
+                    p, s = fut.result()
+                    total_proc += p
+                    total_save += s
+                    logging.info(f"[agendador] {t['cnpj']}/{t['amb']}: processados={p}, salvos={s}")
+                except LeaseOcupado as e:
+                    # outro nó está com o CNPJ: tenta de novo quando o lease dele vencer
+                    logging.info(f"[agendador] {t['cnpj']}/{t['amb']} ignorado: {e}")
+                    retry_ts = e.lease.expira_em + random.uniform(0, 1)
+                except Exception as e:
+                    logging.exception(f"[agendador] Falha no CNPJ {t['cnpj']}/{t['amb']}: {e}")
+                    retry_ts = time.time() + TENANT_RETRY_SECONDS
+                if continuo:
+                    ts = load_state(t["cnpj"], t["amb"])["next_allowed_ts"]
+                    heapq.heappush(fila, (max(ts, retry_ts or 0), i))
+
+    return total_proc, total_save
+
+
+# ========= Modo serviço (--serve) =========
+
+class ServeContext:
+    """
+    Estado mantido entre jobs do modo --serve: índices de chave por destino,
+    manifestos de scan e policy de ritmo. O pool de sessões HTTPS e o backend de
+    estado são os globais do módulo, também reaproveitados entre jobs.
+    """
+
+    def __init__(self, args: argparse.Namespace, policy: PacingPolicy):
+        self.args = args
+        self.policy = policy
+        self._lock = threading.Lock()
+        self._indices = {}
+        self._manifests = {}
+
+    def index(self, dest_root: str) -> Optional[ChaveIndex]:
+        if self.args.sem_indice:
+            return None
+        key = os.path.abspath(dest_root)
+        with self._lock:
+            if key not in self._indices:
+                self._indices[key] = ChaveIndex(dest_root)
+            return self._indices[key]
+
+    def manifest(self, path: Optional[str]) -> ScanManifest:
+        key = os.path.abspath(path or os.path.join(STATE_DIR, "scan_manifest.sqlite"))
+        with self._lock:
+            if key not in self._manifests:
+                self._manifests[key] = ScanManifest(key)
+            return self._manifests[key]
+
+
+def _job_filter(job: dict):
+    """
+    Filtro de emissão do job: "mes" (AAAA-MM), "ultimo_mes" ou "de"/"ate" (AAAA-MM-DD).
+    """
+    month_tuple = month_from_arg(job.get("mes"), bool(job.get("ultimo_mes")))
+    date_range = range_from_args(job.get("de"), job.get("ate"))
+    if month_tuple and date_range:
+        raise ValueError("use mes/ultimo_mes ou de/ate, não ambos")
+    return month_tuple or date_range
+
+
+def _job_router(job: dict, ctx: ServeContext, dest_root: str, cnpj: str) -> DocRouter:
+    index = ctx.index(dest_root)
+
+    def _salvar(xml_txt: str, raw: bytes):
+        return salvar_nfeproc_renomeando(xml_txt, raw, dest_root, cnpj, index=index)
+
+    sinks = {
+        "resNFe": job.get("dest_resumos"),
+        "procEventoNFe": job.get("dest_eventos"),
+        "resEvento": job.get("dest_eventos"),
+    }
+    return build_router(cnpj, _salvar, sinks, bool(job.get("apenas_nfeproc")))
+
+
+def run_job(job: dict, ctx: ServeContext, emit: Callable[[dict], None]) -> dict:
+    """
+    Executa um job do modo --serve e devolve o resultado. Operações:
+      baixar  — cnpj, uf, cert_pfx, cert_pass, dest [, amb, mes|ultimo_mes|de/ate,
+                apenas_nfeproc, pipeline, dest_resumos, dest_eventos]
+      scan    — scan_dir, dest, cnpj [, workers, full_rescan, manifesto, filtros e destinos]
+      consultar — dest [, cnpj, emitente, destinatario, mes|ultimo_mes|de/ate,
+                valor_min, valor_max, chave, limite] (catálogo de DEST)
+      estado  — lista os estados gravados
+      ping    — verificação de vida
+    emit recebe os eventos de progresso durante a execução.
+    """
+    op = job.get("op")
+    if op == "ping":
+        return {"pong": True}
+    if op == "estado":
+        return {"estados": _STATE_STORE.list()}
+    if op == "consultar":
+        if not job.get("dest"):
+            raise ValueError("campos obrigatórios ausentes: dest")
+        digitos = {k: re.sub(r"\D", "", str(job[k])) for k in ("cnpj", "emitente", "destinatario") if job.get(k)}
+        notas = (ctx.index(job["dest"]) or ChaveIndex(job["dest"])).consultar(
+            emissao=as_date_range(_job_filter(job)),
+            valor_min=job.get("valor_min"),
+            valor_max=job.get("valor_max"),
+            chave=job.get("chave"),
+            limite=job.get("limite"),
+            **digitos,
+        )
+        return {"notas": notas}
+
+    def _progresso(dados: dict):
+        emit({"evento": "progresso", **dados})
+
+    obrigatorios = {"baixar": ("cnpj", "uf", "dest"), "scan": ("scan_dir", "dest", "cnpj")}.get(op, ())
+    if op == "baixar" and requires_certificate(job.get("amb") or ctx.args.amb):
+        obrigatorios += ("cert_pfx", "cert_pass")
+    missing = [k for k in obrigatorios if not job.get(k)]
+    if op not in ("baixar", "scan"):
+        raise ValueError(f"operação desconhecida: {op!r}")
+    if missing:
+        raise ValueError(f"campos obrigatórios ausentes: {', '.join(missing)}")
+
+    cnpj = re.sub(r"\D", "", str(job["cnpj"]))
+    dest_root = job["dest"]
+    ensure_dir(dest_root)
+    emission_filter = _job_filter(job)
+    router = _job_router(job, ctx, dest_root, cnpj)
+
+    if op == "baixar":
+        uf = job["uf"].upper()
+        if uf not in UF_CODE_MAP:
+            raise ValueError(f"UF inválida: {job['uf']}")
+        p, s = baixar_online(
+            cnpj=cnpj,
+            uf=uf,
+            ambiente=job.get("amb") or ctx.args.amb,
+            cert_pfx=job.get("cert_pfx"),
+            cert_pass=job.get("cert_pass"),
+            filtro_ano_mes=filter_key(emission_filter) or None,
+            salvar_xml_fn=None,
+            verbose=ctx.args.verbose,
+            router=router,
+            pipeline_workers=int(job.get("pipeline", ctx.args.pipeline)),
+            pipeline_fila=ctx.args.pipeline_fila,
+            policy=ctx.policy,
+            progresso=_progresso,
+        )
+    else:
+        p, s = process_doczips_locais(
+            scan_dir=job["scan_dir"],
+            dest_root=dest_root,
+            cnpj=cnpj,
+            month_filter=emission_filter,
+            apenas_nfeproc=bool(job.get("apenas_nfeproc")),
+            workers=int(job.get("workers", ctx.args.workers)),
+            index=ctx.index(dest_root),
+            manifest=ctx.manifest(job.get("manifesto") or ctx.args.scan_manifest),
+            full_rescan=bool(job.get("full_rescan")),
+            router=router,
+            progresso=_progresso,
+        )
+    return {"processados": p, "salvos": s}
+
+
+class _JobLogHandler(logging.Handler):
+    """
+    Repassa os logs emitidos pela thread de um job como eventos "log" desse job.
+    """
+
+    def __init__(self):
+        super().__init__(logging.INFO)
+        self.local = threading.local()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        emit = getattr(self.local, "emit", None)
+        if emit is not None:
+            emit({"evento": "log", "nivel": record.levelname, "msg": record.getMessage()})
+
+
+def serve_stream(rfile, wfile, ctx: ServeContext, max_jobs: int = 4) -> None:
+    """
+    Lê jobs JSON (um por linha) de rfile e escreve em wfile, também uma linha JSON por
+    evento: aceito, progresso, log, resultado ou erro, todos com o "id" do job.
+    Até max_jobs rodam em paralelo; {"op": "sair"} encerra após os jobs em andamento.
+    """
+    out_lock = threading.Lock()
+    log_handler = _JobLogHandler()
+    logging.getLogger().addHandler(log_handler)
+
+    def _write(obj: dict):
+        line = json.dumps(obj, ensure_ascii=False, default=str) + "\n"
+        with out_lock:
+            wfile.write(line)
+            wfile.flush()
+
+    def _executar(job: dict):
+        job_id = job.get("id")
+
+        def emit(evento: dict):
+            _write({"id": job_id, **evento})
+
+        log_handler.local.emit = emit
+        inicio = time.time()
+        try:
+            resultado = run_job(job, ctx, emit)
+            emit({"evento": "resultado", "duracao": round(time.time() - inicio, 3), **resultado})
+        except (Exception, SystemExit) as e:
+            logging.debug(traceback.format_exc())
+            emit({"evento": "erro", "erro": str(e) or type(e).__name__})
+        finally:
+            log_handler.local.emit = None
+
+    executor = ThreadPoolExecutor(max_workers=max(1, max_jobs), thread_name_prefix="job")
+    try:
+        for line in rfile:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                job = json.loads(line)
+                if not isinstance(job, dict):
+                    raise ValueError("job deve ser um objeto JSON")
+            except ValueError as e:
+                _write({"id": None, "evento": "erro", "erro": f"JSON inválido: {e}"})
+                continue
+            if job.get("op") == "sair":
+                break
+            _write({"id": job.get("id"), "evento": "aceito"})
+            executor.submit(_executar, job)
+    finally:
+        executor.shutdown(wait=True)
+        logging.getLogger().removeHandler(log_handler)
+
+
+def serve(ctx: ServeContext, socket_path: Optional[str] = None, max_jobs: int = 4) -> None:
+    """
+    Processo de longa duração: atende jobs em stdin/stdout ou, com socket_path,
+    num socket Unix local (uma sessão JSON lines por conexão).
+    """
+    if not socket_path:
+        logging.info("Modo serviço: lendo jobs em stdin.")
+        serve_stream(sys.stdin, sys.stdout, ctx, max_jobs)
+        return
+
+    import socketserver
+
+    class _Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            rfile = io.TextIOWrapper(self.rfile, encoding="utf-8")
+            wfile = io.TextIOWrapper(self.wfile, encoding="utf-8", write_through=True)
+            serve_stream(rfile, wfile, ctx, max_jobs)
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    with socketserver.ThreadingUnixStreamServer(socket_path, _Handler) as server:
+        server.daemon_threads = True
+        logging.info(f"Modo serviço: escutando em {socket_path}")
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(socket_path)
+
+
+# ========= CLI =========
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(
         description="Baixar/Processar NF-e (nfeProc) via NFeDistribuicaoDFe e/ou docZip local.",
         formatter_class=argparse.RawTextHelpFormatter,
     )
-    p.add_argument("--cnpj", required=True, help="CNPJ do interessado (apenas dígitos).")
-    p.add_argument("--dest", required=True, help="Diretório de destino (será organizado como DEST/CNPJ/AAAA/MM).")
+    p.add_argument("--cnpj", help="CNPJ do interessado (apenas dígitos). Obrigatório sem --tenants.")
+    p.add_argument("--dest", help="Diretório de destino (será organizado como DEST/CNPJ/AAAA/MM).")
+    p.add_argument("--armazenamento", choices=STORAGE_MODES, default="arquivos",
+                   help="Gravação dos nfeProc: 'arquivos' (DEST/CNPJ/AAAA/MM/nNF.xml) ou 'pacote'\n"
+                        "(DEST/CNPJ/AAAA/MM.pack + MM.idx, um pacote por CNPJ/mês) ou 'gz'/'zst' (nNF.xml.gz,\n"
+                        "nNF.xml.zst: cada arquivo compactado; zst requer zstandard) (default: arquivos).")
+    p.add_argument("--exportar-pacotes", metavar="DIR",
+                   help="Desempacota os pacotes de --dest para DIR no layout de pastas e termina.")
 
     # Mês de emissão
     p.add_argument("--mes-emissao", help="Filtro do mês de emissão no formato AAAA-MM (ex.: 2025-11).")
     p.add_argument("--ultimo-mes", action="store_true", help="Filtrar pelo último mês (com base na data atual).")
+    p.add_argument("--emissao-de", help="Início do intervalo de emissão AAAA-MM-DD (inclusive).")
+    p.add_argument("--emissao-ate", help="Fim do intervalo de emissão AAAA-MM-DD (inclusive).")
 
     # Modo on-line
     p.add_argument("--baixar-online", action="store_true", help="Ativa o download on-line via NFeDistribuicaoDFe.")
     p.add_argument("--uf", help="UF do autor (ex.: SP, RJ, MG) – obrigatório com --baixar-online.")
     p.add_argument("--amb", choices=["prod", "hom"], default="prod", help="Ambiente (prod|hom). Padrão: prod.")
+    p.add_argument("--endpoint", metavar="URL",
+                   help="Substitui o endpoint do NFeDistribuicaoDFe (ex.: mockSefazDistDFe.py local). "
+                        "Com http://, o certificado é dispensado.")
     p.add_argument("--cert-pfx", help="Caminho do certificado A1 (.pfx) – obrigatório com --baixar-online.")
     p.add_argument("--cert-pass", help="Senha do .pfx – obrigatório com --baixar-online.")
-    p.add_argument("--max-chamadas", type=int, default=20, help="Limite de iterações da distribuição (default: 20).")
+    p.add_argument("--max-chamadas", type=int, default=20,
+                   help="Limite de iterações da distribuição por execução (default: 20; 0 = sem limite).")
+    p.add_argument("--intervalo", type=float, default=1.2, help="Intervalo mínimo entre chamadas, em segundos (default: 1.2).")
+    p.add_argument("--cooldown-em-dia", type=float, default=3600,
+                   help="Espera após ficar em dia (137 ou ultNSU == maxNSU), em segundos. A NT 2014.002 pede 1h (default: 3600).")
+    p.add_argument("--cooldown-pendente", type=float, default=60,
+                   help="Espera quando a execução para em --max-chamadas com documentos pendentes (default: 60).")
+    p.add_argument("--sessao-ociosa", type=float, default=SESSION_IDLE_SECONDS,
+                   help=f"Fecha sessões/certificados sem uso há mais de N segundos (default: {SESSION_IDLE_SECONDS}).")
+    p.add_argument("--backoff-656", type=float, default=3600,
+                   help="Espera após cStat 656, dobrada a cada bloqueio seguido (default: 3600, teto 6h).")
+    p.add_argument("--pipeline", type=int, default=0, metavar="N",
+                   help="Sobrepõe busca e gravação: N threads decodificam/gravam enquanto a busca segue (default: 0, sequencial).")
+    p.add_argument("--pipeline-fila", type=int, default=4,
+                   help="Lotes aguardando gravação antes de a busca esperar (default: 4).")
+
+    # Vários CNPJs
+    p.add_argument("--tenants", help="Manifesto JSON com vários CNPJs (cnpj, uf, amb, cert_pfx, cert_pass) para download on-line.")
+    p.add_argument("--max-paralelo", type=int, default=4, help="CNPJs consultados ao mesmo tempo com --tenants (default: 4).")
+    p.add_argument("--continuo", action="store_true",
+                   help="Com --tenants, não termina: cada CNPJ volta para a fila ao fim do seu next_allowed_ts.")
 
     # Modo local (docZip)
     p.add_argument("--scan-dir", help="Pasta contendo docZip (base64+gzip) ou XMLs para processamento local.")
+    p.add_argument("--watch", action="store_true",
+                   help="Com --scan-dir, não termina: processa cada arquivo novo assim que ele chega (inotify ou polling).")
+    p.add_argument("--watch-debounce", type=float, default=1.0,
+                   help="Segundos sem mudança de tamanho/mtime antes de ler um arquivo novo (default: 1).")
+    p.add_argument("--watch-backend", choices=["auto", "inotify", "poll"], default="auto",
+                   help="Fonte de eventos do --watch: inotify (Linux), poll (relista a pasta) ou auto (default).")
+    p.add_argument("--watch-poll", type=float, default=5.0,
+                   help="Intervalo de relistagem do backend poll, em segundos (default: 5).")
+    p.add_argument("--full-rescan", action="store_true",
+                   help="Relê todos os arquivos do --scan-dir, ignorando o manifesto de execuções anteriores.")
+    p.add_argument("--scan-manifest",
+                   help="Arquivo SQLite do manifesto do --scan-dir (default: state/scan_manifest.sqlite).")
+    p.add_argument("--workers", type=int, default=1,
+                   help="Processos para decode/parse no --scan-dir (default: 1, sem pool).")
+
+    # Estado
+    p.add_argument("--state-backend", choices=["json", "sqlite"], default="json",
+                   help="Onde guardar ultNSU/next_allowed_ts: json (um arquivo por CNPJ) ou sqlite. Padrão: json.")
+    p.add_argument("--state-db", help="Arquivo SQLite do estado (default: state/estado.sqlite).")
+    p.add_argument("--importar-estado-json", nargs="?", const=STATE_DIR, metavar="DIR",
+                   help="Importa os state/{cnpj}_{amb}.json para o backend escolhido e sai.")
+    p.add_argument("--listar-estado", action="store_true",
+                   help="Lista o estado de todos os CNPJs (atraso até maxNSU, espera restante) e sai.")
+    p.add_argument("--lacunas", action="store_true",
+                   help="Relatório do livro de NSU: NSUs não recebidos até o cursor e recebidos sem gravação\n"
+                        "(todos os CNPJs do estado, ou só --cnpj) e sai.")
+    p.add_argument("--reparar-lacunas", action="store_true",
+                   help="Pede de novo, via consNSU, só os NSUs em lacuna no livro (--cnpj com --uf/certificado, ou --tenants).\n"
+                        "Limitado por --intervalo e --max-chamadas.")
+
+    # Vários nós
+    p.add_argument("--lease-backend", choices=["nenhum", "arquivo", "sqlite"], default="nenhum",
+                   help="Coordena vários hosts/containers: cada CNPJ só é baixado por quem tiver o lease.\n"
+                        "arquivo (pasta compartilhada) ou sqlite. Use junto com um estado compartilhado. Padrão: nenhum.")
+    p.add_argument("--lease-path",
+                   help="Pasta (arquivo) ou arquivo SQLite (sqlite) dos leases (default: state/leases ou state/leases.sqlite).")
+    p.add_argument("--lease-ttl", type=float, default=LEASE_TTL_SECONDS,
+                   help=f"Validade do lease em segundos, renovado a cada TTL/3 (default: {LEASE_TTL_SECONDS}).")
+    p.add_argument("--node-id", dest="no_id", help="Identificação deste nó nos leases (default: host:pid).")
+    p.add_argument("--listar-leases", action="store_true",
+                   help="Lista os leases (dono, tempo restante) e sai.")
+
+    # Métricas e perfil
+    p.add_argument("--metrics-file", metavar="PATH",
+                   help="Grava métricas por etapa e por CNPJ: texto Prometheus, ou JSON se PATH terminar em .json.")
+    p.add_argument("--metrics-intervalo", type=float, default=30,
+                   help="Regrava --metrics-file a cada N segundos durante a execução (default: 30).")
+    p.add_argument("--profile", metavar="PATH",
+                   help="Roda sob cProfile e grava as estatísticas em PATH (thread principal).")
+
+    # Modo serviço
+    p.add_argument("--serve", action="store_true",
+                   help="Mantém o processo ativo lendo jobs JSON (um por linha) em stdin; respostas em stdout.")
+    p.add_argument("--serve-socket", metavar="PATH",
+                   help="Como --serve, mas atende conexões num socket Unix local.")
+
+    # Índice de chaves
+    p.add_argument("--sem-indice", action="store_true",
+                   help="Não usar o índice de chaves DEST/.indice.sqlite (deduplicação por chave de acesso).")
+    p.add_argument("--reconstruir-indice", action="store_true",
+                   help="Indexa os nfeProc já existentes em DEST antes de processar.")
+
+    # Catálogo (consulta sem reler a árvore)
+    p.add_argument("--consultar", action="store_true",
+                   help="Consulta o catálogo de DEST/.indice.sqlite e sai. Filtros: --cnpj, --emitente, --destinatario,\n"
+                        "--mes-emissao/--ultimo-mes ou --emissao-de/--emissao-ate, --valor-min, --valor-max, --chave.")
+    p.add_argument("--emitente", help="Com --consultar: CNPJ/CPF do emitente.")
+    p.add_argument("--destinatario", help="Com --consultar: CNPJ/CPF do destinatário.")
+    p.add_argument("--valor-min", type=float, help="Com --consultar: vNF mínimo.")
+    p.add_argument("--valor-max", type=float, help="Com --consultar: vNF máximo.")
+    p.add_argument("--chave", help="Com --consultar: chave de acesso.")
+    p.add_argument("--limite", type=int, help="Com --consultar: máximo de linhas.")
+    p.add_argument("--json", action="store_true", help="Com --consultar: uma linha JSON por nota em vez da tabela.")
+
+    # Validação
+    p.add_argument("--validar-xsd", action="store_true",
+                   help="Valida cada documento contra o XSD do seu schema antes de gravar; inválidos vão para --quarentena.")
+    p.add_argument("--xsd-dir", action="append", default=[], metavar="DIR",
+                   help="Pasta com XSDs (repetível; ex.: pacote de liberação PL_009). A pasta do script é sempre incluída.")
+    p.add_argument("--quarentena", default=QUARANTINE_DIR,
+                   help=f"Pasta dos documentos reprovados, com o motivo em .motivo.txt (default: {QUARANTINE_DIR}).")
 
     # Regras
     p.add_argument("--apenas-nfeproc", action="store_true", help="Salvar somente nfeProc (descarta demais).")
+    p.add_argument("--dest-resumos", help="Pasta para os resumos (resNFe). Sem ela, resumos são descartados.")
+    p.add_argument("--dest-eventos", help="Pasta para eventos (procEventoNFe/resEvento). Sem ela, eventos são descartados.")
     p.add_argument("--verbose", action="store_true", help="Logs detalhados.")
     p.add_argument("--log", help="Arquivo de log.")
 
@@ -635,55 +4522,279 @@ def build_arg_parser() -> argparse.ArgumentParser:
 
 def main():
     args = build_arg_parser().parse_args()
-    setup_logging(args.log, args.verbose)
+    # no modo serviço via stdin, stdout é o canal de respostas: os logs vão para stderr
+    setup_logging(args.log, args.verbose, sys.stderr if args.serve else None)
 
-    if args.baixar_online:
-        for req in ("uf", "cert_pfx", "cert_pass"):
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    parar_metricas = threading.Event()
+    if args.metrics_file:
+        # exportação periódica: --continuo e --serve não terminam
+        def _exportar():
+            while not parar_metricas.wait(args.metrics_intervalo):
+                _METRICS.write(args.metrics_file)
+        threading.Thread(target=_exportar, name="metricas", daemon=True).start()
+
+    try:
+        _run(args)
+    finally:
+        parar_metricas.set()
+        resumo = _METRICS.summary()
+        if resumo:
+            logging.info(f"Etapas: {resumo}")
+        if args.metrics_file:
+            _METRICS.write(args.metrics_file)
+            logging.info(f"Métricas gravadas em {args.metrics_file}")
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            logging.info(f"Perfil (cProfile) gravado em {args.profile}; veja com: python -m pstats {args.profile}")
+
+
+def _run(args: argparse.Namespace):
+    set_state_store(open_state_store(args.state_backend, args.state_db))
+    if args.endpoint:
+        set_endpoint(args.endpoint)
+        logging.info(f"Endpoint substituído: {args.endpoint}")
+    if args.importar_estado_json:
+        n = import_json_states(_STATE_STORE, args.importar_estado_json)
+        logging.info(f"{n} estado(s) importado(s) para o backend {args.state_backend}.")
+        return
+    if args.listar_estado:
+        print(format_state_report(_STATE_STORE.list()))
+        return
+    if args.lacunas:
+        cnpj_filtro = re.sub(r"\D", "", args.cnpj) if args.cnpj else None
+        states = [st for st in _STATE_STORE.list() if cnpj_filtro in (None, st["cnpj"])]
+        print(format_gap_report([(st, load_ledger(st["cnpj"], st["ambiente"])) for st in states]))
+        return
+    lease_store = open_lease_store(args.lease_backend, args.lease_path)
+    if args.listar_leases:
+        if lease_store is None:
+            logging.error("--lease-backend é obrigatório com --listar-leases.")
+            sys.exit(2)
+        print(format_lease_report(lease_store.list()))
+        return
+    if (isinstance(lease_store, SqliteLeaseStore) and isinstance(_STATE_STORE, SqliteStateStore)
+            and os.path.abspath(lease_store.path) == os.path.abspath(_STATE_STORE.path)):
+        # o fencing segura a transação dos leases enquanto grava o estado
+        logging.error("--lease-path não pode ser a mesma base SQLite de --state-db.")
+        sys.exit(2)
+    set_lease_store(lease_store, args.lease_ttl, args.no_id)
+    if lease_store is not None:
+        logging.info(f"Leases: backend {args.lease_backend}, nó {_NODE_ID}, TTL {args.lease_ttl:g}s")
+
+    try:
+        set_storage_mode(args.armazenamento)
+    except ImportError as e:
+        logging.error(str(e))
+        sys.exit(2)
+    if args.exportar_pacotes:
+        if not args.dest:
+            logging.error("--dest é obrigatório com --exportar-pacotes.")
+            sys.exit(2)
+        n = _PACKS.export(args.dest, args.exportar_pacotes)
+        logging.info(f"{n} documento(s) exportado(s) para {args.exportar_pacotes}.")
+        return
+
+    if args.consultar:
+        if not args.dest:
+            logging.error("--dest é obrigatório com --consultar.")
+            sys.exit(2)
+        try:
+            emissao = as_date_range(_job_filter({"mes": args.mes_emissao, "ultimo_mes": args.ultimo_mes,
+                                                  "de": args.emissao_de, "ate": args.emissao_ate}))
+        except ValueError as e:
+            logging.error(str(e))
+            sys.exit(2)
+        inicio = time.perf_counter()
+        rows = ChaveIndex(args.dest).consultar(
+            cnpj=re.sub(r"\D", "", args.cnpj) if args.cnpj else None,
+            emitente=re.sub(r"\D", "", args.emitente) if args.emitente else None,
+            destinatario=re.sub(r"\D", "", args.destinatario) if args.destinatario else None,
+            emissao=emissao,
+            valor_min=args.valor_min,
+            valor_max=args.valor_max,
+            chave=args.chave,
+            limite=args.limite,
+        )
+        if args.json:
+            for r in rows:
+                print(json.dumps(r, ensure_ascii=False))
+        else:
+            print(format_catalog_report(rows))
+        logging.info(f"Consulta: {len(rows)} nota(s) em {(time.perf_counter() - inicio) * 1000:.1f} ms")
+        return
+
+    if args.validar_xsd:
+        set_validator(XsdValidator(args.xsd_dir + [os.path.dirname(os.path.abspath(__file__))], args.quarentena))
+
+    set_session_pool(SessionPool(idle_seconds=args.sessao_ociosa))
+    policy = PacingPolicy(
+        intervalo=args.intervalo,
+        cooldown_em_dia=args.cooldown_em_dia,
+        cooldown_pendente=args.cooldown_pendente,
+        backoff_656=args.backoff_656,
+        max_chamadas=args.max_chamadas or None,
+    )
+    if args.serve or args.serve_socket:
+        try:
+            serve(ServeContext(args, policy), args.serve_socket, args.max_paralelo)
+        finally:
+            _SESSION_POOL.close()
+            _PACKS.close()
+        return
+
+    if not args.dest:
+        logging.error("--dest é obrigatório.")
+        sys.exit(2)
+    if not args.cnpj and not args.tenants:
+        logging.error("--cnpj é obrigatório (ou use --tenants).")
+        sys.exit(2)
+    if args.scan_dir and not args.cnpj:
+        logging.error("--cnpj é obrigatório com --scan-dir.")
+        sys.exit(2)
+    if args.watch and not args.scan_dir:
+        logging.error("--watch requer --scan-dir.")
+        sys.exit(2)
+    if args.baixar_online and not args.cnpj:
+        logging.error("--cnpj é obrigatório com --baixar-online.")
+        sys.exit(2)
+
+    if args.baixar_online or (args.reparar_lacunas and args.cnpj):
+        obrigatorios = ("uf", "cert_pfx", "cert_pass") if requires_certificate(args.amb) else ("uf",)
+        for req in obrigatorios:
             if getattr(args, req.replace("-", "_"), None) is None:
-                logging.error(f"--{req.replace('_','-')} é obrigatório com --baixar-online.")
+                logging.error(f"--{req.replace('_','-')} é obrigatório com --baixar-online/--reparar-lacunas.")
                 sys.exit(2)
         if args.uf.upper() not in UF_CODE_MAP:
             logging.error(f"UF inválida: {args.uf}")
             sys.exit(2)
 
     month_tuple = month_from_arg(args.mes_emissao, args.ultimo_mes)
-    filtro_ano_mes = f"{month_tuple[0]:04d}-{month_tuple[1]:02d}" if month_tuple else None
+    date_range = range_from_args(args.emissao_de, args.emissao_ate)
+    if month_tuple and date_range:
+        logging.error("Use --mes-emissao/--ultimo-mes ou --emissao-de/--emissao-ate, não ambos.")
+        sys.exit(2)
+    emission_filter = month_tuple or date_range
+    filtro_ano_mes = filter_key(emission_filter) or None
 
-    if month_tuple:
-        logging.info(f"Filtro de emissão: {month_tuple[0]:04d}-{month_tuple[1]:02d}")
+    if emission_filter:
+        logging.info(f"Filtro de emissão: {filter_key(emission_filter)}")
     else:
         logging.info("Sem filtro de mês (trará todas as emissões).")
 
     ensure_dir(args.dest)
-    cnpj_digits = re.sub(r"\D", "", args.cnpj)
+    cnpj_digits = re.sub(r"\D", "", args.cnpj) if args.cnpj else ""
 
     total_proc = 0
     total_save = 0
 
+    index = None if args.sem_indice else ChaveIndex(args.dest)
+    if index is not None and args.reconstruir_indice:
+        logging.info(f"Índice: {index.rebuild()} nfeProc existente(s) indexado(s).")
+
     def _salvar(xml_txt: str, raw: bytes):
-        salvar_nfeproc_renomeando(xml_txt, raw, args.dest, cnpj_digits)
+        return salvar_nfeproc_renomeando(xml_txt, raw, args.dest, cnpj_digits, index=index)
+
+    sinks = {
+        "resNFe": args.dest_resumos,
+        "procEventoNFe": args.dest_eventos,
+        "resEvento": args.dest_eventos,
+    }
+    router = build_router(cnpj_digits, _salvar, sinks, args.apenas_nfeproc)
 
     if args.baixar_online:
-        p, s = baixar_online(
-            cnpj=cnpj_digits,
-            uf=args.uf.upper(),
-            ambiente=args.amb,
-            cert_pfx=args.cert_pfx,
-            cert_pass=args.cert_pass,
+        try:
+            p, s = baixar_online(
+                cnpj=cnpj_digits,
+                uf=args.uf.upper(),
+                ambiente=args.amb,
+                cert_pfx=args.cert_pfx,
+                cert_pass=args.cert_pass,
+                filtro_ano_mes=filtro_ano_mes,
+                salvar_xml_fn=_salvar,
+                verbose=args.verbose,
+                router=router,
+                pipeline_workers=args.pipeline,
+                pipeline_fila=args.pipeline_fila,
+                policy=policy,
+            )
+            total_proc += p
+            total_save += s
+        except LeaseOcupado as e:
+            logging.info(f"Consulta não iniciada: {e}")
+
+    if args.reparar_lacunas:
+        # depois do distNSU (se houver), para o cursor já estar atualizado
+        alvos = []
+        if args.cnpj:
+            alvos.append({"cnpj": cnpj_digits, "uf": args.uf.upper(), "amb": args.amb,
+                          "cert_pfx": args.cert_pfx, "cert_pass": args.cert_pass, "dest": None})
+        if args.tenants:
+            alvos.extend(load_tenants(args.tenants, requires_certificate(args.amb)))
+        for t in alvos:
+            try:
+                p, s = _run_tenant(t, args.dest, filtro_ano_mes, args.verbose, index, sinks,
+                                   args.apenas_nfeproc, policy=policy, reparar=True)
+                total_proc += p
+                total_save += s
+            except LeaseOcupado as e:
+                logging.info(f"Reparo não iniciado: {e}")
+            except Exception as e:
+                logging.exception(f"Falha no reparo de {t['cnpj']}/{t['amb']}: {e}")
+
+    if args.tenants:
+        p, s = run_tenants(
+            tenants=load_tenants(args.tenants, requires_certificate(args.amb)),
+            dest_root=args.dest,
             filtro_ano_mes=filtro_ano_mes,
-            salvar_xml_fn=_salvar,
+            max_paralelo=args.max_paralelo,
+            continuo=args.continuo,
             verbose=args.verbose,
+            index=index,
+            sinks=sinks,
+            apenas_nfeproc=args.apenas_nfeproc,
+            pipeline_workers=args.pipeline,
+            policy=policy,
         )
         total_proc += p
         total_save += s
 
-    if args.scan_dir:
+    if args.scan_dir and args.watch:
+        p, s = watch_scan_dir(
+            scan_dir=args.scan_dir,
+            dest_root=args.dest,
+            cnpj=cnpj_digits,
+            month_filter=emission_filter,
+            apenas_nfeproc=args.apenas_nfeproc,
+            workers=args.workers,
+            index=index,
+            manifest=ScanManifest(args.scan_manifest or os.path.join(STATE_DIR, "scan_manifest.sqlite")),
+            router=router,
+            debounce=args.watch_debounce,
+            backend=args.watch_backend,
+            intervalo_poll=args.watch_poll,
+            full_rescan=args.full_rescan,
+        )
+        total_proc += p
+        total_save += s
+    elif args.scan_dir:
         p, s = process_doczips_locais(
             scan_dir=args.scan_dir,
             dest_root=args.dest,
             cnpj=cnpj_digits,
-            month_filter=month_tuple,
-            apenas_nfeproc=True,
+            month_filter=emission_filter,
+            apenas_nfeproc=args.apenas_nfeproc,
+            workers=args.workers,
+            index=index,
+            manifest=ScanManifest(args.scan_manifest or os.path.join(STATE_DIR, "scan_manifest.sqlite")),
+            full_rescan=args.full_rescan,
+            router=router,
         )
         total_proc += p
         total_save += s
@@ -695,6 +4806,8 @@ def main():
         f"{month_tuple[1]:02d}" if month_tuple else ""
     ).rstrip("\\/")
 
+    _SESSION_POOL.close()
+    _PACKS.close()
     logging.info(f"Resumo: processados={total_proc}, salvos={total_save}, destino={dest_preview}")
 
 if __name__ == "__main__":
@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+"""
+Servidor local que imita o NFeDistribuicaoDFe (SOAP 1.2) para testes de carga e
+ponta a ponta do capturarXmlSefaz, sem consumir a cota da SEFAZ nem arriscar 656.
+
+Responde distNSU e consNSU com retDistDFeInt contendo docZip sintéticos (gzip+base64)
+de nfeProc, resNFe, procEventoNFe e resEvento, gerados de forma determinística a partir
+de (seed, CNPJ, NSU): duas execuções com os mesmos parâmetros devolvem os mesmos bytes.
+
+Uso:
+  python mockSefazDistDFe.py --port 8765 --max-nsu 5000 --lote 50 --latencia 150 --jitter 100
+  python capturarXmlSefaz_1763056346624.py --baixar-online --endpoint http://127.0.0.1:8765/ws \\
+      --cnpj 12345678000199 --uf SP --dest ./saida --intervalo 0 --max-chamadas 0
+
+GET /stats devolve contadores de requisições por cStat e falhas injetadas.
+Só usa a biblioteca padrão.
+"""
+
+import argparse
+import base64
+import gzip
+import http.server
+import json
+import logging
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+NS_NFE = "http://www.portalfiscal.inf.br/nfe"
+NS_SOAP = "http://www.w3.org/2003/05/soap-envelope"
+NS_WSDL = "http://www.portalfiscal.inf.br/nfe/wsdl/NFeDistribuicaoDFe"
+
+SCHEMAS = {
+    "procNFe": "procNFe_v4.00.xsd",
+    "resNFe": "resNFe_v1.01.xsd",
+    "procEventoNFe": "procEventoNFe_v1.00.xsd",
+    "resEvento": "resEvento_v1.01.xsd",
+}
+
+XMOTIVO = {
+    137: "Nenhum documento localizado",
+    138: "Documento(s) localizado(s)",
+    656: "Rejeição: Consumo Indevido (Deve ser aguardado 1 hora para efetuar nova solicitação caso não existam mais documentos a serem pesquisados)",
+}
+
+
+class MockConfig(NamedTuple):
+    """
+    Parâmetros do servidor. Latências em milissegundos; probabilidades entre 0 e 1.
+    mix: peso de cada tipo de documento; meses: meses de emissão (AAAA-MM) sorteados;
+    nnf_distintos: faixa de nNF por mês (valores pequenos geram nNF repetidos);
+    sequencia: cStat forçados para as primeiras requisições (depois, comportamento normal);
+    bloqueio_656: segundos após ficar em dia (137) em que nova consulta recebe 656;
+    omitir: fração dos docZip que o distNSU deixa de fora (o consNSU do mesmo NSU os devolve).
+    """
+    max_nsu: int = 1000
+    lote: int = 50
+    latencia_ms: float = 0
+    jitter_ms: float = 0
+    meses: Tuple[str, ...] = ("2025-10", "2025-11")
+    mix: Tuple[Tuple[str, float], ...] = (("procNFe", 0.7), ("resNFe", 0.15),
+                                          ("procEventoNFe", 0.1), ("resEvento", 0.05))
+    nnf_distintos: int = 100000
+    itens: int = 3
+    sequencia: Tuple[int, ...] = ()
+    bloqueio_656: float = 0
+    falha_http: float = 0
+    falha_lenta: float = 0
+    falha_lenta_seg: float = 65
+    falha_truncada: float = 0
+    omitir: float = 0
+    seed: int = 1
+
+
+# ========= Geração de documentos =========
+
+def _dv_chave(chave43: str) -> str:
+    """
+    Dígito verificador da chave de acesso (módulo 11, pesos 2..9).
+    """
+    total, peso = 0, 2
+    for d in reversed(chave43):
+        total += int(d) * peso
+        peso = 2 if peso == 9 else peso + 1
+    resto = total % 11
+    return "0" if resto < 2 else str(11 - resto)
+
+
+def gerar_chave(cnpj_emit: str, dh_emi: datetime, nnf: int, serie: int = 1,
+                cuf: int = 35, modelo: int = 55, codigo: int = 0) -> str:
+    base = (f"{cuf:02d}{dh_emi:%y%m}{cnpj_emit:0>14}{modelo:02d}{serie:03d}"
+            f"{nnf:09d}1{codigo % 10 ** 8:08d}")
+    return base + _dv_chave(base)
+
+
+def _cnpj_emitente(rng: random.Random) -> str:
+    return f"{rng.randrange(10 ** 7, 10 ** 8)}0001{rng.randrange(10, 100)}"
+
+
+def gerar_nfeproc(chave: str, nnf: int, dh_emi: datetime, cnpj_emit: str, cnpj_dest: str,
+                  itens: int = 3, rng: Optional[random.Random] = None) -> bytes:
+    rng = rng or random.Random(nnf)
+    dh = dh_emi.strftime("%Y-%m-%dT%H:%M:%S-03:00")
+    dets = []
+    total = 0.0
+    for i in range(1, itens + 1):
+        q = rng.randint(1, 20)
+        v = round(rng.uniform(1, 500), 2)
+        total += q * v
+        dets.append(
+            f'<det nItem="{i}"><prod><cProd>{rng.randrange(10 ** 5):05d}</cProd><cEAN>SEM GTIN</cEAN>'
+            f'<xProd>PRODUTO SINTETICO {i}</xProd><NCM>84713012</NCM><CFOP>5102</CFOP><uCom>UN</uCom>'
+            f'<qCom>{q:.4f}</qCom><vUnCom>{v:.10f}</vUnCom><vProd>{q * v:.2f}</vProd><cEANTrib>SEM GTIN</cEANTrib>'
+            f'<uTrib>UN</uTrib><qTrib>{q:.4f}</qTrib><vUnTrib>{v:.10f}</vUnTrib><indTot>1</indTot></prod>'
+            f'<imposto><ICMS><ICMS00><orig>0</orig><CST>00</CST><modBC>3</modBC><vBC>{q * v:.2f}</vBC>'
+            f'<pICMS>18.00</pICMS><vICMS>{q * v * 0.18:.2f}</vICMS></ICMS00></ICMS></imposto></det>'
+        )
+    return (
+        f'<?xml version="1.0" encoding="UTF-8"?><nfeProc xmlns="{NS_NFE}" versao="4.00"><NFe>'
+        f'<infNFe Id="NFe{chave}" versao="4.00"><ide><cUF>{chave[:2]}</cUF><cNF>{chave[35:43]}</cNF>'
+        f'<natOp>VENDA</natOp><mod>55</mod><serie>1</serie><nNF>{nnf}</nNF><dhEmi>{dh}</dhEmi>'
+        f'<tpNF>1</tpNF><idDest>1</idDest><tpAmb>1</tpAmb></ide>'
+        f'<emit><CNPJ>{cnpj_emit}</CNPJ><xNome>EMITENTE SINTETICO LTDA</xNome><IE>111111111111</IE></emit>'
+        f'<dest><CNPJ>{cnpj_dest}</CNPJ><xNome>DESTINATARIO SINTETICO</xNome></dest>'
+        f'{"".join(dets)}<total><ICMSTot><vProd>{total:.2f}</vProd><vNF>{total:.2f}</vNF></ICMSTot></total>'
+        f'</infNFe><Signature xmlns="http://www.w3.org/2000/09/xmldsig#"><SignatureValue>'
+        f'{base64.b64encode(rng.randbytes(256)).decode()}</SignatureValue></Signature></NFe>'
+        f'<protNFe versao="4.00"><infProt><tpAmb>1</tpAmb><chNFe>{chave}</chNFe><dhRecbto>{dh}</dhRecbto>'
+        f'<nProt>1{rng.randrange(10 ** 13, 10 ** 14)}</nProt><cStat>100</cStat>'
+        f'<xMotivo>Autorizado o uso da NF-e</xMotivo></infProt></protNFe></nfeProc>'
+    ).encode("utf-8")
+
+
+def gerar_resnfe(chave: str, dh_emi: datetime, cnpj_emit: str, valor: float = 100.0) -> bytes:
+    dh = dh_emi.strftime("%Y-%m-%dT%H:%M:%S-03:00")
+    return (
+        f'<resNFe xmlns="{NS_NFE}" versao="1.01"><chNFe>{chave}</chNFe><CNPJ>{cnpj_emit}</CNPJ>'
+        f'<xNome>EMITENTE SINTETICO LTDA</xNome><IE>111111111111</IE><dhEmi>{dh}</dhEmi><tpNF>1</tpNF>'
+        f'<vNF>{valor:.2f}</vNF><digVal>{base64.b64encode(chave.encode()[:20]).decode()}</digVal>'
+        f'<dhRecbto>{dh}</dhRecbto><nProt>135250000000001</nProt><cSitNFe>1</cSitNFe></resNFe>'
+    ).encode("utf-8")
+
+
+def gerar_evento(chave: str, dh_evento: datetime, cnpj_autor: str, resumo: bool = False) -> bytes:
+    dh = dh_evento.strftime("%Y-%m-%dT%H:%M:%S-03:00")
+    if resumo:
+        return (
+            f'<resEvento xmlns="{NS_NFE}" versao="1.01"><cOrgao>91</cOrgao><CNPJ>{cnpj_autor}</CNPJ>'
+            f'<chNFe>{chave}</chNFe><dhEvento>{dh}</dhEvento><tpEvento>110111</tpEvento><nSeqEvento>1</nSeqEvento>'
+            f'<xEvento>Cancelamento</xEvento><dhRecbto>{dh}</dhRecbto><nProt>135250000000002</nProt></resEvento>'
+        ).encode("utf-8")
+    return (
+        f'<procEventoNFe xmlns="{NS_NFE}" versao="1.00"><evento versao="1.00"><infEvento Id="ID210210{chave}01">'
+        f'<cOrgao>91</cOrgao><tpAmb>1</tpAmb><CNPJ>{cnpj_autor}</CNPJ><chNFe>{chave}</chNFe><dhEvento>{dh}</dhEvento>'
+        f'<tpEvento>210210</tpEvento><nSeqEvento>1</nSeqEvento><verEvento>1.00</verEvento>'
+        f'<detEvento versao="1.00"><descEvento>Ciencia da Operacao</descEvento></detEvento></infEvento></evento>'
+        f'<retEvento versao="1.00"><infEvento><tpAmb>1</tpAmb><cStat>135</cStat><chNFe>{chave}</chNFe>'
+        f'<tpEvento>210210</tpEvento><dhRegEvento>{dh}</dhRegEvento></infEvento></retEvento></procEventoNFe>'
+    ).encode("utf-8")
+
+
+def _sortear_tipo(rng: random.Random, mix) -> str:
+    total = sum(p for _, p in mix)
+    x = rng.uniform(0, total)
+    for tipo, peso in mix:
+        x -= peso
+        if x <= 0:
+            return tipo
+    return mix[-1][0]
+
+
+def gerar_documento(cfg: MockConfig, cnpj_dest: str, nsu: int) -> Tuple[str, bytes]:
+    """
+    Documento do NSU para o CNPJ destinatário: (tipo, xml). Determinístico por (seed, CNPJ, NSU).
+    """
+    rng = random.Random(f"{cfg.seed}:{cnpj_dest}:{nsu}")
+    tipo = _sortear_tipo(rng, cfg.mix)
+    ano, mes = (int(x) for x in rng.choice(cfg.meses).split("-"))
+    dh = datetime(ano, mes, 1) + timedelta(days=rng.randrange(28), seconds=rng.randrange(86400))
+    nnf = rng.randrange(1, cfg.nnf_distintos + 1)
+    emit = _cnpj_emitente(rng)
+    chave = gerar_chave(emit, dh, nnf, codigo=nsu)
+
+    if tipo == "procNFe":
+        xml = gerar_nfeproc(chave, nnf, dh, emit, cnpj_dest, cfg.itens, rng)
+    elif tipo == "resNFe":
+        xml = gerar_resnfe(chave, dh, emit, round(rng.uniform(10, 5000), 2))
+    else:
+        xml = gerar_evento(chave, dh + timedelta(days=1), cnpj_dest, resumo=(tipo == "resEvento"))
+    return tipo, xml
+
+
+def montar_resposta(cstat: int, ult_nsu: int, max_nsu: int,
+                    docs: List[Tuple[int, str, bytes]] = (), xmotivo: Optional[str] = None) -> bytes:
+    """
+    Envelope SOAP 1.2 com retDistDFeInt; docs = [(nsu, tipo, xml), ...].
+    """
+    zips = "".join(
+        f'<docZip NSU="{nsu:015d}" schema="{SCHEMAS[tipo]}">'
+        f'{base64.b64encode(gzip.compress(xml, compresslevel=6)).decode()}</docZip>'
+        for nsu, tipo, xml in docs
+    )
+    lote = f"<loteDistDFeInt>{zips}</loteDistDFeInt>" if docs else ""
+    agora = datetime.now().strftime("%Y-%m-%dT%H:%M:%S-03:00")
+    return (
+        f'<?xml version="1.0" encoding="utf-8"?><soap:Envelope xmlns:soap="{NS_SOAP}"><soap:Body>'
+        f'<nfeDistDFeInteresseResponse xmlns="{NS_WSDL}"><nfeDistDFeInteresseResult>'
+        f'<retDistDFeInt xmlns="{NS_NFE}" versao="1.01"><tpAmb>1</tpAmb><verAplic>MOCK_1.0</verAplic>'
+        f'<cStat>{cstat}</cStat><xMotivo>{xmotivo or XMOTIVO.get(cstat, "")}</xMotivo><dhResp>{agora}</dhResp>'
+        f'<ultNSU>{ult_nsu:015d}</ultNSU><maxNSU>{max_nsu:015d}</maxNSU>{lote}</retDistDFeInt>'
+        f'</nfeDistDFeInteresseResult></nfeDistDFeInteresseResponse></soap:Body></soap:Envelope>'
+    ).encode("utf-8")
+
+
+# ========= Servidor =========
+
+_CNPJ_RE = re.compile(rb"<CNPJ>(\d+)</CNPJ>")
+_DIST_RE = re.compile(rb"<distNSU>\s*<ultNSU>(\d+)</ultNSU>")
+_CONS_RE = re.compile(rb"<consNSU>\s*<NSU>(\d+)</NSU>")
+
+
+class MockDistDFe:
+    """
+    Lógica do serviço, separada do HTTP: decide cStat, lote e falhas de cada requisição.
+    """
+
+    def __init__(self, cfg: MockConfig):
+        self.cfg = cfg
+        self._lock = threading.Lock()
+        self._rng = random.Random(cfg.seed)
+        self._n = 0
+        self._em_dia: Dict[str, float] = {}
+        self.stats = {"requisicoes": 0, "documentos": 0, "bytes": 0, "cstat": {}, "falhas": {}}
+
+    def _contar(self, chave: str, grupo: str = "cstat") -> None:
+        self.stats[grupo][chave] = self.stats[grupo].get(chave, 0) + 1
+
+    def falha(self) -> Optional[str]:
+        """
+        Falha a injetar nesta requisição: "http", "lenta", "truncada" ou None.
+        """
+        with self._lock:
+            x = self._rng.random()
+            for nome, p in (("http", self.cfg.falha_http), ("lenta", self.cfg.falha_lenta),
+                            ("truncada", self.cfg.falha_truncada)):
+                if x < p:
+                    self._contar(nome, "falhas")
+                    return nome
+                x -= p
+        return None
+
+    def latencia(self) -> float:
+        with self._lock:
+            jitter = self._rng.uniform(0, self.cfg.jitter_ms)
+        return (self.cfg.latencia_ms + jitter) / 1000.0
+
+    def responder(self, body: bytes) -> bytes:
+        cfg = self.cfg
+        m = _CNPJ_RE.search(body)
+        cnpj = m.group(1).decode() if m else ""
+        dist = _DIST_RE.search(body)
+        cons = _CONS_RE.search(body)
+
+        with self._lock:
+            forcado = cfg.sequencia[self._n] if self._n < len(cfg.sequencia) else None
+            self._n += 1
+            self.stats["requisicoes"] += 1
+            bloqueado = (cfg.bloqueio_656 > 0 and cnpj in self._em_dia
+                         and time.time() - self._em_dia[cnpj] < cfg.bloqueio_656)
+
+        if cons is not None:
+            nsu = int(cons.group(1))
+            ult = nsu
+            if forcado in (137, 656) or not 0 < nsu <= cfg.max_nsu:
+                cstat, docs = forcado or 137, []
+            else:
+                cstat, docs = 138, [(nsu, *gerar_documento(cfg, cnpj, nsu))]
+        else:
+            ult = int(dist.group(1)) if dist else 0
+            if forcado == 656 or (forcado is None and bloqueado):
+                cstat, docs = 656, []
+            elif forcado == 137 or ult >= cfg.max_nsu:
+                cstat, docs = 137, []
+                ult = max(ult, cfg.max_nsu) if forcado is None else ult
+            else:
+                fim = min(ult + cfg.lote, cfg.max_nsu)
+                docs = [(nsu, *gerar_documento(cfg, cnpj, nsu)) for nsu in range(ult + 1, fim + 1)
+                        if not (cfg.omitir and random.Random(f"omitir:{cfg.seed}:{cnpj}:{nsu}").random() < cfg.omitir)]
+                cstat, ult = 138, fim
+
+        with self._lock:
+            self._contar(str(cstat))
+            self.stats["documentos"] += len(docs)
+            if cstat == 137 or (cstat == 138 and ult >= cfg.max_nsu):
+                self._em_dia[cnpj] = time.time()
+
+        out = montar_resposta(cstat, ult, cfg.max_nsu, docs)
+        with self._lock:
+            self.stats["bytes"] += len(out)
+        return out
+
+
+def _handler(servico: MockDistDFe):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, fmt, *args):
+            logging.debug(f"{self.address_string()} {fmt % args}")
+
+        def _enviar(self, status: int, body: bytes, content_type: str, truncar: bool = False):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if truncar:
+                self.wfile.write(body[: len(body) // 2])
+                self.close_connection = True
+                return
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.rstrip("/") == "/stats":
+                with servico._lock:
+                    body = json.dumps(servico.stats).encode("utf-8")
+                self._enviar(200, body, "application/json")
+            else:
+                self._enviar(404, b"", "text/plain")
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            falha = servico.falha()
+            time.sleep(servico.latencia())
+            if falha == "http":
+                self._enviar(500, b"falha injetada", "text/plain")
+                return
+            if falha == "lenta":
+                time.sleep(servico.cfg.falha_lenta_seg)
+            out = servico.responder(body)
+            self._enviar(200, out, "application/soap+xml; charset=utf-8", truncar=(falha == "truncada"))
+
+    return Handler
+
+
+def iniciar(cfg: MockConfig, host: str = "127.0.0.1", port: int = 0
+            ) -> Tuple[http.server.ThreadingHTTPServer, MockDistDFe, str]:
+    """
+    Sobe o servidor numa thread daemon. Retorna (servidor, serviço, URL do endpoint).
+    """
+    servico = MockDistDFe(cfg)
+    server = http.server.ThreadingHTTPServer((host, port), _handler(servico))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="mock-distdfe", daemon=True).start()
+    return server, servico, f"http://{host}:{server.server_port}/ws"
+
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(description="Servidor local que imita o NFeDistribuicaoDFe para testes de carga.")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8765)
+    p.add_argument("--max-nsu", type=int, default=1000, help="maxNSU de cada CNPJ (default: 1000).")
+    p.add_argument("--lote", type=int, default=50, help="Documentos por resposta 138 (default: 50, como a SEFAZ).")
+    p.add_argument("--latencia", type=float, default=0, help="Latência fixa por requisição, em ms.")
+    p.add_argument("--jitter", type=float, default=0, help="Latência extra aleatória (0..N ms).")
+    p.add_argument("--meses", default="2025-10,2025-11", help="Meses de emissão sorteados (AAAA-MM,...).")
+    p.add_argument("--mix", default="procNFe=0.7,resNFe=0.15,procEventoNFe=0.1,resEvento=0.05",
+                   help="Pesos dos tipos de documento.")
+    p.add_argument("--nnf-distintos", type=int, default=100000,
+                   help="Faixa de nNF sorteados; valores pequenos geram nNF repetidos.")
+    p.add_argument("--itens", type=int, default=3, help="Itens (det) por nfeProc; controla o tamanho.")
+    p.add_argument("--sequencia", default="",
+                   help="cStat forçados para as primeiras requisições, ex.: 138,138,656,137.")
+    p.add_argument("--bloqueio-656", type=float, default=0,
+                   help="Responde 656 a consultas feitas até N s depois de o CNPJ ficar em dia (0 = desliga).")
+    p.add_argument("--falha-http", type=float, default=0, help="Probabilidade de HTTP 500.")
+    p.add_argument("--falha-lenta", type=float, default=0, help="Probabilidade de resposta além do timeout.")
+    p.add_argument("--falha-lenta-seg", type=float, default=65, help="Atraso da resposta lenta (default: 65 s).")
+    p.add_argument("--falha-truncada", type=float, default=0, help="Probabilidade de corpo cortado ao meio.")
+    p.add_argument("--omitir", type=float, default=0,
+                   help="Fração dos docZip omitidos no distNSU (lacunas de NSU); o consNSU os devolve.")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--verbose", action="store_true")
+    return p
+
+
+def config_from_args(args: argparse.Namespace) -> MockConfig:
+    mix = []
+    for item in args.mix.split(","):
+        tipo, _, peso = item.partition("=")
+        if tipo.strip() not in SCHEMAS:
+            raise SystemExit(f"--mix: tipo desconhecido {tipo!r} (use {', '.join(SCHEMAS)})")
+        mix.append((tipo.strip(), float(peso or 1)))
+    return MockConfig(
+        max_nsu=args.max_nsu,
+        lote=max(1, args.lote),
+        latencia_ms=args.latencia,
+        jitter_ms=args.jitter,
+        meses=tuple(m.strip() for m in args.meses.split(",") if m.strip()),
+        mix=tuple(mix),
+        nnf_distintos=max(1, args.nnf_distintos),
+        itens=max(1, args.itens),
+        sequencia=tuple(int(c) for c in args.sequencia.split(",") if c.strip()),
+        bloqueio_656=args.bloqueio_656,
+        falha_http=args.falha_http,
+        falha_lenta=args.falha_lenta,
+        falha_lenta_seg=args.falha_lenta_seg,
+        falha_truncada=args.falha_truncada,
+        omitir=args.omitir,
+        seed=args.seed,
+    )
+
+
+def main():
+    args = build_arg_parser().parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s | %(levelname)s | %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+    cfg = config_from_args(args)
+    server, servico, url = iniciar(cfg, args.host, args.port)
+    logging.info(f"Mock NFeDistribuicaoDFe em {url} (maxNSU={cfg.max_nsu}, lote={cfg.lote}); Ctrl+C encerra.")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        logging.info(f"Estatísticas: {json.dumps(servico.stats)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Testes de fumaça do capturarXmlSefaz contra o mockSefazDistDFe local.
+
+O mock roda numa thread deste processo (iniciar) e a CLI num subprocesso, como em
+produção: nenhum estado global do módulo vaza entre os testes.
+"""
+
+import importlib.util
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+ASSETS = Path(__file__).resolve().parent.parent / "attached_assets"
+SCRIPT = ASSETS / "capturarXmlSefaz_1763056346624.py"
+CNPJ = "12345678000199"
+
+sys.path.insert(0, str(ASSETS))
+import mockSefazDistDFe as mock  # noqa: E402
+
+
+def _carregar_script():
+    spec = importlib.util.spec_from_file_location("capturarXmlSefaz", SCRIPT)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+capturar = _carregar_script()
+
+
+@pytest.fixture
+def servidor():
+    servidores = []
+
+    def _iniciar(**campos):
+        server, servico, url = mock.iniciar(mock.MockConfig(**campos))
+        servidores.append(server)
+        return servico, url
+
+    yield _iniciar
+    for server in servidores:
+        server.shutdown()
+        server.server_close()
+
+
+def _cli(cwd: Path, *args: str) -> subprocess.CompletedProcess:
+    proc = subprocess.run([sys.executable, str(SCRIPT), *args], cwd=cwd,
+                          capture_output=True, text=True, timeout=120)
+    assert proc.returncode == 0, proc.stderr
+    return proc
+
+
+def _online(cwd: Path, url: str, *args: str) -> subprocess.CompletedProcess:
+    return _cli(cwd, "--cnpj", CNPJ, "--uf", "SP", "--endpoint", url, "--dest", "dest",
+                "--intervalo", "0", "--max-chamadas", "0",
+                "--state-backend", "sqlite", "--state-db", "estado.sqlite", *args)
+
+
+def _tipos(cfg: "mock.MockConfig", nsus) -> list:
+    return [mock.gerar_documento(cfg, CNPJ, nsu)[0] for nsu in nsus]
+
+
+def _xmls(pasta: Path) -> list:
+    return sorted(p for p in pasta.rglob("*.xml")) if pasta.exists() else []
+
+
+def test_baixar_online_basico(tmp_path, servidor):
+    servico, url = servidor(max_nsu=120, lote=50)
+    _online(tmp_path, url, "--baixar-online")
+
+    esperados = _tipos(servico.cfg, range(1, 121)).count("procNFe")
+    assert len(_xmls(tmp_path / "dest" / CNPJ)) == esperados
+
+    state = capturar.SqliteStateStore(str(tmp_path / "estado.sqlite")).load(CNPJ, "prod")
+    assert int(state["ult_nsu"]) == 120
+    assert state["motivo_espera"] == "em_dia"
+
+
+def test_reparar_lacunas_fecha_omitidos(tmp_path, servidor):
+    servico, url = servidor(max_nsu=200, lote=50, omitir=0.1)
+    _online(tmp_path, url, "--baixar-online")
+
+    store = capturar.SqliteStateStore(str(tmp_path / "estado.sqlite"))
+    nao_recebidos, nao_gravados = store.load_ledger(CNPJ, "prod").lacunas(200)
+    assert nao_recebidos.total() > 0
+    assert nao_gravados.total() == 0
+
+    _online(tmp_path, url, "--reparar-lacunas")
+
+    nao_recebidos, nao_gravados = store.load_ledger(CNPJ, "prod").lacunas(200)
+    assert nao_recebidos.total() == 0 and nao_gravados.total() == 0
+    esperados = _tipos(servico.cfg, range(1, 201)).count("procNFe")
+    assert len(_xmls(tmp_path / "dest" / CNPJ)) == esperados
+
+
+def test_scan_dir_reroteia_eventos_ao_incluir_destino(tmp_path):
+    cfg = mock.MockConfig()
+    entrada = tmp_path / "in"
+    entrada.mkdir()
+    tipos = []
+    for nsu in range(1, 41):
+        tipo, xml = mock.gerar_documento(cfg, CNPJ, nsu)
+        (entrada / f"{nsu:04d}_{tipo}.xml").write_bytes(xml)
+        tipos.append(tipo)
+
+    base = ("--scan-dir", "in", "--cnpj", CNPJ, "--dest", "dest", "--scan-manifest", "manifesto.sqlite")
+    _cli(tmp_path, *base)
+    assert not (tmp_path / "ev").exists()
+
+    # mesmos arquivos, agora com destino para eventos e resumos: não podem ser pulados
+    _cli(tmp_path, *base, "--dest-eventos", "ev", "--dest-resumos", "res")
+    roteados = len(_xmls(tmp_path / "ev")) + len(_xmls(tmp_path / "res"))
+    assert roteados == len(tipos) - tipos.count("procNFe")
+
+    proc = _cli(tmp_path, *base, "--dest-eventos", "ev", "--dest-resumos", "res")
+    assert "(manifesto): 40" in proc.stderr + proc.stdout
+
+
+@pytest.mark.parametrize("backend", ["arquivo", "sqlite"])
+def test_gravacao_com_token_antigo_e_recusada(tmp_path, backend, monkeypatch):
+    monkeypatch.setattr(capturar, "STATE_DIR", str(tmp_path / "estado"))
+    capturar.set_state_store(capturar.SqliteStateStore(str(tmp_path / "estado.sqlite")))
+    leases = capturar.open_lease_store(backend, str(tmp_path / ("leases" if backend == "arquivo" else "leases.sqlite")))
+    capturar.set_lease_store(leases)
+    try:
+        antigo, _ = leases.acquire(f"{CNPJ}_prod", "no-a", ttl=0.01)
+        capturar.save_state(CNPJ, "prod", "000000000000010", 0, antigo)
+        time.sleep(0.05)
+        novo, _ = leases.acquire(f"{CNPJ}_prod", "no-b", ttl=60)
+        assert novo.token == antigo.token + 1
+
+        with pytest.raises(capturar.LeasePerdido):
+            capturar.save_state(CNPJ, "prod", "000000000000005", 0, antigo)
+        with pytest.raises(capturar.LeasePerdido):
+            capturar.save_ledger(CNPJ, "prod", capturar.NsuLedger(desde=5), antigo)
+        capturar.save_state(CNPJ, "prod", "000000000000020", 0, novo)
+        assert capturar.load_state(CNPJ, "prod")["ult_nsu"] == "000000000000020"
+        assert capturar.load_ledger(CNPJ, "prod") is None
+    finally:
+        capturar.set_lease_store(None)
+        capturar.set_state_store(capturar.JsonStateStore())